@@ -74,6 +74,30 @@ def create_app():
         os.makedirs(app.config['POSTS_IMAGES_FOLDER'], exist_ok=True)
     # =====================================================================
 
+    # --- Cache su disco delle tile vettoriali dei percorsi (app/tiles.py) ---
+    if 'RENDER' in os.environ:
+        default_tile_cache = '/var/data/tile_cache'
+    else:
+        default_tile_cache = os.path.join(app.instance_path, 'tile_cache')
+    app.config['TILE_CACHE_DIR'] = os.environ.get('TILE_CACHE_DIR', default_tile_cache)
+    app.config['TILE_CACHE_MAX_AGE'] = int(os.environ.get('TILE_CACHE_MAX_AGE', 300))  # secondi, header HTTP
+
+    # --- Cache delle risposte di /api/map_data per cella geohash (app/map_cache.py) ---
+    app.config['MAP_DATA_CACHE_TTL'] = int(os.environ.get('MAP_DATA_CACHE_TTL', 60))  # secondi
+    app.config['MAP_DATA_CACHE_SIZE'] = int(os.environ.get('MAP_DATA_CACHE_SIZE', 512))  # voci per worker
+
+    # --- Cache del grafo dei follow (app/follow_graph.py) ---
+    app.config['FOLLOW_GRAPH_CACHE_TTL'] = int(os.environ.get('FOLLOW_GRAPH_CACHE_TTL', 60))  # secondi
+    app.config['FOLLOW_GRAPH_CACHE_SIZE'] = int(os.environ.get('FOLLOW_GRAPH_CACHE_SIZE', 10000))  # insiemi per worker
+
+    # --- Coda dei lavori in background (app/jobs.py, consumata da worker.py) ---
+    app.config['JOB_WORKER_CONCURRENCY'] = int(os.environ.get('JOB_WORKER_CONCURRENCY', 2))
+    app.config['JOB_VISIBILITY_TIMEOUT'] = int(os.environ.get('JOB_VISIBILITY_TIMEOUT', 300))
+    app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+    app.config['JOB_RETRY_BACKOFF'] = int(os.environ.get('JOB_RETRY_BACKOFF', 30))
+    app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 2))
+    app.config['JOBS_RUN_INLINE'] = os.environ.get('JOBS_RUN_INLINE', '0') == '1'
+
     # --- Estensioni e Inizializzazioni ---
     app.jinja_env.add_extension('jinja2.ext.do')
     db.init_app(app)
@@ -100,10 +124,8 @@ def create_app():
     def inject_global_variables():
         unread_count = 0
         if current_user.is_authenticated:
-            from .models import Notification
-            unread_count = Notification.query.filter_by(
-                recipient_id=current_user.id, read=False
-            ).count()
+            # Contatore mantenuto in scrittura: nessuna COUNT ad ogni pagina
+            unread_count = current_user.unread_notifications or 0
             
         return dict(
             now=datetime.utcnow(), today_minus_1day=datetime.utcnow() - timedelta(days=1),
@@ -1,126 +1,152 @@
 # app/api/routes.py
 
-from flask import Blueprint, jsonify, request, url_for
+from flask import Blueprint, current_app, jsonify, request, url_for
 from flask_login import current_user, login_required
-from app.models import Route, Challenge, Activity, User, RouteRecord, ActivityLike, Notification
+from app.models import Route, Challenge, Activity, User, ActivityLike, Notification, Job
 from app import db
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, undefer
 from sqlalchemy import func
-from math import cos as math_cos, radians as math_radians
-import json
-from shapely.geometry import LineString, box, Point # Importa anche Point per il controllo
+from math import cos as math_cos, isfinite as math_isfinite, radians as math_radians
+import time
 from datetime import datetime
+from app.spatial import get_route_index, routes_intersecting, route_geometry_cache, route_ids_intersecting
+from app.simplify import requested_tolerance, with_coordinates
+from app.polyline import requested_precision
+from app.map_cache import GLOBAL_CELL, cache_area, level_tolerance, map_data_cache
+from app.follow_graph import follow_graph_cache
+from app.tiles import FORMATS, FORMAT_ALIASES, get_tile, is_valid_tile, tile_cache
+from app.main.leaderboards import get_leaderboard_page, get_route_leaderboards, get_user_standing
+from app.main.services import load_engagement, bump_counter
 
 
 
 api = Blueprint('api', __name__)
 
+# /api/routes/nearby: numero di percorsi restituiti (k) di default e massimo
+NEARBY_DEFAULT_K = 10
+NEARBY_MAX_K = 50
+
 @api.route('/map_data')
 def get_map_data():
     lat = request.args.get('lat', type=float)
     lon = request.args.get('lon', type=float)
     radius_km = request.args.get('radius_km', 20, type=float)
     activity_type = request.args.get('activity_type', 'all', type=str)
-
+    # Con 'zoom' o 'tolerance' (metri) i percorsi vengono restituiti al livello di dettaglio adatto
+    tolerance = level_tolerance(requested_tolerance(request.args, lat))
+    # Con 'format=polyline' (e 'precision') le geometrie viaggiano come Encoded Polyline
+    try:
+        polyline_precision = requested_precision(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # La parte indipendente dall'utente è in cache per cella geohash (app/map_cache.py)
+    area = cache_area(lat, lon, radius_km)
+    if area is None:
+        data, _, _ = _build_map_data(lat, lon, radius_km, activity_type, tolerance, polyline_precision)
+    elif area[0] == GLOBAL_CELL:
+        cache_key = (GLOBAL_CELL, None, activity_type, tolerance, polyline_precision)
+        data = map_data_cache.get(cache_key)
+        if data is None:
+            started = time.perf_counter()
+            data, bounds, route_ids = _build_map_data(None, None, radius_km, activity_type, tolerance, polyline_precision)
+            map_data_cache.put(cache_key, data, bounds, route_ids, time.perf_counter() - started)
+    else:
+        # In cache ci sono i percorsi serializzati di tutta la cella: la risposta
+        # tiene solo quelli del riquadro richiesto e calcola su questi sfide,
+        # attività recenti e classifiche locali.
+        cell, bucket_km, cell_lat, cell_lon, cell_radius_km = area
+        cache_key = (cell, bucket_km, activity_type, tolerance, polyline_precision)
+        cell_routes = map_data_cache.get(cache_key)
+        if cell_routes is None:
+            started = time.perf_counter()
+            routes, bounds = _query_map_routes(cell_lat, cell_lon, cell_radius_km, activity_type, tolerance)
+            cell_routes = {
+                'routes': _serialize_map_routes(routes, tolerance, polyline_precision),
+                'bounds': {route.id: (route.min_lon, route.min_lat, route.max_lon, route.max_lat) for route in routes},
+            }
+            map_data_cache.put(cache_key, cell_routes, bounds, cell_routes['bounds'], time.perf_counter() - started)
+        route_ids = route_ids_intersecting(cell_routes['bounds'], *_map_query_bounds(lat, lon, radius_km))
+        data = _map_area_data([route for route in cell_routes['routes'] if route['id'] in route_ids],
+                              route_ids, activity_type)
+
+    return jsonify(_with_viewer_engagement(data))
+
+
+def _with_viewer_engagement(data):
+    """
+    Copia della risposta della mappa con i dati del singolo utente: contatori
+    dei like aggiornati e `user_has_liked`, per le sole attività recenti.
+    """
+    activity_ids = [a['id'] for a in data['recent_activities']]
+    like_counts = {}
+    if activity_ids:
+        like_counts = dict(db.session.query(Activity.id, Activity.like_count).filter(
+            Activity.id.in_(activity_ids)
+        ).all())
+    # Like e "mi piace" dell'utente per tutte le attività in una sola query
+    activity_engagement = load_engagement(activity_ids=activity_ids, viewer=current_user)['activities']
+    recent_activities = [
+        dict(a, like_count=like_counts.get(a['id'], a['like_count']), user_has_liked=a['id'] in activity_engagement)
+        for a in data['recent_activities']
+    ]
+    return dict(data, recent_activities=recent_activities)
+
+
+def _build_map_data(lat, lon, radius_km, activity_type, tolerance, polyline_precision):
+    """
+    Parte di /api/map_data indipendente dall'utente. Ritorna (dati, bounding box
+    interrogato o None senza lat/lon, id dei percorsi dell'area).
+    """
+    routes, query_bounds = _query_map_routes(lat, lon, radius_km, activity_type, tolerance)
+    route_ids_in_area = {route.id for route in routes}
+    data = _map_area_data(
+        _serialize_map_routes(routes, tolerance, polyline_precision), route_ids_in_area,
+        activity_type, in_area=query_bounds is not None
+    )
+    return data, query_bounds, route_ids_in_area
+
+
+def _map_query_bounds(lat, lon, radius_km):
+    """Riquadro (min_lon, min_lat, max_lon, max_lat) di lato 2·radius_km centrato in lat/lon."""
+    delta_lat = radius_km / 111.0
+    delta_lon = radius_km / (111.0 * abs(math_cos(math_radians(lat)))) if lat != 0 else radius_km / 111.0 
+    return lon - delta_lon, lat - delta_lat, lon + delta_lon, lat + delta_lat
+
+
+def _query_map_routes(lat, lon, radius_km, activity_type, tolerance):
+    """Percorsi della mappa e bounding box interrogato (None senza lat/lon: i primi 10)."""
     all_routes_query = Route.query.options(joinedload(Route.creator))
-    all_challenges_query = Challenge.query.options(
-        joinedload(Challenge.challenger),
-        joinedload(Challenge.route_info)
-    ).order_by(Challenge.created_at.desc())
-    all_activities_query = Activity.query.options(
-        joinedload(Activity.user_activity),
-        joinedload(Activity.route_activity),
-        joinedload(Activity.challenge)
-    ).order_by(Activity.created_at.desc())
-    
+    if tolerance is not None:
+        all_routes_query = all_routes_query.options(undefer(Route.coordinates_lod))
     if activity_type != 'all':
         all_routes_query = all_routes_query.filter(Route.activity_type == activity_type)
-        all_activities_query = all_activities_query.filter(Activity.activity_type == activity_type)
-        all_challenges_query = all_challenges_query.join(Route).filter(Route.activity_type == activity_type)
 
-    all_routes_from_db = all_routes_query.all()
-    all_challenges_from_db = all_challenges_query.all()
-    all_activities_from_db = all_activities_query.all()
+    if lat is None or lon is None:
+        return all_routes_query.limit(10).all(), None
 
-    query_routes_to_serialize = []
-    query_challenges_to_serialize = []
-    query_activities_to_serialize = []
+    query_bounds = _map_query_bounds(lat, lon, radius_km)
+    min_lon, min_lat, max_lon, max_lat = query_bounds
 
-    route_ids_in_area = set()
-
-    if lat is None or lon is None:
-        query_routes_to_serialize = all_routes_from_db[:10]
-        query_challenges_to_serialize = all_challenges_from_db[:3]
-        query_activities_to_serialize = all_activities_from_db[:10]
-        route_ids_in_area = {r.id for r in query_routes_to_serialize}
-    else:
-        delta_lat = radius_km / 111.0
-        delta_lon = radius_km / (111.0 * abs(math_cos(math_radians(lat)))) if lat != 0 else radius_km / 111.0 
-        min_lat, max_lat = lat - delta_lat, lat + delta_lat
-        min_lon, max_lon = lon - delta_lon, lon + delta_lon
-        
-        bbox_polygon_shapely = box(min_lon, min_lat, max_lon, max_lat) # Definisci una volta
-
-        for route in all_routes_from_db:
-            processed_geojson = None # Variabile per memorizzare il GeoJSON in formato standard
-            if route.coordinates:
-                try:
-                    loaded_coords = json.loads(route.coordinates)
-                    
-                    if isinstance(loaded_coords, dict) and 'geometry' in loaded_coords and 'coordinates' in loaded_coords['geometry']:
-                        # Caso 1: È un oggetto GeoJSON Feature completo
-                        processed_geojson = loaded_coords
-                    elif isinstance(loaded_coords, dict) and 'type' in loaded_coords and loaded_coords['type'] == 'LineString' and 'coordinates' in loaded_coords:
-                        # Caso 2: È un oggetto GeoJSON LineString diretto
-                        processed_geojson = {"type": "Feature", "geometry": loaded_coords, "properties": {}}
-                    elif isinstance(loaded_coords, list) and all(isinstance(coord, list) and len(coord) >= 2 for coord in loaded_coords):
-                        # Caso 3: È un semplice array di [lon, lat] o [lon, lat, alt]
-                        processed_geojson = {
-                            "type": "Feature",
-                            "geometry": {
-                                "type": "LineString",
-                                "coordinates": loaded_coords
-                            },
-                            "properties": {}
-                        }
-                    # else: Formato non riconosciuto, processed_geojson rimane None
-                except json.JSONDecodeError:
-                    print(f"Warning: Errore di decodifica JSON per la rotta {route.id}. Coordinates: {route.coordinates[:100]}...")
-            
-            # Se abbiamo un GeoJSON valido e processato, controlliamo l'intersezione
-            if processed_geojson and 'geometry' in processed_geojson and 'coordinates' in processed_geojson['geometry']:
-                geo_type = processed_geojson['geometry']['type']
-                geo_coords = processed_geojson['geometry']['coordinates']
-
-                shapely_geometry = None
-                if geo_type == 'LineString':
-                    shapely_geometry = LineString(geo_coords)
-                elif geo_type == 'Point' and geo_coords: # Se una rotta fosse un singolo punto (improbabile ma possibile)
-                    shapely_geometry = Point(geo_coords)
-                # Aggiungi altri tipi di geometria GeoJSON se necessario (Polygon, etc.)
-
-                if shapely_geometry and shapely_geometry.intersects(bbox_polygon_shapely):
-                    query_routes_to_serialize.append(route) # Aggiungi l'intera rotta per la serializzazione
-                    route_ids_in_area.add(route.id) # Aggiungi l'ID per filtrare sfide/attività
-        
-        # Filtra sfide e attività basandosi sugli ID delle rotte nell'area
-        query_challenges_to_serialize = [c for c in all_challenges_from_db if c.route_id in route_ids_in_area]
-        query_activities_to_serialize = [a for a in all_activities_from_db if a.route_id in route_ids_in_area]
-        
-        # Applica i limiti se necessario (già fatto sopra)
-        query_challenges_to_serialize = query_challenges_to_serialize[:3]
-        query_activities_to_serialize = query_activities_to_serialize[:10]
+    # Prefiltro con range query indicizzata sul bounding box salvato,
+    # poi verifica esatta sulle geometrie tenute in memoria dall'indice spaziale.
+    candidate_routes = all_routes_query.filter(
+        Route.bbox_intersects(min_lat, max_lat, min_lon, max_lon)
+    ).all()
+    return routes_intersecting(candidate_routes, min_lon, min_lat, max_lon, max_lat), query_bounds
 
 
+def _serialize_map_routes(query_routes_to_serialize, tolerance, polyline_precision):
+    """Percorsi della mappa come dict, con record e top 5 di ciascuno."""
     serializable_routes_for_api = []
-    serializable_featured_routes_for_api = []
     
+    # Record e top 5 (miglior tempo di ciascun utente, dalla classifica
+    # materializzata) di tutti i percorsi dell'area in due query a finestra:
+    # nel ciclo restano solo lookup su dizionario.
+    leaderboards = get_route_leaderboards([route.id for route in query_routes_to_serialize], limit=5)
+
     for route in query_routes_to_serialize:
-        # Recupera il record holder e le top 5 attività (la logica rimane simile)
-        route_record = RouteRecord.query.options(
-            joinedload(RouteRecord.record_holder),
-            joinedload(RouteRecord.activity)
-        ).filter_by(route_id=route.id).order_by(RouteRecord.duration.asc()).first()
+        route_record = leaderboards[route.id].record
 
         king_queen_data = None
         if route_record and route_record.record_holder and route_record.activity:
@@ -133,9 +159,7 @@ def get_map_data():
                 'created_at': route_record.created_at.strftime('%Y-%m-%d %H:%M:%S')
             }
         
-        top_5_activities = Activity.query.options(
-            joinedload(Activity.user_activity)
-        ).filter_by(route_id=route.id).order_by(Activity.duration.asc()).limit(5).all()
+        top_5_activities = leaderboards[route.id].top
 
         top_5_activities_data = []
         for activity in top_5_activities:
@@ -156,32 +180,23 @@ def get_map_data():
 
         # Anche qui, assicurati che le coordinate siano sempre un oggetto GeoJSON ben formato per la risposta
         # altrimenti potrebbero esserci problemi nel frontend con le mappe
-        final_coordinates_for_api = None
-        if route.coordinates:
-             try:
-                 loaded_coords_for_api = json.loads(route.coordinates)
-                 if isinstance(loaded_coords_for_api, dict) and 'geometry' in loaded_coords_for_api:
-                     final_coordinates_for_api = loaded_coords_for_api # Già un Feature
-                 elif isinstance(loaded_coords_for_api, dict) and 'type' in loaded_coords_for_api and loaded_coords_for_api['type'] == 'LineString':
-                     final_coordinates_for_api = {"type": "Feature", "geometry": loaded_coords_for_api, "properties": {}}
-                 elif isinstance(loaded_coords_for_api, list):
-                     final_coordinates_for_api = {
-                         "type": "Feature",
-                         "geometry": {
-                             "type": "LineString",
-                             "coordinates": loaded_coords_for_api
-                         },
-                         "properties": {}
-                     }
-             except json.JSONDecodeError:
-                 print(f"Warning: Errore di decodifica JSON durante la serializzazione per rotta {route.id}.")
-
+        if polyline_precision is None:
+            final_coordinates_for_api = route_geometry_cache.feature(route)
+            if route.coordinates and final_coordinates_for_api is None:
+                print(f"Warning: Errore di decodifica JSON durante la serializzazione per rotta {route.id}.")
+            final_coordinates_for_api = with_coordinates(final_coordinates_for_api, route.coordinates_for_tolerance(tolerance))
+            geometry_data = {'coordinates': final_coordinates_for_api}  # <-- USA IL PROCESSED GEOJSON QUI
+        else:
+            geometry_data = {
+                'polyline': route_geometry_cache.polyline(route, polyline_precision, tolerance),
+                'polyline_precision': polyline_precision
+            }
 
         route_data = {
             'id': route.id,
             'name': route.name,
             'description': route.description,
-            'coordinates': final_coordinates_for_api, # <-- USA IL PROCESSED GEOJSON QUI
+            **geometry_data,
             'created_at': route.created_at.strftime('%Y-%m-%d %H:%M:%S'),
             'created_by_id': creator_id,
             'created_by_username': creator_username,
@@ -196,8 +211,43 @@ def get_map_data():
 
         serializable_routes_for_api.append(route_data)
 
-        if route.is_featured:
-            serializable_featured_routes_for_api.append(route_data)
+    return serializable_routes_for_api
+
+
+def _map_area_data(serializable_routes_for_api, route_ids_in_area, activity_type, in_area=True):
+    """
+    Risposta di /api/map_data per i percorsi già serializzati: sfide, attività
+    recenti e classifiche locali dei soli `route_ids_in_area` (con
+    in_area=False, cioè senza lat/lon, le ultime sfide e attività ovunque).
+    """
+    all_challenges_query = Challenge.query.options(
+        joinedload(Challenge.challenger),
+        joinedload(Challenge.route_info)
+    ).order_by(Challenge.created_at.desc())
+    all_activities_query = Activity.query.options(
+        joinedload(Activity.user_activity),
+        joinedload(Activity.route_activity),
+        joinedload(Activity.challenge)
+    ).order_by(Activity.created_at.desc())
+
+    if activity_type != 'all':
+        all_activities_query = all_activities_query.filter(Activity.activity_type == activity_type)
+        all_challenges_query = all_challenges_query.join(Route).filter(Route.activity_type == activity_type)
+
+    query_challenges_to_serialize = []
+    query_activities_to_serialize = []
+
+    if not in_area:
+        query_challenges_to_serialize = all_challenges_query.limit(3).all()
+        query_activities_to_serialize = all_activities_query.limit(10).all()
+    elif route_ids_in_area:
+        # Filtra sfide e attività basandosi sugli ID delle rotte nell'area
+        query_challenges_to_serialize = all_challenges_query.filter(
+            Challenge.route_id.in_(route_ids_in_area)
+        ).limit(3).all()
+        query_activities_to_serialize = all_activities_query.filter(
+            Activity.route_id.in_(route_ids_in_area)
+        ).limit(10).all()
 
     serializable_challenges_for_api = []
     for challenge in sorted(query_challenges_to_serialize, key=lambda c: c.created_at, reverse=True):
@@ -217,17 +267,6 @@ def get_map_data():
     serializable_activities_for_api = []
     for activity in query_activities_to_serialize:
         if activity.user_activity and activity.route_activity:
-            
-            # --- NUOVA LOGICA PER I LIKE ---
-            like_count = activity.likes.count()
-            user_has_liked = False
-            # Verifica se l'utente corrente è autenticato prima di accedere a current_user.id
-            if current_user.is_authenticated:
-                # Controlla se esiste un like di questo utente per questa attività
-                if activity.likes.filter(ActivityLike.user_id == current_user.id).first():
-                    user_has_liked = True
-            # --- FINE NUOVA LOGICA ---
-
             serializable_activities_for_api.append({
                 'id': activity.id,
                 'user_id': activity.user_id,
@@ -242,8 +281,8 @@ def get_map_data():
                 'avg_speed': activity.avg_speed,
                 'created_at': activity.created_at.strftime('%Y-%m-%d %H:%M:%S'),
                  # --- NUOVI DATI AGGIUNTI AL JSON ---
-                'like_count': like_count,
-                'user_has_liked': user_has_liked
+                'like_count': activity.like_count,
+                'user_has_liked': False     # impostato per utente da _with_viewer_engagement
             })
 
     # >>> INIZIO NUOVA SEZIONE: CLASSIFICHE LOCALI <<<
@@ -281,16 +320,16 @@ def get_map_data():
     # >>> FINE NUOVA SEZIONE <<<
 
 
-    return jsonify({
+    return {
         "routes": serializable_routes_for_api,
         "challenges": serializable_challenges_for_api,
         "recent_activities": serializable_activities_for_api,
-        "featured_routes": serializable_featured_routes_for_api,
+        "featured_routes": [route for route in serializable_routes_for_api if route['is_featured']],
         "local_leaderboards": {
             "distance": local_top_distance,
             "creators": local_top_creators
         }
-    })
+    }
 
 
 # In app/api/routes.py, dopo la funzione get_map_data
@@ -305,11 +344,13 @@ def toggle_activity_like(activity_id):
         # L'utente sta togliendo il like, quindi potremmo voler cancellare la notifica
         # Per semplicità, per ora non facciamo nulla in caso di "unlike"
         db.session.delete(like)
+        bump_counter(Activity, activity.id, 'like_count', -1)
         action = 'unliked'
     else:
         # L'utente sta mettendo il like, creiamo la notifica
         new_like = ActivityLike(user_id=current_user.id, activity_id=activity.id)
         db.session.add(new_like)
+        bump_counter(Activity, activity.id, 'like_count', 1)
         action = 'liked'
         
         # --- NUOVA LOGICA NOTIFICHE ---
@@ -331,7 +372,7 @@ def toggle_activity_like(activity_id):
     return jsonify({
         'status': 'success',
         'action': action,
-        'new_like_count': activity.likes.count()
+        'new_like_count': activity.like_count
     })
 
 
@@ -339,9 +380,6 @@ def toggle_activity_like(activity_id):
 @api.route('/classic-routes/<city>')
 def get_classic_routes(city):
     """Restituisce i percorsi classici per una città specifica, con top 5 tempi opzionali"""
-    from app.models import Route, RouteRecord, Activity
-    from sqlalchemy import func
-
     include_top_times = request.args.get('include_top_times', 'false').lower() == 'true'
 
     # Recupera tutte le route classiche della città, case-insensitive
@@ -350,10 +388,15 @@ def get_classic_routes(city):
         Route.classic_city.ilike(f"%{city}%")
     ).order_by(Route.name).all()
 
+    # Tentativi, record e top 5 (miglior tempo per utente) di tutti i percorsi in due query
+    leaderboards = get_route_leaderboards(
+        [route.id for route in classic_routes], limit=5 if include_top_times else 0
+    )
+
     routes_data = []
     for route in classic_routes:
-        # Recupera il record holder (il migliore) per la route
-        record = RouteRecord.query.filter_by(route_id=route.id).order_by(RouteRecord.duration.asc()).first()
+        leaderboard = leaderboards[route.id]
+        record = leaderboard.record
 
         route_data = {
             'id': route.id,
@@ -368,7 +411,7 @@ def get_classic_routes(city):
             'estimated_time': route.estimated_time,
             'landmarks': route.landmarks,
             'featured_image': route.featured_image,
-            'total_activities': route.activities.count(),
+            'total_activities': leaderboard.attempts,
             'record_holder': None,
             'top_5_times': []
         }
@@ -381,12 +424,8 @@ def get_classic_routes(city):
 
         # --- LOGICA TOP 5 TEMPI ---
         if include_top_times:
-            top_5_activities = Activity.query.options(
-                joinedload(Activity.user_activity)
-            ).filter_by(route_id=route.id).order_by(Activity.duration.asc()).limit(5).all()
-
             top_5_activities_data = []
-            for activity in top_5_activities:
+            for activity in leaderboard.top:
                 if activity.user_activity:
                     top_5_activities_data.append({
                         'username': activity.user_activity.username,
@@ -432,4 +471,171 @@ def my_friends():
         print(f"Errore nel caricamento amici: {e}")
         # In produzione, non stampare l'errore completo in console se contiene dati sensibili
         # return jsonify({'error': 'Errore interno del server'}), 500
-        return jsonify({'error': str(e)}), 500 # Per debug, restituisci l'errore
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500 # Per debug, restituisci l'errore
+
+@api.route('/routes/nearby')
+def nearby_routes():
+    """
+    I `k` percorsi più vicini a lat/lon per distanza reale (in metri) dal punto
+    più vicino della linea (`measure=line`, default) o dalla partenza
+    (`measure=start`), opzionalmente filtrati per activity_type ed entro
+    max_distance_km. Usa l'indice spaziale in memoria (app/spatial.py).
+    """
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None or not (math_isfinite(lat) and math_isfinite(lon)) \
+            or abs(lat) > 90 or abs(lon) > 180:
+        return jsonify({'error': 'Parametri lat e lon obbligatori e validi.'}), 400
+    k = min(max(request.args.get('k', NEARBY_DEFAULT_K, type=int), 1), NEARBY_MAX_K)
+    activity_type = request.args.get('activity_type', 'all', type=str)
+    measure = request.args.get('measure', 'line', type=str)
+    max_distance_km = request.args.get('max_distance_km', type=float)
+    max_distance_m = max_distance_km * 1000 if max_distance_km is not None and max_distance_km > 0 else None
+
+    try:
+        nearest = get_route_index().nearest(
+            lon, lat, k=k,
+            activity_type=None if activity_type == 'all' else activity_type,
+            measure=measure, max_distance_m=max_distance_m
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    routes_by_id = {}
+    if nearest:
+        routes_by_id = {route.id: route for route in Route.query.options(joinedload(Route.creator)).filter(
+            Route.id.in_([route_id for route_id, _ in nearest])
+        )}
+
+    routes_data = []
+    for route_id, distance_m in nearest:
+        route = routes_by_id.get(route_id)
+        if route is None:   # eliminato da un altro worker, l'indice si riallinea alla ricostruzione
+            continue
+        routes_data.append({
+            'id': route.id,
+            'name': route.name,
+            'description': route.description,
+            'activity_type': route.activity_type,
+            'distance_km': route.distance_km,
+            'start_location': route.start_location,
+            'classic_city': route.classic_city,
+            'is_featured': route.is_featured,
+            'featured_image': route.featured_image,
+            'created_by_id': route.created_by,
+            'created_by_username': route.creator.username if route.creator else "Sconosciuto",
+            'distance_m': round(distance_m, 1)
+        })
+
+    return jsonify({'lat': lat, 'lon': lon, 'measure': measure, 'routes': routes_data})
+
+
+@api.route('/routes/<int:route_id>/leaderboard')
+def route_leaderboard(route_id):
+    """
+    Classifica materializzata del percorso per tipo di attività (default: quello
+    del percorso), paginata con limit/offset, più la posizione dell'utente loggato.
+    """
+    route = Route.query.get_or_404(route_id)
+    activity_type = request.args.get('activity_type', route.activity_type, type=str)
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    entries = get_leaderboard_page(route.id, activity_type, limit=limit, offset=offset)
+    standing = get_user_standing(route.id, activity_type, current_user.id) if current_user.is_authenticated else None
+
+    def entry_data(entry, position):
+        return {
+            'position': position,
+            'user_id': entry.user_id,
+            'username': entry.user.username if entry.user else None,
+            'profile_image': entry.user.profile_image if entry.user else None,
+            'activity_id': entry.activity_id,
+            'duration': entry.duration,
+            'attempts': entry.attempts,
+            'created_at': entry.activity.created_at.strftime('%Y-%m-%d %H:%M:%S') if entry.activity and entry.activity.created_at else None
+        }
+
+    return jsonify({
+        'route_id': route.id,
+        'activity_type': activity_type,
+        'offset': offset,
+        'entries': [entry_data(entry, offset + i + 1) for i, entry in enumerate(entries)],
+        'me': entry_data(standing['entry'], standing['position']) | {'total': standing['total']} if standing else None
+    })
+
+
+@api.route('/routes/<int:route_id>/geometry')
+def route_geometry(route_id):
+    """
+    Sola geometria di un percorso, per le mappe che la caricano a parte.
+    Parametri: format=geojson|polyline, precision (polyline), zoom o tolerance.
+    """
+    route = Route.query.options(undefer(Route.coordinates_lod)).filter_by(id=route_id).first()
+    if route is None:
+        return jsonify({'error': 'Percorso non trovato.'}), 404
+    try:
+        polyline_precision = requested_precision(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    tolerance = requested_tolerance(request.args, route.centroid_lat)
+
+    data = {'id': route.id, 'tolerance': tolerance}
+    if polyline_precision is None:
+        data['format'] = 'geojson'
+        data['coordinates'] = with_coordinates(route_geometry_cache.feature(route), route.coordinates_for_tolerance(tolerance))
+    else:
+        data['format'] = 'polyline'
+        data['polyline'] = route_geometry_cache.polyline(route, polyline_precision, tolerance)
+        data['precision'] = polyline_precision
+    return jsonify(data)
+
+
+@api.route('/tiles/<int:z>/<int:x>/<int:y>')
+@api.route('/tiles/<int:z>/<int:x>/<int:y>.<ext>')
+def route_tile(z, x, y, ext=None):
+    """
+    Tile vettoriale XYZ con i percorsi, ritagliati e semplificati per lo zoom.
+    Formato dall'estensione (.geojson/.mvt/.pbf) o dal parametro 'format'.
+    """
+    tile_format = (ext or request.args.get('format') or 'geojson').lower()
+    tile_format = FORMAT_ALIASES.get(tile_format, tile_format)
+    if tile_format not in FORMATS:
+        return jsonify({'error': f"Formato tile non supportato: {tile_format} (usa 'geojson' o 'mvt')."}), 400
+    if not is_valid_tile(z, x, y):
+        return jsonify({'error': 'Tile non valida.'}), 404
+
+    body, etag = get_tile(z, x, y, tile_format)
+    response = current_app.response_class(body, mimetype=FORMATS[tile_format])
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get('TILE_CACHE_MAX_AGE', 300)
+    return response.make_conditional(request)
+
+
+@api.route('/cache/stats')
+@login_required
+def cache_stats():
+    """Statistiche delle cache in-process del worker corrente (solo amministratori)."""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Accesso riservato agli amministratori.'}), 403
+    return jsonify({
+        'route_geometry': route_geometry_cache.stats(),
+        'tiles': tile_cache.stats(),
+        'map_data': map_data_cache.stats(),
+        'follow_graph': follow_graph_cache.stats()
+    })
+
+
+@api.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    """Stato, avanzamento ed esito di un lavoro in background."""
+    job = db.session.get(Job, job_id)
+    if job is None or (job.user_id != current_user.id and not current_user.is_admin):
+        return jsonify({'error': 'Elaborazione non trovata.'}), 404
+
+    data = job.to_dict()
+    if job.status == 'succeeded' and job.result and job.result.get('activity_id'):
+        data['activity_url'] = url_for('main.activity_detail', activity_id=job.result['activity_id'])
+    return jsonify(data)
@@ -0,0 +1,210 @@
+# app/follow_graph.py
+"""
+Grafo dei follow in cache: per ogni utente l'insieme degli id seguiti e
+quello degli id dei follower, letti con una query sola e poi riusati.
+
+`is_following` diventa un controllo di appartenenza su un frozenset e
+`following_among` risponde a "quali di questi utenti seguo?" per una pagina
+intera senza query aggiuntive. La cache è una LRU con TTL per worker
+(FOLLOW_GRAPH_CACHE_SIZE voci, FOLLOW_GRAPH_CACHE_TTL secondi): follow e
+unfollow invalidano le voci dei due utenti dopo il commit, negli altri worker
+la voce resta valida al più per il TTL. Per questo le scritture
+(User.follow/unfollow) controllano comunque il database.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session, object_session
+
+from app import db
+from app.models import User, followers
+
+
+FOLLOWED = 'followed'      # id degli utenti seguiti da user_id
+FOLLOWERS = 'followers'    # id degli utenti che seguono user_id
+
+
+class FollowGraphCache:
+    """Cache LRU con TTL di (verso, user_id) -> frozenset di id utente."""
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()   # (verso, user_id) -> (scadenza, frozenset)
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _configure(self):
+        if has_app_context():
+            self.maxsize = current_app.config.get('FOLLOW_GRAPH_CACHE_SIZE', self.maxsize)
+            self.ttl = current_app.config.get('FOLLOW_GRAPH_CACHE_TTL', self.ttl)
+
+    def get(self, key):
+        """Insieme in cache per la chiave, None se assente o scaduto."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, ids):
+        self._configure()
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, ids)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        """Elimina le chiavi indicate; ritorna quante erano in cache."""
+        removed = 0
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    removed += 1
+            self.invalidations += removed
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+follow_graph_cache = FollowGraphCache()
+
+
+# =====================================================================
+# LETTURA
+# =====================================================================
+
+def _load(direction, user_id):
+    key = (direction, user_id)
+    ids = follow_graph_cache.get(key)
+    if ids is None:
+        if direction == FOLLOWED:
+            query = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == user_id)
+        else:
+            query = db.session.query(followers.c.follower_id).filter(followers.c.followed_id == user_id)
+        ids = frozenset(other_id for (other_id,) in query)
+        follow_graph_cache.put(key, ids)
+    return ids
+
+
+def followed_ids(user_id):
+    """Id degli utenti seguiti da `user_id` (frozenset, da non modificare)."""
+    return _load(FOLLOWED, user_id)
+
+
+def follower_ids(user_id):
+    """Id dei follower di `user_id` (frozenset, da non modificare)."""
+    return _load(FOLLOWERS, user_id)
+
+
+def is_following(follower_id, followed_id):
+    """True se `follower_id` segue `followed_id`."""
+    return followed_id in followed_ids(follower_id)
+
+
+def following_among(user_id, candidate_ids):
+    """Sottoinsieme di `candidate_ids` seguito da `user_id` (una query al massimo)."""
+    return followed_ids(user_id).intersection(candidate_ids)
+
+
+def follow_counts(user_ids):
+    """
+    {user_id: {'followers': n, 'followed': n}} per più utenti: le dimensioni
+    degli insiemi già in cache, due COUNT raggruppati per gli altri.
+    """
+    user_ids = set(user_ids)
+    counts = {user_id: {FOLLOWERS: 0, FOLLOWED: 0} for user_id in user_ids}
+    for direction, own_column, other_column in ((FOLLOWERS, followers.c.followed_id, followers.c.follower_id),
+                                                (FOLLOWED, followers.c.follower_id, followers.c.followed_id)):
+        missing = set()
+        for user_id in user_ids:
+            ids = follow_graph_cache.get((direction, user_id))
+            if ids is None:
+                missing.add(user_id)
+            else:
+                counts[user_id][direction] = len(ids)
+        if missing:
+            rows = db.session.query(own_column, func.count(other_column)).filter(
+                own_column.in_(missing)
+            ).group_by(own_column)
+            for user_id, count in rows:
+                counts[user_id][direction] = count
+    return counts
+
+
+# =====================================================================
+# INVALIDAZIONE DOPO LE SCRITTURE
+# =====================================================================
+
+def _dirty(session):
+    return session.info.setdefault('dirty_follow_graph', set())
+
+
+def _on_follow_changed(target, value, initiator):
+    session = object_session(target)
+    if session is None or value is None:
+        return value
+    _dirty(session).update({(FOLLOWED, target.id), (FOLLOWERS, value.id)})
+    return value
+
+
+def _on_user_deleted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        _dirty(session).update({(FOLLOWED, target.id), (FOLLOWERS, target.id)})
+
+
+def _invalidate_after_commit(session):
+    keys = session.info.pop('dirty_follow_graph', None)
+    if keys:
+        follow_graph_cache.invalidate(keys)
+
+
+def _discard_after_rollback(session, previous_transaction):
+    session.info.pop('dirty_follow_graph', None)
+
+
+event.listen(User.followed, 'append', _on_follow_changed)
+event.listen(User.followed, 'remove', _on_follow_changed)
+event.listen(User, 'after_delete', _on_user_deleted)
+event.listen(Session, 'after_commit', _invalidate_after_commit)
+event.listen(Session, 'after_soft_rollback', _discard_after_rollback)
@@ -0,0 +1,145 @@
+# app/geo.py
+"""
+Calcoli geodetici vettorizzati (NumPy) sulle tracce GPS.
+
+Tutte le statistiche delle attività (distanza, durata, tempo in movimento,
+velocità, passo) passano da qui: ogni funzione lavora su array interi invece
+che punto per punto, quindi anche una traccia da 50.000 punti si elabora in
+pochi millisecondi.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+from app.tracks import to_track
+
+
+EARTH_RADIUS_M = 6371000.0
+
+# Sotto questa velocità (m/s, ~1,8 km/h) un segmento è considerato una pausa
+MOVING_SPEED_THRESHOLD = 0.5
+# Pause tra due punti più lunghe di così (s) non contano mai come movimento
+MAX_MOVING_GAP = 60.0
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Distanza in metri tra coppie di punti (gradi). Accetta scalari o array
+    NumPy della stessa forma e restituisce rispettivamente uno scalare o un array.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def segment_distances(lat, lon):
+    """Lunghezza in metri di ciascun segmento della traccia (n-1 valori)."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if lat.size < 2:
+        return np.zeros(0)
+    return haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+
+def cumulative_distance(lat, lon):
+    """Distanza progressiva in metri da inizio traccia (n valori, il primo è 0)."""
+    lat = np.asarray(lat, dtype=np.float64)
+    if lat.size == 0:
+        return np.zeros(0)
+    return np.concatenate(([0.0], np.cumsum(segment_distances(lat, lon))))
+
+
+def path_length(lat, lon):
+    """Lunghezza totale della traccia in metri."""
+    return float(segment_distances(lat, lon).sum())
+
+
+def speed_series(lat, lon, time):
+    """
+    Velocità in km/h di ciascun segmento (n-1 valori). I segmenti con
+    intervallo di tempo nullo o negativo hanno velocità 0.
+    """
+    distances = segment_distances(lat, lon)
+    if distances.size == 0:
+        return distances
+    dt = np.diff(np.asarray(time, dtype=np.float64))
+    speeds = np.zeros_like(distances)
+    np.divide(distances, dt, out=speeds, where=dt > 0)
+    return speeds * 3.6
+
+
+def moving_time(lat, lon, time, threshold=MOVING_SPEED_THRESHOLD, max_gap=MAX_MOVING_GAP):
+    """
+    Secondi passati in movimento: somma degli intervalli dei segmenti con
+    velocità almeno `threshold` m/s e durata non superiore a `max_gap`.
+    """
+    distances = segment_distances(lat, lon)
+    if distances.size == 0:
+        return 0.0
+    dt = np.diff(np.asarray(time, dtype=np.float64))
+    moving = (dt > 0) & (dt <= max_gap) & (distances >= threshold * dt)
+    return float(dt[moving].sum())
+
+
+def elevation_gain(ele):
+    """Dislivello positivo in metri."""
+    if ele is None:
+        return 0.0
+    ele = np.asarray(ele, dtype=np.float64)
+    if ele.size < 2:
+        return 0.0
+    deltas = np.diff(ele)
+    return float(deltas[deltas > 0].sum())
+
+
+def pace(distance_km, seconds):
+    """Passo in minuti al km, None se la distanza è nulla."""
+    if not distance_km or distance_km <= 0 or not seconds:
+        return None
+    return (seconds / 60.0) / distance_km
+
+
+def average_speed(distance_km, seconds):
+    """Velocità media in km/h."""
+    return (distance_km / seconds) * 3600.0 if seconds and seconds > 0 else 0.0
+
+
+@dataclass
+class TrackStats:
+    distance_km: float = 0.0
+    duration: int = 0             # secondi, dal primo all'ultimo punto
+    moving_time: int = 0          # secondi effettivamente in movimento
+    avg_speed: float = 0.0        # km/h sulla durata totale
+    moving_speed: float = 0.0     # km/h sul tempo in movimento
+    max_speed: float = 0.0        # km/h
+    avg_pace: float = None        # min/km
+    elevation_gain: float = 0.0   # metri
+    points: int = 0
+
+
+def track_stats(gps_track):
+    """
+    Calcola tutte le statistiche di una traccia (Track, binario o JSON legacy).
+    Senza tempi si ottengono solo distanza e dislivello.
+    """
+    track = to_track(gps_track)
+    stats = TrackStats(points=len(track))
+    if len(track) < 2:
+        return stats
+
+    distances = segment_distances(track.lat, track.lon)
+    stats.distance_km = float(distances.sum()) / 1000.0
+    stats.elevation_gain = elevation_gain(track.ele)
+
+    if track.has_time:
+        dt = np.diff(track.time)
+        stats.duration = max(int(track.time[-1] - track.time[0]), 0)
+        moving = (dt > 0) & (dt <= MAX_MOVING_GAP) & (distances >= MOVING_SPEED_THRESHOLD * dt)
+        stats.moving_time = int(dt[moving].sum())
+        stats.avg_speed = average_speed(stats.distance_km, stats.duration)
+        stats.moving_speed = average_speed(stats.distance_km, stats.moving_time)
+        speeds = np.zeros_like(distances)
+        np.divide(distances, dt, out=speeds, where=dt > 0)
+        stats.max_speed = float(speeds.max()) * 3.6
+        stats.avg_pace = pace(stats.distance_km, stats.duration)
+    return stats
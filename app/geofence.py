@@ -0,0 +1,171 @@
+# app/geofence.py
+"""
+Validazione geofencing delle attività rispetto al percorso di riferimento.
+
+Percorso e traccia vengono proiettati in un sistema metrico locale
+(equirettangolare centrato sul percorso), così il buffer ha davvero la
+larghezza richiesta in metri a qualunque latitudine. Il controllo dei punti
+usa `shapely.contains_xy` su una geometria preparata: nessun oggetto Point
+viene creato e l'intera traccia si valida con una sola chiamata vettorizzata.
+"""
+from dataclasses import dataclass, field
+
+import numpy as np
+import shapely
+from shapely.geometry import LineString
+
+from app.geo import EARTH_RADIUS_M
+
+
+DEFAULT_BUFFER_METERS = 50
+DEFAULT_SECTIONS = 10
+# Distanza (m) tra i campioni del percorso usati per la copertura per sezione
+COVERAGE_SAMPLE_STEP = 25.0
+
+
+class LocalProjection:
+    """
+    Proiezione equirettangolare centrata in (lon0, lat0): x/y in metri.
+    Su distanze di qualche decina di km l'errore è trascurabile rispetto
+    all'accuratezza del GPS.
+    """
+
+    def __init__(self, lon0, lat0):
+        self.lon0 = float(lon0)
+        self.lat0 = float(lat0)
+        self._kx = np.radians(1.0) * EARTH_RADIUS_M * np.cos(np.radians(self.lat0))
+        self._ky = np.radians(1.0) * EARTH_RADIUS_M
+
+    @classmethod
+    def for_coordinates(cls, lon, lat):
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        return cls((lon.min() + lon.max()) / 2.0, (lat.min() + lat.max()) / 2.0)
+
+    def forward(self, lon, lat):
+        """Gradi -> metri (array x, y)."""
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        return (lon - self.lon0) * self._kx, (lat - self.lat0) * self._ky
+
+    def inverse(self, x, y):
+        """Metri -> gradi (array lon, lat)."""
+        return np.asarray(x) / self._kx + self.lon0, np.asarray(y) / self._ky + self.lat0
+
+
+@dataclass
+class GeofenceResult:
+    total_points: int = 0
+    points_inside: int = 0
+    match_percentage: float = 0.0
+    # Frazione di ciascuna sezione del percorso (in ordine) toccata dalla traccia
+    section_coverage: list = field(default_factory=list)
+
+    @property
+    def route_coverage(self):
+        if not self.section_coverage:
+            return 0.0
+        return float(np.mean(self.section_coverage))
+
+    @property
+    def weakest_section(self):
+        """(indice, copertura) della sezione meno coperta, None se non ci sono sezioni."""
+        if not self.section_coverage:
+            return None
+        index = int(np.argmin(self.section_coverage))
+        return index, self.section_coverage[index]
+
+    def to_dict(self):
+        return {
+            'total_points': self.total_points,
+            'points_inside': self.points_inside,
+            'match_percentage': round(self.match_percentage, 4),
+            'route_coverage': round(self.route_coverage, 4),
+            'section_coverage': [round(c, 4) for c in self.section_coverage],
+        }
+
+
+class RouteGeofence:
+    """
+    Geofence di un percorso: linea e buffer in metri nella proiezione locale,
+    con il buffer già preparato per i test punto-in-poligono ripetuti.
+    """
+
+    def __init__(self, lon, lat, buffer_meters=DEFAULT_BUFFER_METERS, sections=DEFAULT_SECTIONS):
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        if lon.size < 2:
+            raise ValueError("Il percorso deve avere almeno due punti.")
+        self.buffer_meters = buffer_meters
+        self.sections = sections
+        self.projection = LocalProjection.for_coordinates(lon, lat)
+        x, y = self.projection.forward(lon, lat)
+        self.line = LineString(np.column_stack((x, y)))
+        self.polygon = self.line.buffer(buffer_meters)
+        shapely.prepare(self.polygon)
+
+        # Campioni regolari lungo il percorso (interpolati con NumPy sulla
+        # distanza progressiva dei vertici) per la copertura per sezione
+        vertex_distances = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+        length = float(vertex_distances[-1])
+        n_samples = max(int(length // COVERAGE_SAMPLE_STEP) + 1, sections * 2)
+        sample_distances = np.linspace(0.0, length, n_samples)
+        self._samples = shapely.points(
+            np.interp(sample_distances, vertex_distances, x),
+            np.interp(sample_distances, vertex_distances, y)
+        )
+        if length > 0:
+            self._sample_sections = np.minimum((sample_distances / length * sections).astype(int), sections - 1)
+        else:
+            self._sample_sections = np.zeros(n_samples, dtype=int)
+
+    @classmethod
+    def from_coordinates(cls, coordinates, **kwargs):
+        """Costruisce il geofence da una lista di coordinate GeoJSON [[lon, lat], ...]."""
+        coords = np.asarray([(c[0], c[1]) for c in coordinates], dtype=np.float64)
+        return cls(coords[:, 0], coords[:, 1], **kwargs)
+
+    @property
+    def length_meters(self):
+        return float(self.line.length)
+
+    def validate(self, lon, lat):
+        """
+        Confronta una traccia (array di lon/lat in gradi) con il geofence.
+        Ritorna un GeofenceResult con la percentuale di punti dentro il buffer
+        e la copertura di ciascuna sezione del percorso.
+        """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        result = GeofenceResult(total_points=int(lon.size))
+        if lon.size == 0:
+            result.section_coverage = [0.0] * self.sections
+            return result
+
+        x, y = self.projection.forward(lon, lat)
+        inside = shapely.contains_xy(self.polygon, x, y)
+        result.points_inside = int(np.count_nonzero(inside))
+        result.match_percentage = result.points_inside / result.total_points
+
+        # Un campione del percorso è coperto se c'è un punto della traccia entro il buffer.
+        # I punti fuori dal buffer distano più di buffer_meters dal percorso: non servono.
+        track_points = shapely.points(x[inside], y[inside])
+        if track_points.size == 0:
+            result.section_coverage = [0.0] * self.sections
+            return result
+        tree = shapely.STRtree(track_points)
+        hits = tree.query(self._samples, predicate='dwithin', distance=self.buffer_meters)
+        covered = np.zeros(self._samples.size, dtype=bool)
+        covered[np.unique(hits[0])] = True
+        covered_per_section = np.bincount(self._sample_sections, weights=covered, minlength=self.sections)
+        samples_per_section = np.bincount(self._sample_sections, minlength=self.sections)
+        coverage = np.divide(covered_per_section, samples_per_section,
+                             out=np.zeros(self.sections), where=samples_per_section > 0)
+        result.section_coverage = coverage.tolist()
+        return result
+
+
+def validate_track(route_coordinates, lon, lat, buffer_meters=DEFAULT_BUFFER_METERS, sections=DEFAULT_SECTIONS):
+    """Scorciatoia: costruisce il geofence del percorso e valida la traccia."""
+    geofence = RouteGeofence.from_coordinates(route_coordinates, buffer_meters=buffer_meters, sections=sections)
+    return geofence.validate(lon, lat)
@@ -0,0 +1,293 @@
+# app/gpx_stream.py
+"""
+Lettore in streaming di file GPX e TCX.
+
+Il file viene letto a blocchi dal parser expat della libreria standard (lo
+stesso su cui si basa `ElementTree.iterparse`) con gestori di eventi: non
+viene costruito nessun albero XML né alcun oggetto Element, ogni punto viene
+copiato direttamente in buffer NumPy che crescono per raddoppio. La memoria
+dipende quindi solo dagli array prodotti e non dalla dimensione del file (un
+export di diverse ore da decine di MB non viene mai caricato tutto in memoria).
+Distanza, durata, dislivello e bounding box si calcolano sugli array al
+termine dell'unica lettura del file.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from xml.parsers import expat
+
+import numpy as np
+
+from app.geo import segment_distances
+from app.tracks import Track
+
+
+# Limite di sicurezza: oltre questo numero di punti il file viene rifiutato
+MAX_POINTS = 2_000_000
+
+# I punti di un percorso pianificato (<rte>/<rtept>) si usano solo se il
+# file non contiene nessun <trkpt>
+TRACK_POINT_TAGS = frozenset(('trkpt', 'Trackpoint'))
+ROUTE_POINT_TAG = 'rtept'
+TRACK_SEGMENT_TAGS = frozenset(('trkseg', 'Track'))
+ROUTE_SEGMENT_TAG = 'rte'
+# Tag figli del punto di cui serve il testo -> campo del punto
+POINT_FIELDS = {
+    'ele': 'ele', 'AltitudeMeters': 'ele',
+    'time': 'time', 'Time': 'time',
+    'LatitudeDegrees': 'lat', 'LongitudeDegrees': 'lon',
+}
+NAME_PARENTS = frozenset(('trk', 'rte', 'metadata'))
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class TrackFileError(ValueError):
+    """File GPX/TCX non leggibile o senza punti validi."""
+
+
+def _local_name(tag):
+    # Senza elaborazione dei namespace expat riporta il prefisso (es. "gpxtpx:hr")
+    return tag.rsplit(':', 1)[-1] if ':' in tag else tag
+
+
+def _parse_time(text):
+    """Timestamp ISO 8601 -> epoch in secondi (senza fuso = UTC)."""
+    if text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+    parsed = datetime.fromisoformat(text)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class _GrowableArray:
+    """Array float64 a crescita geometrica (ammortizzata O(1) per append)."""
+
+    __slots__ = ('_data', '_size')
+
+    def __init__(self, capacity=1024):
+        self._data = np.empty(capacity, dtype=np.float64)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, value):
+        if self._size == self._data.size:
+            grown = np.empty(self._data.size * 2, dtype=np.float64)
+            grown[:self._size] = self._data[:self._size]
+            self._data = grown
+        self._data[self._size] = value
+        self._size += 1
+
+    def values(self):
+        return self._data[:self._size].copy()
+
+
+@dataclass
+class ParsedTrackFile:
+    track: Track                # lon/lat, tempi e quote (se presenti in tutti i punti)
+    name: str = None
+    file_format: str = 'gpx'
+    segment_starts: np.ndarray = None   # indici del primo punto di ogni segmento
+    distance_2d_km: float = 0.0
+    distance_3d_km: float = 0.0
+    duration: int = 0           # secondi tra il primo e l'ultimo punto con timestamp
+    # Somma delle durate dei singoli segmenti (come gpxpy get_duration): le pause tra un segmento e l'altro non contano
+    segments_duration: int = 0
+    elevation_gain: float = 0.0
+    elevation_loss: float = 0.0
+    bounds: tuple = None        # (min_lon, min_lat, max_lon, max_lat)
+
+    @property
+    def point_count(self):
+        return len(self.track)
+
+    @property
+    def distance_km(self):
+        """Distanza 3D se il file ha le quote, altrimenti 2D (come gpxpy length_3d/length_2d)."""
+        return self.distance_3d_km or self.distance_2d_km
+
+    def coordinates(self):
+        """Lista [[lon, lat], ...] per GeoJSON."""
+        return self.track.coordinates()
+
+    def to_feature(self):
+        return {
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": self.coordinates()},
+            "properties": {}
+        }
+
+
+class _PointBuffers:
+    """Coordinate, tempi e quote di una sequenza di punti, divisa in segmenti."""
+
+    def __init__(self):
+        self.lon, self.lat = _GrowableArray(), _GrowableArray()
+        self.times, self.ele = _GrowableArray(), _GrowableArray()
+        self.segment_starts = []
+        self.new_segment = True
+
+    def __len__(self):
+        return len(self.lon)
+
+    def store(self, point, max_points):
+        try:
+            p_lat = float(point.get('lat'))
+            p_lon = float(point.get('lon'))
+        except (TypeError, ValueError):
+            return  # es. Trackpoint TCX senza Position
+        if not (-90 <= p_lat <= 90 and -180 <= p_lon <= 180):
+            return
+
+        if self.new_segment:
+            self.segment_starts.append(len(self.lon))
+            self.new_segment = False
+        self.lat.append(p_lat)
+        self.lon.append(p_lon)
+        try:
+            self.times.append(_parse_time(point['time']) if point.get('time') else np.nan)
+        except (TypeError, ValueError, OverflowError):
+            self.times.append(np.nan)
+        try:
+            self.ele.append(float(point['ele']) if point.get('ele') else np.nan)
+        except ValueError:
+            self.ele.append(np.nan)
+        if len(self.lon) > max_points:
+            raise TrackFileError(f"Il file contiene più di {max_points} punti.")
+
+
+class _TrackFileHandler:
+    """Gestori degli eventi expat: accumulano i punti nei buffer NumPy."""
+
+    def __init__(self, max_points):
+        self.max_points = max_points
+        self.track = _PointBuffers()    # <trkpt> GPX e <Trackpoint> TCX
+        self.route = _PointBuffers()    # <rtept> GPX
+        self.name = None
+        self.file_format = None
+        self._stack = []
+        self._target = None     # buffer del punto corrente
+        self._point = None      # campi del punto corrente
+        self._field = None      # campo di cui si sta leggendo il testo
+        self._text = []
+
+    def start(self, tag, attrs):
+        tag = _local_name(tag)
+        if self.file_format is None:
+            if tag == 'gpx':
+                self.file_format = 'gpx'
+            elif tag == 'TrainingCenterDatabase':
+                self.file_format = 'tcx'
+            else:
+                raise TrackFileError("Il file non è un GPX o un TCX.")
+
+        if self._point is not None:
+            self._field = POINT_FIELDS.get(tag)
+            self._text = []
+        elif tag in TRACK_POINT_TAGS or tag == ROUTE_POINT_TAG:
+            # Nel TCX lat/lon arrivano dai figli LatitudeDegrees/LongitudeDegrees
+            self._point = {'lat': attrs.get('lat'), 'lon': attrs.get('lon')}
+            self._target = self.route if tag == ROUTE_POINT_TAG else self.track
+        elif tag in TRACK_SEGMENT_TAGS:
+            self.track.new_segment = True
+        elif tag == ROUTE_SEGMENT_TAG:
+            self.route.new_segment = True
+        elif tag == 'name' and self.name is None and self._stack and self._stack[-1] in NAME_PARENTS:
+            self._field = 'name'
+            self._text = []
+        self._stack.append(tag)
+
+    def end(self, tag):
+        self._stack.pop()
+        if self._field is not None:
+            text = ''.join(self._text).strip()
+            if self._field == 'name':
+                self.name = text or None
+            elif self._point is not None:
+                self._point[self._field] = text
+            self._field = None
+            return
+        tag = _local_name(tag)
+        if self._point is not None and (tag in TRACK_POINT_TAGS or tag == ROUTE_POINT_TAG):
+            self._target.store(self._point, self.max_points)
+            self._point = None
+            self._target = None
+
+    def characters(self, data):
+        if self._field is not None:
+            self._text.append(data)
+
+
+def read_track_file(stream, max_points=MAX_POINTS):
+    """
+    Legge un file GPX o TCX (file-like binario) in streaming.
+    Solleva TrackFileError se il file non è valido o non contiene punti.
+    """
+    handler = _TrackFileHandler(max_points)
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.characters
+
+    try:
+        while True:
+            chunk = stream.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.Parse(chunk, False)
+        parser.Parse(b'', True)
+    except expat.ExpatError as e:
+        raise TrackFileError(f"XML non valido: {e}")
+
+    points = handler.track if len(handler.track) else handler.route
+    if not len(points):
+        raise TrackFileError("Il file non contiene punti di tracciato validi.")
+
+    return _build_result(points.lon, points.lat, points.times, points.ele,
+                         points.segment_starts, handler.name, handler.file_format)
+
+
+def _build_result(lon, lat, times, ele, segment_starts, name, file_format):
+    lon, lat = lon.values(), lat.values()
+    times, ele = times.values(), ele.values()
+    starts = np.asarray(segment_starts or [0], dtype=np.int64)
+
+    # Distanze dei segmenti, senza contare i "salti" tra un trkseg e il successivo
+    distances = segment_distances(lat, lon)
+    breaks = starts[starts > 0] - 1
+    distances[breaks] = 0.0
+
+    has_elevation = bool(ele.size) and not np.isnan(ele).any()
+    distance_3d = 0.0
+    gain = loss = 0.0
+    if has_elevation:
+        climbs = np.diff(ele)
+        climbs[breaks] = 0.0
+        distance_3d = float(np.sqrt(distances ** 2 + climbs ** 2).sum()) / 1000.0
+        gain = float(climbs[climbs > 0].sum())
+        loss = float(-climbs[climbs < 0].sum())
+
+    timed = times[~np.isnan(times)]
+    duration = max(int(timed[-1] - timed[0]), 0) if timed.size >= 2 else 0
+    has_time = bool(times.size) and timed.size == times.size
+    segments_duration = 0
+    for segment_times in np.split(times, starts[starts > 0]):
+        segment_timed = segment_times[~np.isnan(segment_times)]
+        if segment_timed.size >= 2:
+            segments_duration += max(int(segment_timed[-1] - segment_timed[0]), 0)
+
+    return ParsedTrackFile(
+        track=Track(lon, lat, time=times if has_time else None, ele=ele if has_elevation else None),
+        name=name,
+        file_format=file_format,
+        segment_starts=starts,
+        distance_2d_km=float(distances.sum()) / 1000.0,
+        distance_3d_km=distance_3d,
+        duration=duration,
+        segments_duration=segments_duration,
+        elevation_gain=gain,
+        elevation_loss=loss,
+        bounds=(float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())),
+    )
@@ -0,0 +1,353 @@
+# app/jobs.py
+"""
+Coda di lavori in background persistente sul database (tabella `jobs`).
+
+Non serve nessun broker esterno: le richieste web accodano un Job con
+`enqueue()` e rispondono subito, il processo `worker.py` li preleva ed esegue.
+
+- Prelievo: SELECT ... FOR UPDATE SKIP LOCKED (su PostgreSQL) seguito da un
+  UPDATE condizionale, così due worker non prendono mai lo stesso job.
+- Visibility timeout: un job in esecuzione è "bloccato" fino a `locked_until`;
+  se il worker muore senza rinnovarlo (update_progress lo rinnova) il job torna
+  disponibile per un altro worker.
+- Retry: un errore imprevisto rimette il job in coda con backoff esponenziale
+  fino a `max_attempts`; JobFailed invece chiude subito il job come fallito
+  (es. file non valido) con il messaggio per l'utente.
+
+Configurazione (app.config / variabili d'ambiente): JOB_WORKER_CONCURRENCY,
+JOB_VISIBILITY_TIMEOUT, JOB_MAX_ATTEMPTS, JOB_RETRY_BACKOFF, JOB_POLL_INTERVAL,
+JOBS_RUN_INLINE (esegue i job nella richiesta stessa, utile in sviluppo).
+"""
+import os
+import socket
+import threading
+import traceback
+import zlib
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from app import db
+from app.models import Job
+
+
+DEFAULTS = {
+    'JOB_WORKER_CONCURRENCY': 2,
+    'JOB_VISIBILITY_TIMEOUT': 300,   # secondi
+    'JOB_MAX_ATTEMPTS': 3,
+    'JOB_RETRY_BACKOFF': 30,         # secondi, raddoppia ad ogni tentativo
+    'JOB_POLL_INTERVAL': 2.0,        # secondi di attesa quando la coda è vuota
+    'JOBS_RUN_INLINE': False,
+}
+
+JOB_HANDLERS = {}
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class JobFailed(Exception):
+    """Errore definitivo: il job fallisce senza altri tentativi."""
+
+
+def job_handler(kind):
+    """Decoratore che registra la funzione che esegue i job di tipo `kind`."""
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def setting(name):
+    return current_app.config.get(name, DEFAULTS[name])
+
+
+# =====================================================================
+# FILE ALLEGATI
+# =====================================================================
+
+def compress_stream(stream):
+    """Comprime con zlib un file caricato leggendolo a blocchi."""
+    compressor = zlib.compressobj(6)
+    parts = []
+    while True:
+        chunk = stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        parts.append(compressor.compress(chunk))
+    parts.append(compressor.flush())
+    return b''.join(parts)
+
+
+class _InflatingReader:
+    """File-like in sola lettura che decomprime il file allegato al job a blocchi."""
+
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+        self._inflater = zlib.decompressobj()
+        self._buffer = b''
+        self._exhausted = False
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        while (size < 0 or len(self._buffer) < size) and not self._exhausted:
+            chunk = self._data[self._offset:self._offset + _CHUNK_SIZE]
+            self._offset += _CHUNK_SIZE
+            if chunk:
+                self._buffer += self._inflater.decompress(chunk)
+            else:
+                self._buffer += self._inflater.flush()
+                self._exhausted = True
+        if size < 0:
+            size = len(self._buffer)
+        result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
+
+
+def job_file(job):
+    """Restituisce il file allegato al job come stream leggibile, None se assente."""
+    if job.file_data is None:
+        return None
+    return _InflatingReader(bytes(job.file_data))
+
+
+# =====================================================================
+# ACCODAMENTO
+# =====================================================================
+
+def enqueue(kind, payload=None, user_id=None, file_stream=None, max_attempts=None):
+    """
+    Accoda un job e fa commit. Se JOBS_RUN_INLINE è attivo il job viene
+    eseguito subito nella richiesta corrente.
+    """
+    job = Job(
+        kind=kind,
+        payload=payload or {},
+        user_id=user_id,
+        file_data=compress_stream(file_stream) if file_stream is not None else None,
+        max_attempts=max_attempts or setting('JOB_MAX_ATTEMPTS'),
+        run_after=datetime.utcnow(),
+    )
+    db.session.add(job)
+    db.session.commit()
+    print(f"📥 Job {job.id} ({kind}) accodato.")
+
+    if setting('JOBS_RUN_INLINE'):
+        job_id = job.id
+        process_job(job_id, worker_id='inline')
+        job = db.session.get(Job, job_id)
+    return job
+
+
+def enqueue_in_transaction(connection, kind, payload=None, user_id=None, max_attempts=None):
+    """
+    Accoda un job sulla connessione della transazione in corso, senza commit:
+    il job esiste solo se la transazione va a buon fine. Pensata per gli eventi
+    di flush, dove la sessione non può essere usata per aggiungere oggetti.
+    """
+    connection.execute(Job.__table__.insert().values(
+        kind=kind,
+        status='queued',
+        payload=payload or {},
+        user_id=user_id,
+        progress=0,
+        attempts=0,
+        max_attempts=max_attempts or setting('JOB_MAX_ATTEMPTS'),
+        run_after=datetime.utcnow(),
+        created_at=datetime.utcnow(),
+    ))
+
+
+# =====================================================================
+# PRELIEVO ED ESECUZIONE
+# =====================================================================
+
+def _available_filter(now):
+    return db.and_(
+        Job.attempts < Job.max_attempts,
+        db.or_(
+            db.and_(Job.status == 'queued', Job.run_after <= now),
+            # Job di un worker che non ha più rinnovato il lock (es. processo terminato)
+            db.and_(Job.status == 'running', Job.locked_until < now),
+        )
+    )
+
+
+def _lock_values(worker_id, now):
+    return {
+        'status': 'running',
+        'locked_by': worker_id,
+        'locked_until': now + timedelta(seconds=setting('JOB_VISIBILITY_TIMEOUT')),
+        'attempts': Job.attempts + 1,
+        'started_at': now,
+    }
+
+
+def fail_abandoned_jobs():
+    """Chiude come falliti i job rimasti bloccati che hanno esaurito i tentativi."""
+    now = datetime.utcnow()
+    count = Job.query.filter(
+        Job.status == 'running',
+        Job.locked_until < now,
+        Job.attempts >= Job.max_attempts
+    ).update({
+        'status': 'failed',
+        'error': 'Elaborazione interrotta troppe volte.',
+        'locked_until': None,
+        'finished_at': now,
+        'file_data': None,
+    }, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def claim_next_job(worker_id):
+    """Preleva il prossimo job disponibile e lo blocca per questo worker. None se la coda è vuota."""
+    now = datetime.utcnow()
+    job_id = db.session.query(Job.id).filter(
+        _available_filter(now)
+    ).order_by(Job.run_after, Job.id).limit(1).with_for_update(skip_locked=True).scalar()
+    if job_id is None:
+        db.session.rollback()
+        return None
+
+    # UPDATE condizionale: se un altro worker l'ha preso nel frattempo non tocca nessuna riga
+    claimed = Job.query.filter(Job.id == job_id, _available_filter(now)).update(
+        _lock_values(worker_id, now), synchronize_session=False
+    )
+    db.session.commit()
+    if not claimed:
+        return None
+    return db.session.get(Job, job_id)
+
+
+def update_progress(job, percent, message=None):
+    """
+    Aggiorna l'avanzamento del job e rinnova il visibility timeout.
+    Usa una connessione separata, quindi non fa commit del lavoro in corso.
+    """
+    values = {
+        'progress': max(0, min(int(percent), 100)),
+        'locked_until': datetime.utcnow() + timedelta(seconds=setting('JOB_VISIBILITY_TIMEOUT')),
+    }
+    if message is not None:
+        values['progress_message'] = message[:200]
+    with db.engine.begin() as connection:
+        connection.execute(Job.__table__.update().where(Job.__table__.c.id == job.id).values(**values))
+
+
+def run_job(job):
+    """Esegue un job già prelevato e ne registra l'esito."""
+    job_id = job.id
+    handler = JOB_HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise JobFailed(f"Tipo di lavoro sconosciuto: {job.kind}")
+        result = handler(job)
+    except JobFailed as e:
+        db.session.rollback()
+        _finish(db.session.get(Job, job_id), 'failed', error=str(e))
+        print(f"⚠️ Job {job_id} ({job.kind}) fallito: {e}")
+        return False
+    except Exception as e:
+        db.session.rollback()
+        traceback.print_exc()
+        job = db.session.get(Job, job_id)
+        if job.attempts < job.max_attempts:
+            delay = setting('JOB_RETRY_BACKOFF') * (2 ** max(job.attempts - 1, 0))
+            job.status = 'queued'
+            job.error = str(e)
+            job.locked_until = None
+            job.locked_by = None
+            job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+            db.session.commit()
+            print(f"🔁 Job {job_id} ({job.kind}) in errore, nuovo tentativo tra {delay}s: {e}")
+        else:
+            _finish(job, 'failed', error=str(e))
+            print(f"❌ Job {job_id} ({job.kind}) fallito dopo {job.attempts} tentativi: {e}")
+        return False
+
+    _finish(db.session.get(Job, job_id), 'succeeded', result=result)
+    print(f"✅ Job {job_id} ({job.kind}) completato.")
+    return True
+
+
+def _finish(job, status, result=None, error=None):
+    job.status = status
+    job.result = result if result is not None else job.result
+    job.error = error
+    job.finished_at = datetime.utcnow()
+    job.locked_until = None
+    job.file_data = None
+    if status == 'succeeded':
+        job.progress = 100
+    db.session.commit()
+
+
+def process_job(job_id, worker_id):
+    """Preleva ed esegue un job specifico (modalità JOBS_RUN_INLINE)."""
+    now = datetime.utcnow()
+    claimed = Job.query.filter(Job.id == job_id, _available_filter(now)).update(
+        _lock_values(worker_id, now), synchronize_session=False
+    )
+    db.session.commit()
+    if claimed:
+        run_job(db.session.get(Job, job_id))
+
+
+def work_once(worker_id):
+    """Esegue al massimo un job. Ritorna True se ne ha trovato uno."""
+    job = claim_next_job(worker_id)
+    if job is None:
+        return False
+    try:
+        run_job(job)
+    finally:
+        db.session.remove()
+    return True
+
+
+def cleanup_finished_jobs(days=7):
+    """Elimina i job conclusi da più di `days` giorni."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    count = Job.query.filter(
+        Job.status.in_(('succeeded', 'failed')),
+        Job.finished_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def run_worker(app, concurrency=None, poll_interval=None, stop_event=None):
+    """
+    Avvia `concurrency` thread che consumano la coda finché `stop_event`
+    non viene impostato. Blocca il chiamante.
+    """
+    with app.app_context():
+        concurrency = concurrency or setting('JOB_WORKER_CONCURRENCY')
+        poll_interval = poll_interval or setting('JOB_POLL_INTERVAL')
+    stop_event = stop_event or threading.Event()
+    base_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def loop(index):
+        worker_id = f"{base_id}:{index}"
+        with app.app_context():
+            while not stop_event.is_set():
+                try:
+                    if index == 0:
+                        fail_abandoned_jobs()
+                    if not work_once(worker_id):
+                        stop_event.wait(poll_interval)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"⚠️ Worker {worker_id}: errore nel prelievo dei job: {e}")
+                    stop_event.wait(poll_interval)
+
+    threads = [threading.Thread(target=loop, args=(i,), name=f"job-worker-{i}", daemon=True)
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    print(f"👷 Worker coda job avviato: {concurrency} thread, polling ogni {poll_interval}s.")
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,198 @@
+# File: app/main/activity_uploads.py
+"""
+Elaborazione in background delle attività caricate da file GPX/TCX.
+
+record_activity accoda un job 'record_activity' con il file compresso e
+risponde subito; il worker esegue qui lettura del file, validazione di
+distanza e geofencing, salvataggio, controllo del record e badge.
+"""
+from datetime import datetime
+from decimal import Decimal
+
+from app import db
+from app.geo import average_speed
+from app.gpx_stream import read_track_file, TrackFileError
+from app.jobs import enqueue, job_file, job_handler, update_progress, JobFailed
+from app.models import Activity, Challenge, Post, Route, RouteRecord, User
+from app.spatial import route_geometry_cache
+from .gamification import add_prestige
+from .leaderboards import get_leader
+
+
+JOB_KIND = 'record_activity'
+
+DISTANCE_TOLERANCE_PERCENT = Decimal('0.05')
+GEOFENCE_BUFFER_METERS = 50
+GEOFENCE_MATCH_THRESHOLD = 0.80
+
+
+def enqueue_activity_upload(user, route, challenge, activity_type, file_storage):
+    """Accoda l'elaborazione di un file caricato e restituisce il Job."""
+    return enqueue(
+        JOB_KIND,
+        payload={
+            'user_id': user.id,
+            'route_id': route.id,
+            'challenge_id': challenge.id if challenge else None,
+            'activity_type': activity_type,
+            'filename': file_storage.filename,
+        },
+        user_id=user.id,
+        file_stream=file_storage.stream,
+    )
+
+
+def _validate_distance(route, activity_distance_km):
+    expected_distance = Decimal(str(route.distance_km)) if route.distance_km is not None else Decimal(0)
+    actual_distance = Decimal(str(activity_distance_km))
+
+    is_valid_distance = False
+    if expected_distance > 0:
+        lower_bound = expected_distance * (1 - DISTANCE_TOLERANCE_PERCENT)
+        upper_bound = expected_distance * (1 + DISTANCE_TOLERANCE_PERCENT)
+        if lower_bound <= actual_distance <= upper_bound:
+            is_valid_distance = True
+    elif actual_distance == 0 and expected_distance == 0:
+        is_valid_distance = True
+
+    if not is_valid_distance:
+        raise JobFailed(f'La distanza dell\'attività non corrisponde al percorso selezionato '
+                        f'(Prevista: ~{expected_distance:.2f} km, Registrata: {actual_distance:.2f} km).')
+
+
+def _validate_geofence(route, track):
+    # Buffer di 50 m in proiezione metrica locale, test vettorizzato su tutti i punti
+    try:
+        geofence = route_geometry_cache.geofence(route, buffer_meters=GEOFENCE_BUFFER_METERS)
+    except ValueError:
+        raise JobFailed('Errore nella creazione del geofence per il percorso.')
+
+    result = geofence.validate(track.lon, track.lat)
+    if result.total_points == 0:
+        raise JobFailed('Nessun punto GPS nel file di attività per la validazione.')
+
+    print(f"--- DEBUG: Geofencing {result.match_percentage:.0%} punti nel buffer, "
+          f"copertura sezioni: {[f'{c:.0%}' for c in result.section_coverage]} ---")
+    if result.match_percentage < GEOFENCE_MATCH_THRESHOLD:
+        section_index, section_coverage = result.weakest_section
+        raise JobFailed(f'Il tracciato non segue abbastanza il percorso ({result.match_percentage:.0%} di corrispondenza; '
+                        f'sezione meno coperta: {section_index + 1}/{geofence.sections} al {section_coverage:.0%}).')
+    return result
+
+
+def _update_route_record(user, route, activity):
+    """
+    Aggiorna il record del percorso se l'attività è in testa alla classifica
+    materializzata (aggiornata al salvataggio dell'attività). Ritorna True se è un nuovo record.
+    """
+    leader = get_leader(route.id, activity.activity_type)
+    if leader is None or leader.activity_id != activity.id:
+        return False
+    current_record = RouteRecord.query.filter_by(
+        route_id=route.id, activity_type=activity.activity_type
+    ).order_by(RouteRecord.duration.asc()).first()
+    if current_record and current_record.activity_id == activity.id:
+        return False
+
+    if current_record:
+        # Se c'era un record precedente, lo rimuoviamo
+        db.session.delete(current_record)
+    db.session.add(RouteRecord(
+        route_id=route.id,
+        user_id=user.id,
+        activity_id=activity.id,
+        activity_type=activity.activity_type,
+        duration=activity.duration
+    ))
+
+    # Post automatico per celebrare il nuovo record
+    record_post_content = (
+        f"🏆 Nuovo Record! {user.username} ha conquistato il percorso '{route.name}' "
+        f"con un tempo eccezionale di {datetime.utcfromtimestamp(activity.duration).strftime('%H:%M:%S')}!"
+    )
+    db.session.add(Post(
+        user_id=user.id,
+        content=record_post_content,
+        post_category='system_record',
+        post_type='text'
+    ))
+    add_prestige(user, 'new_record')
+    db.session.commit()
+    return True
+
+
+@job_handler(JOB_KIND)
+def process_activity_upload(job):
+    """Handler del job: restituisce il riepilogo salvato in Job.result."""
+    from .routes import award_badge_if_earned
+
+    payload = job.payload or {}
+    user = db.session.get(User, payload.get('user_id'))
+    route = db.session.get(Route, payload.get('route_id'))
+    challenge = db.session.get(Challenge, payload['challenge_id']) if payload.get('challenge_id') else None
+    if not user or not route:
+        raise JobFailed('Utente o percorso non più esistente.')
+
+    # Un tentativo precedente potrebbe aver già salvato l'attività prima di interrompersi
+    activity = None
+    if job.result and job.result.get('activity_id'):
+        activity = db.session.get(Activity, job.result['activity_id'])
+
+    geofence_result = None
+    if activity is None:
+        update_progress(job, 10, 'Lettura del file')
+        stream = job_file(job)
+        if stream is None:
+            raise JobFailed('File dell\'attività non disponibile.')
+        try:
+            parsed_file = read_track_file(stream)
+        except TrackFileError:
+            raise JobFailed('Il file GPX non contiene dati di percorso validi.')
+
+        update_progress(job, 40, 'Validazione della distanza')
+        _validate_distance(route, parsed_file.distance_km)
+
+        update_progress(job, 60, 'Validazione del tracciato')
+        geofence_result = _validate_geofence(route, parsed_file.track)
+
+        update_progress(job, 80, 'Salvataggio dell\'attività')
+        activity = Activity(
+            user_id=user.id, route_id=route.id,
+            challenge_id=challenge.id if challenge else None,
+            activity_type=payload.get('activity_type') or 'Corsa', gps_track=parsed_file.track,
+            # Durata in movimento come prima con gpxpy: le pause tra i segmenti non contano
+            duration=int(parsed_file.segments_duration),
+            avg_speed=float(average_speed(parsed_file.distance_km, parsed_file.segments_duration)),
+            distance=float(parsed_file.distance_km)
+        )
+        db.session.add(activity)
+        add_prestige(user, 'new_activity')
+        db.session.flush()
+        # Salvato insieme all'attività: un eventuale nuovo tentativo non la duplica
+        job.result = {'activity_id': activity.id}
+        db.session.commit()
+
+    update_progress(job, 90, 'Record e badge')
+    new_record = _update_route_record(user, route, activity)
+
+    badges = []
+    if new_record and award_badge_if_earned(user, "Re/Regina del Percorso", notify=False):
+        badges.append("Re/Regina del Percorso")
+    if Activity.query.filter_by(user_id=user.id).count() == 1:
+        if award_badge_if_earned(user, "Prima Attività", notify=False):
+            badges.append("Prima Attività")
+    if activity.distance > 10.0:
+        if award_badge_if_earned(user, "Hai percorso più di 10km", notify=False):
+            badges.append("Hai percorso più di 10km")
+
+    return {
+        'activity_id': activity.id,
+        'route_id': route.id,
+        'challenge_id': challenge.id if challenge else None,
+        'distance_km': round(activity.distance, 3),
+        'duration': activity.duration,
+        'avg_speed': round(activity.avg_speed, 2),
+        'new_record': new_record,
+        'badges': badges,
+        'geofence': geofence_result.to_dict() if geofence_result else None,
+    }
@@ -0,0 +1,279 @@
+# File: app/main/leaderboards.py
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from sqlalchemy import and_, event, func, or_, select
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import get_history
+from app import db
+from app.models import Activity, RouteLeaderboard, RouteRecord
+
+
+def get_routes_record_holders(route_ids):
+    """
+    Restituisce il record (RouteRecord con durata minima) di ciascun percorso
+    con un'unica query a finestra, con detentore e attività già caricati.
+
+    Ritorna un dizionario {route_id: RouteRecord}.
+    """
+    route_ids = list(route_ids)
+    if not route_ids:
+        return {}
+
+    ranked = db.session.query(
+        RouteRecord.id.label('record_id'),
+        func.row_number().over(
+            partition_by=RouteRecord.route_id,
+            order_by=(RouteRecord.duration.asc(), RouteRecord.id.asc())
+        ).label('position')
+    ).filter(RouteRecord.route_id.in_(route_ids)).subquery()
+
+    records = RouteRecord.query.options(
+        joinedload(RouteRecord.record_holder),
+        joinedload(RouteRecord.activity)
+    ).join(
+        ranked, ranked.c.record_id == RouteRecord.id
+    ).filter(ranked.c.position == 1).all()
+
+    return {record.route_id: record for record in records}
+
+
+@dataclass
+class RouteRanking:
+    """Classifica di un percorso: migliori tempi (uno per utente), tentativi e record."""
+    route_id: int
+    # Migliori attività, al massimo una per utente, dalla più veloce (utenti già caricati)
+    top: list = field(default_factory=list)
+    attempts: int = 0       # attività registrate sul percorso
+    athletes: int = 0       # utenti distinti con almeno un'attività
+    record: RouteRecord = None
+
+    @property
+    def fastest(self):
+        return self.top[0] if self.top else None
+
+
+def get_route_leaderboards(route_ids, limit=5, include_record=True):
+    """
+    Classifiche di più percorsi lette dalla tabella materializzata
+    RouteLeaderboards con una query a finestra (miglior tempo di ogni utente
+    su tutti i tipi di attività, posizione e conteggi) più, con
+    `include_record`, quella dei detentori del record (RouteRecord).
+
+    Ritorna un dizionario {route_id: RouteRanking} con una voce per ogni
+    percorso richiesto, anche senza attività.
+    """
+    route_ids = list(dict.fromkeys(route_ids))
+    if not route_ids:
+        return {}
+
+    # Miglior riga di ogni utente su ogni percorso (un utente può averne una per tipo) e tentativi totali
+    per_user = db.session.query(
+        RouteLeaderboard.activity_id.label('activity_id'),
+        RouteLeaderboard.route_id.label('route_id'),
+        RouteLeaderboard.duration.label('duration'),
+        func.row_number().over(
+            partition_by=(RouteLeaderboard.route_id, RouteLeaderboard.user_id),
+            order_by=(RouteLeaderboard.duration.asc(), RouteLeaderboard.activity_id.asc())
+        ).label('user_position'),
+        func.sum(RouteLeaderboard.attempts).over(partition_by=RouteLeaderboard.route_id).label('attempts')
+    ).filter(RouteLeaderboard.route_id.in_(route_ids)).subquery()
+
+    # Posizione tra i migliori tempi dei singoli utenti e numero di utenti
+    ranked = db.session.query(
+        per_user.c.activity_id,
+        per_user.c.attempts,
+        func.row_number().over(
+            partition_by=per_user.c.route_id,
+            order_by=(per_user.c.duration.asc(), per_user.c.activity_id.asc())
+        ).label('position'),
+        func.count(per_user.c.activity_id).over(partition_by=per_user.c.route_id).label('athletes')
+    ).filter(per_user.c.user_position == 1).subquery()
+
+    # Con limit=0 serve comunque la prima riga di ogni percorso per i conteggi
+    rows = db.session.query(
+        Activity, ranked.c.position, ranked.c.attempts, ranked.c.athletes
+    ).options(
+        joinedload(Activity.user_activity)
+    ).join(
+        ranked, ranked.c.activity_id == Activity.id
+    ).filter(
+        ranked.c.position <= max(limit, 1)
+    ).order_by(Activity.route_id, ranked.c.position).all()
+
+    result = {route_id: RouteRanking(route_id) for route_id in route_ids}
+    for activity, position, attempts, athletes in rows:
+        ranking = result[activity.route_id]
+        ranking.attempts = int(attempts)
+        ranking.athletes = athletes
+        if position <= limit:
+            ranking.top.append(activity)
+
+    if include_record:
+        for route_id, record in get_routes_record_holders(route_ids).items():
+            result[route_id].record = record
+    return result
+
+
+# =====================================================================
+# CLASSIFICA MATERIALIZZATA (RouteLeaderboards)
+# =====================================================================
+
+def _rank_order():
+    return RouteLeaderboard.duration.asc(), RouteLeaderboard.activity_id.asc()
+
+
+def get_leaderboard_page(route_id, activity_type, limit=10, offset=0):
+    """Righe della classifica di (percorso, tipo) dalla posizione offset+1, con utenti e attività caricati."""
+    return RouteLeaderboard.query.options(
+        joinedload(RouteLeaderboard.user), joinedload(RouteLeaderboard.activity)
+    ).filter_by(
+        route_id=route_id, activity_type=activity_type
+    ).order_by(*_rank_order()).offset(offset).limit(limit).all()
+
+
+def get_leader(route_id, activity_type):
+    """Prima riga della classifica di (percorso, tipo), None se vuota."""
+    return RouteLeaderboard.query.filter_by(
+        route_id=route_id, activity_type=activity_type
+    ).order_by(*_rank_order()).first()
+
+
+def get_user_standing(route_id, activity_type, user_id):
+    """
+    Posizione dell'utente nella classifica di (percorso, tipo):
+    {'position', 'total', 'entry'}, None se l'utente non ha attività.
+    Due conteggi sull'indice della classifica, senza ordinare le attività.
+    """
+    entry = RouteLeaderboard.query.filter_by(
+        route_id=route_id, activity_type=activity_type, user_id=user_id
+    ).first()
+    if entry is None:
+        return None
+    same_board = db.session.query(func.count(RouteLeaderboard.id)).filter(
+        RouteLeaderboard.route_id == route_id, RouteLeaderboard.activity_type == activity_type
+    )
+    ahead = same_board.filter(or_(
+        RouteLeaderboard.duration < entry.duration,
+        and_(RouteLeaderboard.duration == entry.duration, RouteLeaderboard.activity_id < entry.activity_id)
+    )).scalar()
+    return {'position': ahead + 1, 'total': same_board.scalar(), 'entry': entry}
+
+
+_activities = Activity.__table__
+_entries = RouteLeaderboard.__table__
+_records = RouteRecord.__table__
+
+
+def refresh_leaderboard_entry(connection, route_id, activity_type, user_id, exclude_activity_id=None):
+    """
+    Ricalcola dalla tabella Activities la riga di (percorso, tipo, utente),
+    ignorando `exclude_activity_id` (attività in eliminazione).
+    Usa la connessione del flush in corso. Ritorna True se il miglior tempo è cambiato.
+    """
+    if route_id is None or activity_type is None or user_id is None:
+        return False
+    conditions = [
+        _activities.c.route_id == route_id,
+        _activities.c.activity_type == activity_type,
+        _activities.c.user_id == user_id,
+    ]
+    if exclude_activity_id is not None:
+        conditions.append(_activities.c.id != exclude_activity_id)
+    best = connection.execute(
+        select(_activities.c.id, _activities.c.duration).where(*conditions)
+        .order_by(_activities.c.duration.asc(), _activities.c.id.asc()).limit(1)
+    ).first()
+    attempts = connection.execute(select(func.count()).select_from(_activities).where(*conditions)).scalar()
+
+    key = (
+        (_entries.c.route_id == route_id) & (_entries.c.activity_type == activity_type)
+        & (_entries.c.user_id == user_id)
+    )
+    entry = connection.execute(
+        select(_entries.c.activity_id, _entries.c.duration, _entries.c.attempts).where(key)
+    ).first()
+
+    if best is None:
+        if entry is not None:
+            connection.execute(_entries.delete().where(key))
+        return entry is not None
+
+    values = {'activity_id': best.id, 'duration': best.duration, 'attempts': attempts, 'updated_at': datetime.utcnow()}
+    if entry is None:
+        connection.execute(_entries.insert().values(
+            route_id=route_id, activity_type=activity_type, user_id=user_id, **values
+        ))
+        return True
+    if (entry.activity_id, entry.duration, entry.attempts) != (best.id, best.duration, attempts):
+        connection.execute(_entries.update().where(key).values(**values))
+    return (entry.activity_id, entry.duration) != (best.id, best.duration)
+
+
+def sync_route_record(connection, route_id, activity_type):
+    """
+    Riallinea il RouteRecord di (percorso, tipo) alla prima riga della
+    classifica dopo una correzione (modifica o eliminazione di un'attività).
+    I nuovi record delle attività appena caricate li crea il job di upload,
+    che pubblica anche il post celebrativo.
+    """
+    record_key = (_records.c.route_id == route_id) & (_records.c.activity_type == activity_type)
+    records = connection.execute(select(_records.c.activity_id, _records.c.duration).where(record_key)).all()
+    if not records:
+        return
+    leader = connection.execute(
+        select(_entries.c.activity_id, _entries.c.user_id, _entries.c.duration)
+        .where(_entries.c.route_id == route_id, _entries.c.activity_type == activity_type)
+        .order_by(_entries.c.duration.asc(), _entries.c.activity_id.asc()).limit(1)
+    ).first()
+    if leader is not None and len(records) == 1 and tuple(records[0]) == (leader.activity_id, leader.duration):
+        return
+
+    connection.execute(_records.delete().where(record_key))
+    if leader is not None:
+        connection.execute(_records.insert().values(
+            route_id=route_id, user_id=leader.user_id, activity_id=leader.activity_id,
+            activity_type=activity_type, duration=leader.duration, created_at=datetime.utcnow()
+        ))
+
+
+_LEADERBOARD_FIELDS = ('route_id', 'activity_type', 'user_id')
+
+
+def _leaderboard_keys(target, include_old):
+    """Chiavi (percorso, tipo, utente) toccate dalla scrittura: quella attuale e, se cambiata, la precedente."""
+    current = tuple(getattr(target, name) for name in _LEADERBOARD_FIELDS)
+    keys = [current]
+    if include_old:
+        previous = []
+        for name in _LEADERBOARD_FIELDS:
+            history = get_history(target, name)
+            previous.append(history.deleted[0] if history.deleted else getattr(target, name))
+        keys.insert(0, tuple(previous))
+    return list(dict.fromkeys(keys))
+
+
+def _on_activity_inserted(mapper, connection, target):
+    refresh_leaderboard_entry(connection, target.route_id, target.activity_type, target.user_id)
+
+
+def _on_activity_updated(mapper, connection, target):
+    if not any(get_history(target, name).has_changes() for name in _LEADERBOARD_FIELDS + ('duration',)):
+        return
+    # Prima la chiave precedente, che libera l'attività (activity_id è unico nella tabella)
+    for route_id, activity_type, user_id in _leaderboard_keys(target, include_old=True):
+        if refresh_leaderboard_entry(connection, route_id, activity_type, user_id):
+            sync_route_record(connection, route_id, activity_type)
+
+
+def _on_activity_deleting(mapper, connection, target):
+    # before_delete: riga di classifica e record puntano all'attività e vanno spostati prima della DELETE
+    for route_id, activity_type, user_id in _leaderboard_keys(target, include_old=True):
+        if refresh_leaderboard_entry(connection, route_id, activity_type, user_id, exclude_activity_id=target.id):
+            sync_route_record(connection, route_id, activity_type)
+    connection.execute(_records.delete().where(_records.c.activity_id == target.id))
+
+
+event.listen(Activity, 'after_insert', _on_activity_inserted)
+event.listen(Activity, 'after_update', _on_activity_updated)
+event.listen(Activity, 'before_delete', _on_activity_deleting)
@@ -3,24 +3,31 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app,request, Blueprint
 import requests
 from flask_login import login_required, current_user
-from app.models import User, Route, Activity, ActivityLike, Challenge, Comment, Like, RouteRecord, Badge, UserBadge, Notification, ChallengeInvitation, Bet, Post, PostComment, PostLike, Tag ,post_tags, Group,Event
+from app.models import User, Route, Activity, ActivityLike, Challenge, Comment, Like, Badge, UserBadge, Notification, ChallengeInvitation, Bet, Post, PostComment, PostLike, Tag ,post_tags, Group,Event, Job, followers
 from app import db, sitemap
 from sqlalchemy import func
 from sqlalchemy.orm import joinedload, selectinload
 from datetime import datetime
 import json
-import gpxpy
 import uuid
 import os
-from decimal import Decimal, InvalidOperation
-from shapely.geometry import LineString, Point
-from math import radians, sin, cos, sqrt, atan2
+from math import radians, cos
 from werkzeug.utils import secure_filename # Utile per gestire i nomi dei file
 from flask_wtf.csrf import validate_csrf, CSRFError # Importa per la validazione manuale
 import traceback  # ⚠️ AGGIUNGI QUESTO IMPORT
 from app import csrf  # <-- IMPORT CORRETTO
 import json
-from .services import get_unified_feed_items
+from app.tracks import Track
+from app.geo import haversine, path_length, track_stats, average_speed
+from app.simplify import requested_tolerance, with_coordinates
+from app.gpx_stream import read_track_file, TrackFileError
+from app.pagination import paginate_request, InvalidCursor
+from app.follow_graph import followed_ids, following_among, follow_counts
+from .activity_uploads import enqueue_activity_upload
+from .services import get_unified_feed_items, attach_engagement, bump_counter, recount_post_comments, mark_notifications_read
+from .leaderboards import get_route_leaderboards, get_user_standing
+from .timeline import on_follow, on_unfollow
+from .suggestions import get_user_suggestions
 import re # <-- Aggiungi questo import all'inizio del file
 from .onboarding import complete_onboarding_step, get_onboarding_status
 from .gamification import add_prestige, TITLES, create_bet_notification # <-- Assicurati che sia così
@@ -65,25 +72,15 @@ def sitemap_dynamic_urls():
 # --- Funzioni Helper ---
 
 def calculate_distance_meters(lat1, lon1, lat2, lon2):
-    R = 6371000
-    lat1_rad, lon1_rad, lat2_rad, lon2_rad = map(radians, [lat1, lon1, lat2, lon2])
-    dlon = lon2_rad - lon1_rad
-    dlat = lat2_rad - lat1_rad
-    a = sin(dlat / 2)**2 + cos(lat1_rad) * cos(lat2_rad) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    return R * c
-
-def create_geojson_linestring_buffer(geojson_linestring_coords, buffer_distance_meters):
-    if not geojson_linestring_coords or len(geojson_linestring_coords) < 2:
-        return None
-    coords_shapely = [(p[0], p[1]) for p in geojson_linestring_coords]
-    line = LineString(coords_shapely)
-    buffer_in_degrees = buffer_distance_meters / (111.32 * 1000)
-    return line.buffer(buffer_in_degrees)
-    
-def award_badge_if_earned(user, badge_name):
-    # Questa funzione potrebbe aver bisogno di 'app.app_context()' se usata fuori da una request,
-    # ma qui dentro va bene così.
+    return float(haversine(lat1, lon1, lat2, lon2))
+
+def coords_length_km(line_coords):
+    """Lunghezza in km di una lista di coordinate GeoJSON [[lon, lat], ...]."""
+    return path_length([c[1] for c in line_coords], [c[0] for c in line_coords]) / 1000.0
+
+def award_badge_if_earned(user, badge_name, notify=True):
+    # Fuori da una request (es. nei job del worker) va chiamata con notify=False:
+    # il messaggio flash richiede una sessione utente.
     badge = Badge.query.filter_by(name=badge_name).first()
     if not badge:
         if badge_name == "Nuovo Atleta":
@@ -130,7 +127,8 @@ def award_badge_if_earned(user, badge_name):
         add_prestige(user, 'get_badge')
         
         db.session.commit() # Questo salverà sia UserBadge che il nuovo Post
-        flash(f'Congratulazioni! Hai ottenuto il badge: "{badge.name}"!', 'info')
+        if notify:
+            flash(f'Congratulazioni! Hai ottenuto il badge: "{badge.name}"!', 'info')
         return True
     return False
 
@@ -155,7 +153,7 @@ def index():
     
     # Inizializziamo le variabili che dipendono dal login
     # Inizializziamo tutte le variabili che dipendono dal login
-    community_items, has_next_feed_page = [], False
+    community_items, next_feed_cursor = [], None
     upcoming_events, show_onboarding, onboarding_status = [], False, {}
     recent_challenges_in_city = []
 
@@ -163,7 +161,7 @@ def index():
         # --- SE L'UTENTE È LOGGATO, CARICHIAMO I DATI DELLA SUA DASHBOARD ---
         
         # 1. Feed personalizzato
-        community_items, has_next_feed_page = get_unified_feed_items(user=current_user, page=1, per_page=5)
+        community_items, next_feed_cursor = get_unified_feed_items(user=current_user, per_page=5)
         
         # 2. Onboarding
         status, is_complete = get_onboarding_status(current_user)
@@ -200,7 +198,7 @@ def index():
             
     else:
         # --- SE L'UTENTE NON È LOGGATO, CARICHIAMO IL FEED PUBBLICO ---
-        community_items, has_next_feed_page = get_unified_feed_items(user=None, page=1, per_page=5)
+        community_items, next_feed_cursor = get_unified_feed_items(user=None, per_page=5)
 
     # --- DATI SEMPRE PUBBLICI ---
     top_users_data = (
@@ -229,7 +227,7 @@ def index():
                         recent_challenges_in_city=recent_challenges_in_city,
                         top_users=top_users,
                         community_items=community_items, 
-                        has_next_feed_page=has_next_feed_page,
+                        next_feed_cursor=next_feed_cursor,
                         show_onboarding=show_onboarding,
                         onboarding_status=onboarding_status,
                         upcoming_events=upcoming_events,
@@ -278,14 +276,18 @@ def search_city():
 @main.route('/feed')
 @login_required
 def feed():
-    page = request.args.get('page', 1, type=int)
-    activities_query = current_user.followed_posts().union(current_user.activities).order_by(Activity.created_at.desc())
-    pagination = activities_query.options(
+    # Attività proprie e degli utenti seguiti, paginate a cursore su (created_at, id)
+    followed_ids = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == current_user.id)
+    activities_query = Activity.query.filter(
+        (Activity.user_id == current_user.id) | Activity.user_id.in_(followed_ids)
+    ).options(
         joinedload(Activity.user_activity),
         joinedload(Activity.route_activity),
         joinedload(Activity.challenge)
-    ).paginate(page=page, per_page=10, error_out=False)
+    )
+    pagination = paginate_request(activities_query, (Activity.created_at, Activity.id), per_page=10)
     activities_on_page = pagination.items
+    attach_engagement(activities_on_page, current_user)
     # NUOVA RIGA in feed
     return render_template('feed.html', activities=activities_on_page, pagination=pagination, ActivityLike=ActivityLike, is_homepage=False)
 
@@ -299,8 +301,9 @@ def user_profile(user_id): # O user_profile(username) se usi l'username nella UR
     total_activities = user.activities.count()
     total_routes_created = user.routes.count()
     total_records_held = user.route_records.count()
-    followers_count = user.followers.count()
-    followed_count = user.followed.count()
+    counts = follow_counts([user.id])[user.id]
+    followers_count = counts['followers']
+    followed_count = counts['followed']
     user_activities = user.activities.order_by(Activity.created_at.desc()).limit(10).all()
 
     # Nuove query per le scommesse
@@ -486,9 +489,12 @@ def follow(username):
 
     # Commit delle modifiche (follow, notifiche)
     db.session.commit()
+
+    # Gli ultimi post e attività dell'utente seguito entrano nella timeline (in background)
+    on_follow(current_user, user_to_follow)
     
     # Questo onboarding step sembra legato al conteggio di chi l'utente corrente segue (followed)
-    if current_user.followed.count() >= 3: 
+    if len(followed_ids(current_user.id)) >= 3: 
         complete_onboarding_step(current_user, 'followed_users')
         
     flash(f'Ora segui {username}!', 'success')
@@ -512,6 +518,8 @@ def unfollow(username):
     # Rimuove la relazione di follow
     # Assumendo che current_user.unfollow(user_to_unfollow) gestisca la rimozione di Follow
     current_user.unfollow(user_to_unfollow)
+    # I suoi elementi escono subito dalla timeline, nella stessa transazione
+    on_unfollow(current_user, user_to_unfollow)
     
     # --- Potresti aggiungere qui logica per badge legati a "community management" ---
     # Ad esempio, un badge per chi smette di seguire troppe persone, o per chi mantiene una certa "netiquette" sociale.
@@ -524,15 +532,19 @@ def unfollow(username):
 @main.route('/explore/users')
 @login_required
 def explore_users():
-    page = request.args.get('page', 1, type=int)
     search_query = request.args.get('q', '')
     query = User.query
     if search_query:
         query = query.filter(User.username.ilike(f'%{search_query}%'))
     query = query.filter(User.id != current_user.id)
-    pagination = query.order_by(User.username.asc()).paginate(page=page, per_page=15, error_out=False)
+    pagination = paginate_request(query, (User.username, User.id), per_page=15, descending=False)
+    # Follow e contatori di tutta la pagina in blocco, invece di 3 query per card
+    page_user_ids = [user.id for user in pagination.items]
+    followed_on_page = following_among(current_user.id, page_user_ids)
+    counts = follow_counts(page_user_ids)
     # NUOVA RIGA in explore_users
-    return render_template('explore_users.html', users=pagination.items, pagination=pagination, search_query=search_query, is_homepage=False)
+    return render_template('explore_users.html', users=pagination.items, pagination=pagination, search_query=search_query,
+                           followed_on_page=followed_on_page, follow_counts=counts, is_homepage=False)
 
 # --- Route per Percorsi (Routes) ---
 
@@ -549,14 +561,12 @@ def create_route():
         if 'gpx_file' in request.files and request.files['gpx_file'].filename != '':
             gpx_file = request.files['gpx_file']
             try:
-                gpx_data = gpxpy.parse(gpx_file.stream)
-                points = [ [p.longitude, p.latitude] for t in gpx_data.tracks for s in t.segments for p in s.points ]
-                if points:
-                    coords_geojson_str = json.dumps({"type": "Feature", "geometry": {"type": "LineString", "coordinates": points}, "properties": {}})
-                    distance_km = gpx_data.length_3d() / 1000 if gpx_data.length_3d() else gpx_data.length_2d() / 1000
-                else:
-                    flash('Il file GPX non contiene dati di percorso validi.', 'danger')
-                    return redirect(url_for("main.create_route"))
+                parsed_file = read_track_file(gpx_file.stream)
+                coords_geojson_str = json.dumps(parsed_file.to_feature())
+                distance_km = parsed_file.distance_km
+            except TrackFileError:
+                flash('Il file GPX non contiene dati di percorso validi.', 'danger')
+                return redirect(url_for("main.create_route"))
             except Exception as e:
                 flash(f'Errore nella lettura del file GPX: {e}', 'danger')
                 return redirect(url_for("main.create_route"))
@@ -566,8 +576,7 @@ def create_route():
             try:
                 geojson_obj = json.loads(coords_geojson_str)
                 line_coords = geojson_obj['geometry']['coordinates']
-                total_distance_meters = sum(calculate_distance_meters(line_coords[i][1], line_coords[i][0], line_coords[i+1][1], line_coords[i+1][0]) for i in range(len(line_coords) - 1))
-                distance_km = total_distance_meters / 1000.0
+                distance_km = coords_length_km(line_coords)
             except (json.JSONDecodeError, KeyError, IndexError) as e:
                 distance_km = None
 
@@ -619,6 +628,9 @@ def route_detail(route_id):
             
             # Verifica che la struttura GeoJSON sia corretta
             if 'geometry' in geojson_obj and 'coordinates' in geojson_obj['geometry']:
+                # Livello di dettaglio richiesto con ?zoom= o ?tolerance= (default: completo)
+                tolerance = requested_tolerance(request.args, route.centroid_lat)
+                geojson_obj = with_coordinates(geojson_obj, route.coordinates_for_tolerance(tolerance))
                 route_geojson_data = json.dumps(geojson_obj)
                 print("✅ GeoJSON creato correttamente")
             else:
@@ -637,16 +649,13 @@ def route_detail(route_id):
         Challenge.end_date >= datetime.utcnow()
     ).order_by(Challenge.start_date).all()
 
-    # Query per le attività top
-    top_5_activities_for_route = db.session.query(
-        Activity, User
-    ).join(
-        User, Activity.user_id == User.id
-    ).filter(
-        Activity.route_id == route_id
-    ).order_by(
-        Activity.duration.asc()
-    ).limit(5).all()
+    # Top 5 (miglior tempo di ciascun utente) dalla classifica del percorso
+    route_ranking = get_route_leaderboards([route.id], limit=5, include_record=False)[route.id]
+    top_5_activities_for_route = [(activity, activity.user_activity) for activity in route_ranking.top]
+    # Posizione dell'utente nella classifica materializzata del tipo di attività del percorso
+    my_standing = None
+    if current_user.is_authenticated:
+        my_standing = get_user_standing(route.id, route.activity_type, current_user.id)
 
     # Prepara i dati per i commenti con like info
     comments_with_like_info = []
@@ -683,6 +692,7 @@ def route_detail(route_id):
         route_geojson_data=route_geojson_data,
         challenges_for_route=challenges_for_route,
         top_5_activities_for_route=top_5_activities_for_route,
+        my_standing=my_standing,
         comments_with_like_info=comments_with_like_info
     )
 
@@ -910,144 +920,21 @@ def record_activity():
             flash('Nessun file GPX selezionato.', 'danger')
             return redirect(url_for('main.record_activity', **redirect_params))
         
-        try:
-            gpx = gpxpy.parse(gpx_file.stream)
-            
-            activity_duration_seconds = gpx.get_duration() or 0
-            activity_distance_meters = gpx.length_3d() if gpx.length_3d() else gpx.length_2d()
-            activity_distance_km = activity_distance_meters / 1000.0
-            activity_avg_speed = activity_distance_km / (activity_duration_seconds / 3600.0) if activity_duration_seconds > 0 else 0.0
-            
-            activity_geojson_coords_raw = [(p.longitude, p.latitude) for t in gpx.tracks for s in t.segments for p in s.points]
-            
-            if not activity_geojson_coords_raw:
-                flash('Il file GPX non contiene dati di percorso validi.', 'danger')
-                return redirect(url_for('main.record_activity', **redirect_params))
-
-         
-            # --- VALIDAZIONE DELLA DISTANZA ---
-            expected_distance = Decimal(str(target_route.distance_km)) if target_route.distance_km is not None else Decimal(0)
-            actual_distance = Decimal(str(activity_distance_km))
-          
-
-            distance_tolerance_percent = Decimal('0.05')
-            is_valid_distance = False
-            if expected_distance > 0:
-                lower_bound = expected_distance * (1 - distance_tolerance_percent)
-                upper_bound = expected_distance * (1 + distance_tolerance_percent)
-               
-                if lower_bound <= actual_distance <= upper_bound:
-                    is_valid_distance = True
-            elif actual_distance == 0 and expected_distance == 0:
-                 is_valid_distance = True
-
-            if not is_valid_distance:
-               
-                flash(f'La distanza dell\'attività non corrisponde al percorso selezionato (Prevista: ~{expected_distance:.2f} km, Registrata: {actual_distance:.2f} km).', 'danger')
-                return redirect(url_for('main.record_activity', **redirect_params))
-            
-    
-            
-            # --- VALIDAZIONE GEOFENCING ---
-            try:
-                ref_route_geojson_obj = json.loads(target_route.coordinates)
-                ref_route_coords_shapely = [(p[0], p[1]) for p in ref_route_geojson_obj['geometry']['coordinates']]
-                geofence_buffer_meters = 50 
-                geofence_polygon = create_geojson_linestring_buffer(ref_route_coords_shapely, geofence_buffer_meters)
-
-                if geofence_polygon:
-                    points_inside_geofence = sum(1 for lon, lat in activity_geojson_coords_raw if geofence_polygon.contains(Point(lon, lat)))
-                    total_activity_points = len(activity_geojson_coords_raw)
-
-                    if total_activity_points > 0:
-                        geofence_match_threshold = 0.80
-                        match_percentage = points_inside_geofence / total_activity_points
-                      
-                        
-                        if match_percentage < geofence_match_threshold:
-                            print("--- DEBUG: !!! VALIDAZIONE GEOFENCING FALLITA !!! ---")
-                            flash(f'Il tracciato non segue abbastanza il percorso ({match_percentage:.0%} di corrispondenza).', 'danger')
-                            return redirect(url_for('main.record_activity', **redirect_params))
-                        
-                        print("--- DEBUG: Validazione geofencing SUPERATA. ---")
-                    else:
-                        flash('Nessun punto GPS nel file di attività per la validazione.', 'danger')
-                        return redirect(url_for('main.record_activity', **redirect_params))
-                else:
-                    flash('Errore nella creazione del geofence per il percorso.', 'danger')
-                    return redirect(url_for('main.record_activity', **redirect_params))
-            except Exception as e:
-                print(f"--- DEBUG: !!! ERRORE CRITICO DURANTE GEOFENCING: {e} !!! ---")
-                flash(f'Errore durante la validazione geofencing: {e}', 'danger')
-                return redirect(url_for('main.record_activity', **redirect_params))
+        # L'elaborazione del file (lettura, validazioni, record e badge) avviene nel worker:
+        # la richiesta accoda il job e risponde subito, indipendentemente dalla dimensione del file.
+        job = enqueue_activity_upload(current_user, target_route, target_challenge, activity_type, gpx_file)
+        status_url = url_for('api.job_status', job_id=job.id)
 
-            print("--- DEBUG: Tutte le validazioni superate. Procedo al salvataggio. ---")
-            
-            activity_gps_track_geojson = json.dumps({"type": "Feature", "geometry": {"type": "LineString", "coordinates": [[p[0], p[1]] for p in activity_geojson_coords_raw]}, "properties": {}})
-
-            new_activity = Activity(
-                user_id=current_user.id, route_id=target_route.id,
-                challenge_id=target_challenge.id if target_challenge else None,
-                activity_type=activity_type, gps_track=activity_gps_track_geojson,
-                duration=int(activity_duration_seconds), avg_speed=float(activity_avg_speed),
-                distance=float(activity_distance_km)
-            )
-            db.session.add(new_activity)
-            add_prestige(current_user, 'new_activity')
-            db.session.commit()
-
-            current_record = RouteRecord.query.filter_by(route_id=target_route.id, activity_type=activity_type).order_by(RouteRecord.duration.asc()).first()
-            # --- MODIFICA QUESTO BLOCCO ---
-            if not current_record or new_activity.duration < current_record.duration:
-                if current_record:
-                    # Se c'era un record precedente, lo rimuoviamo
-                    db.session.delete(current_record)
-                
-                # Creiamo il nuovo record
-                new_record = RouteRecord(
-                    route_id=target_route.id, 
-                    user_id=current_user.id, 
-                    activity_id=new_activity.id, 
-                    activity_type=activity_type, 
-                    duration=new_activity.duration
-                )
-                db.session.add(new_record)
-                
-                # --- NUOVO CODICE AGGIUNTO QUI ---
-                # Creiamo un post automatico per celebrare il nuovo record!
-                record_post_content = (
-                    f"🏆 Nuovo Record! {current_user.username} ha conquistato il percorso '{target_route.name}' "
-                    f"con un tempo eccezionale di {datetime.utcfromtimestamp(new_activity.duration).strftime('%H:%M:%S')}!"
-                )
-
-                record_post = Post(
-                    user_id=current_user.id, # Il post è attribuito all'utente che ha fatto il record
-                    content=record_post_content,
-                    post_category='system_record', # La nostra nuova categoria speciale!
-                    post_type='text' # È un post di solo testo
-                )
-                db.session.add(record_post)
-                add_prestige(current_user, 'new_record')
-                db.session.commit()
-                award_badge_if_earned(current_user, "Re/Regina del Percorso")
-            
-            if Activity.query.filter_by(user_id=current_user.id).count() == 1:
-                award_badge_if_earned(current_user, "Prima Attività")
-             # --- NUOVA GESTIONE PER IL BADGE "Hai percorso più di 10km" ---
-            # Controlla se l'attività appena registrata supera i 10km
-            if new_activity.distance > 10.0:
-                # Chiama la funzione per assegnare il badge "Hai percorso più di 10km"
-                # La funzione award_badge_if_earned si occuperà di verificare se l'utente ha già il badge
-                award_badge_if_earned(current_user, "Hai percorso più di 10km")
-            # --- FINE NUOVA GESTIONE ---
-
-            flash('Attività registrata con successo!', 'success')
-            return redirect(url_for('main.index'))
+        if request.accept_mimetypes.best == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({
+                'status': 'accepted',
+                'job_id': job.id,
+                'job_status': job.status,
+                'status_url': status_url
+            }), 202, {'Location': status_url}
 
-        except Exception as e:
-            print(f"--- DEBUG: !!! ERRORE CRITICO NEL TRY PRINCIPALE: {e} !!! ---")
-            flash(f'Errore imprevisto durante l\'elaborazione del file GPX: {e}', 'danger')
-            return redirect(url_for('main.record_activity', **redirect_params))
+        flash('File ricevuto! Stiamo elaborando la tua attività.', 'info')
+        return redirect(url_for('main.job_detail', job_id=job.id))
 
     # --- Logica GET ---
     pre_selected_route_id = request.args.get('route_id', type=int)
@@ -1063,6 +950,19 @@ def record_activity():
                            is_homepage=False)
 
 
+@main.route("/jobs/<int:job_id>")
+@login_required
+def job_detail(job_id):
+    """Pagina di attesa per un'elaborazione in background (es. upload di un'attività)."""
+    job = Job.query.get_or_404(job_id)
+    if job.user_id != current_user.id and not current_user.is_admin:
+        flash('Non hai il permesso di vedere questa elaborazione.', 'danger')
+        return redirect(url_for('main.index'))
+    return render_template('job_status.html', job=job,
+                           status_url=url_for('api.job_status', job_id=job.id),
+                           is_homepage=False)
+
+
 
 def parse_gps_to_geojson(gps_data_string):
     """
@@ -1077,6 +977,13 @@ def parse_gps_to_geojson(gps_data_string):
     - Lista di Liste [[lon, lat]]
     - Lista Vuota []
     """
+    if gps_data_string is None:
+        return None
+
+    # Tracce salvate nel formato binario compatto: sono già decodificate in array
+    if isinstance(gps_data_string, Track):
+        return gps_data_string.to_geojson()
+
     if not gps_data_string:
         return None
 
@@ -1134,17 +1041,24 @@ def activity_detail(activity_id):
     activity = Activity.query.get_or_404(activity_id)
 
     
+    # Livello di dettaglio richiesto con ?zoom= o ?tolerance= (default: completo)
+    reference_lat = activity.route_activity.centroid_lat if activity.route_activity else activity.last_latitude
+    tolerance = requested_tolerance(request.args, reference_lat)
+
     # --- GESTIONE GEOJSON DEL PERCORSO ---
     route_geojson_data = None
     if activity.route_activity and activity.route_activity.coordinates:
         try:
-            route_geojson_data = json.loads(activity.route_activity.coordinates)
+            route_geojson_data = with_coordinates(
+                json.loads(activity.route_activity.coordinates),
+                activity.route_activity.coordinates_for_tolerance(tolerance)
+            )
         except Exception as e:
             print(f"Error parsing route coordinates: {e}")
     
     # --- GESTIONE GEOJSON DELL'ATTIVITÀ ---
     print("Parsing activity GPS track...")
-    activity_geojson_data = parse_gps_to_geojson(activity.gps_track)
+    activity_geojson_data = parse_gps_to_geojson(activity.track_for_tolerance(tolerance))
     
     if activity_geojson_data:
         print(f"Successfully parsed GPS track. Coordinates count: {len(activity_geojson_data['coordinates'])}")
@@ -1169,8 +1083,8 @@ def activity_detail(activity_id):
 
 @main.route("/activities")
 def all_activities():
-    page = request.args.get('page', 1, type=int)
-    pagination = Activity.query.options(joinedload(Activity.user_activity), joinedload(Activity.route_activity), joinedload(Activity.challenge)).order_by(Activity.created_at.desc()).paginate(page=page, per_page=10, error_out=False)
+    activities_query = Activity.query.options(joinedload(Activity.user_activity), joinedload(Activity.route_activity), joinedload(Activity.challenge))
+    pagination = paginate_request(activities_query, (Activity.created_at, Activity.id), per_page=10)
     # NUOVA RIGA in all_activities
     return render_template("all_activities.html", activities=pagination.items, pagination=pagination, is_homepage=False)
 
@@ -1214,9 +1128,10 @@ def challenges_list():
     ).order_by(Challenge.created_at.desc()).all()
 
     # 4. Recupera lo storico
-    finished_challenges_pag = Challenge.query.options(joinedload(Challenge.route_info)).filter(
-        Challenge.end_date < now
-    ).order_by(Challenge.end_date.desc()).paginate(page=request.args.get('page', 1, type=int), per_page=10, error_out=False)
+    finished_challenges_pag = paginate_request(
+        Challenge.query.options(joinedload(Challenge.route_info)).filter(Challenge.end_date < now),
+        (Challenge.end_date, Challenge.id), per_page=10
+    )
 
     return render_template("challenges_list.html", 
                            active_challenges=active_challenges, 
@@ -1298,9 +1213,10 @@ def leaderboard_most_routes():
 @main.route('/notifications')
 @login_required
 def notifications():
-    """Notifiche con conteggio non lette"""
-    user_notifications = current_user.notifications.order_by(Notification.timestamp.desc()).all()
-    unread_count = Notification.query.filter_by(recipient_id=current_user.id, read=False).count()
+    """Notifiche con conteggio non lette, paginate a cursore su (timestamp, id)"""
+    pagination = paginate_request(current_user.notifications, (Notification.timestamp, Notification.id), per_page=30)
+    user_notifications = pagination.items
+    unread_count = current_user.unread_notifications
     
     notification_messages = []
     
@@ -1428,14 +1344,13 @@ def notifications():
             'id': n.id
         })
 
-    # Segna le notifiche come lette
-    unread_notifications = current_user.notifications.filter_by(read=False).all()
-    for n in unread_notifications:
-        n.read = True
+    # Segna come lette solo le notifiche di questa pagina (un solo UPDATE)
+    mark_notifications_read(current_user, [n.id for n in user_notifications])
     db.session.commit()
 
     return render_template('notifications.html', 
                          notifications=notification_messages, 
+                         pagination=pagination,
                          unread_count=unread_count,
                          is_homepage=False)
 
@@ -1601,14 +1516,15 @@ def save_live_activity():
         
         # Prepara i dati
         positions = data.get('positions', [])
-        gps_track = json.dumps(positions) if positions else '[]'
-        distance = data.get('distance', 0) or 0.1  # Evita 0.0
-        duration = data.get('duration', 0) or 1    # Evita 0 (in secondi)
+        gps_track = Track.from_points(positions)
+
+        # Statistiche calcolate dalla traccia; i valori del client restano come fallback
+        stats = track_stats(gps_track)
+        distance = stats.distance_km or data.get('distance', 0) or 0.1  # Evita 0.0
+        duration = stats.duration or data.get('duration', 0) or 1      # Evita 0 (in secondi)
         
         # CALCOLA avg_speed (km/h)
-        # velocità = distanza / tempo (in ore)
-        hours = duration / 3600  # secondi → ore
-        avg_speed = distance / hours if hours > 0 else 0
+        avg_speed = average_speed(distance, duration)
         
         # Crea nuova attività con TUTTI i campi obbligatori
         new_activity = Activity(
@@ -1725,15 +1641,14 @@ def debug_my_invitations():
 @login_required
 def finished_challenges():
     """Pagina dedicata alle sfide terminate, con il vincitore pre-calcolato."""
-    page = request.args.get('page', 1, type=int)
     now = datetime.utcnow()
     
     # Query di base per le sfide terminate
     finished_challenges_query = Challenge.query.filter(
         Challenge.end_date < now
-    ).order_by(Challenge.end_date.desc())
+    )
     
-    pagination = finished_challenges_query.paginate(page=page, per_page=10, error_out=False)
+    pagination = paginate_request(finished_challenges_query, (Challenge.end_date, Challenge.id), per_page=10)
     
     # --- NUOVA LOGICA: TROVA IL VINCITORE PER OGNI SFIDA ---
     challenges_with_winners = []
@@ -1831,8 +1746,8 @@ def mark_bet_paid(bet_id):
 def clear_all_notifications():
     """Segna tutte le notifiche come lette"""
     try:
-        # Marca tutte come lette
-        Notification.query.filter_by(recipient_id=current_user.id, read=False).update({'read': True})
+        # Marca tutte come lette e azzera il contatore
+        mark_notifications_read(current_user)
         db.session.commit()
         flash('✅ Tutte le notifiche sono state marcate come lette!', 'success')
     except Exception as e:
@@ -2248,6 +2163,7 @@ def add_comment_to_post(post_id):
         parent_id=parent_id
     )
     db.session.add(new_comment)
+    bump_counter(Post, post_id, 'comment_count', 1)
     db.session.commit()
     flash('Commento aggiunto!', 'success')
     return redirect(url_for('main.post_detail', post_id=post_id))
@@ -2260,18 +2176,20 @@ def toggle_post_like(post_id):
     
     if like:
         db.session.delete(like)
+        bump_counter(Post, post_id, 'like_count', -1)
         action = 'unliked'
     else:
         new_like = PostLike(user_id=current_user.id, post_id=post_id)
         db.session.add(new_like)
+        bump_counter(Post, post_id, 'like_count', 1)
         action = 'liked'
         if post.user_id != current_user.id:
             add_prestige(post.user, 'receive_like')
         
     db.session.commit()
     
-    # Restituisce il conteggio usando il metodo .count() di SQLAlchemy
-    return jsonify({'status': 'success', 'action': action, 'new_like_count': post.likes.count()})
+    # Il contatore viene riletto dal DB dopo il commit (UPDATE atomico)
+    return jsonify({'status': 'success', 'action': action, 'new_like_count': post.like_count})
 
 
 @main.route('/api/post/<int:post_id>/comment/<int:parent_comment_id>/reply', methods=['POST'])
@@ -2297,6 +2215,7 @@ def reply_to_comment_ajax(post_id, parent_comment_id):
         content=processed_content
     )
     db.session.add(reply)
+    bump_counter(Post, post.id, 'comment_count', 1)
     add_prestige(current_user, 'new_comment')
 
     # Notifica all'autore del commento
@@ -2334,23 +2253,26 @@ def reply_to_comment_ajax(post_id, parent_comment_id):
         'status': 'success',
         'message': 'Risposta aggiunta!',
         'comment_html': reply_html,
-        'new_comment_count': post.comments.count()
+        'new_comment_count': post.comment_count
     })
 
 
 
 @main.route('/api/feed')
 def api_feed():
-    page = request.args.get('page', 1, type=int)
-    # Passiamo 'current_user' anche qui
-    items, has_next = get_unified_feed_items(user=current_user, page=page, per_page=5)
-    items, has_next = get_unified_feed_items(page=page, per_page=5)
+    cursor = request.args.get('cursor') or None
+    # Passiamo 'current_user' anche qui: timeline personale se loggato, feed pubblico altrimenti
+    try:
+        items, next_cursor = get_unified_feed_items(user=current_user, cursor=cursor, per_page=5)
+    except InvalidCursor:
+        return jsonify({'error': 'Cursore non valido'}), 400
     
     items_html = render_template('partials/_feed_posts_chunk.html', items=items)
     
     return jsonify({
         'html': items_html,
-        'has_next_page': has_next
+        'has_next_page': next_cursor is not None,
+        'next_cursor': next_cursor
     })
 
 # TEST #####################################################################################################################################
@@ -2729,75 +2651,38 @@ def upload_gpx():
             flash('Nessun file selezionato.', 'warning')
             return redirect(url_for('main.upload_gpx'))
             
-        if file and file.filename.lower().endswith('.gpx'):
+        if file and file.filename.lower().endswith(('.gpx', '.tcx')):
             filename = secure_filename(file.filename)
             try:
-                gpx = gpxpy.parse(file.stream)
-                
-                points = []
-                points_count = 0
-                distance_km = 0.0
-                duration_sec = 0
-
-                if gpx.tracks and gpx.tracks[0].segments:
-                    track_segment = gpx.tracks[0].segments[0] 
-                    if track_segment.points:
-                        points = [{'lat': p.latitude, 'lon': p.longitude} for p in track_segment.points]
-                        points_count = len(points)
-                        
-                        distance_km = 0.0 # Default
-                        try:
-                            if gpx.length_3d():
-                                distance_km = gpx.length_3d() / 1000.0
-                            elif gpx.length_2d():
-                                distance_km = gpx.length_2d() / 1000.0
-                        except Exception as dist_e:
-                            print(f"Errore nel calcolo della distanza GPX: {dist_e}")
-                            distance_km = 0.0 # Fallback a 0 se c'è un problema
-
-                        start_time = None
-                        end_time = None
-                        
-                        if track_segment.points:
-                            for p in track_segment.points:
-                                if p.time:
-                                    start_time = p.time
-                                    break
-                            for p in reversed(track_segment.points):
-                                if p.time:
-                                    end_time = p.time
-                                    break
-                        
-                        if start_time and end_time:
-                            duration_sec = (end_time - start_time).total_seconds()
-                        elif gpx.get_time_first() and gpx.get_time_last():
-                            duration_sec = (gpx.get_time_last() - gpx.get_time_first()).total_seconds()
-                        
-                        gpx_points_json = json.dumps(points)
-                        
-                        return render_template('upload_gpx_confirm.html', 
-                                               filename=filename,
-                                               points_count=points_count,
-                                               distance_km=distance_km,
-                                               duration_sec=duration_sec,
-                                               gpx_points_json=gpx_points_json,
-                                               # NON passare 'name' o 'description' qui
-                                               )
-
-                    else:
-                        flash('Il segmento GPX non contiene punti di tracciato validi.', 'danger')
-                        return redirect(url_for('main.upload_gpx'))
-                else:
-                    flash('Il file GPX non contiene tracce o segmenti validi.', 'danger')
-                    return redirect(url_for('main.upload_gpx'))
-            
-            # --- MANTIENI SOLO L'ECCEZIONE GENERICA PER GLI ERRORI ---
+                parsed_file = read_track_file(file.stream)
+            except TrackFileError:
+                flash('Il file GPX non contiene tracce o segmenti validi.', 'danger')
+                return redirect(url_for('main.upload_gpx'))
             except Exception as e: # Cattura tutti gli errori generici durante il parsing/elaborazione GPX
                 flash(f'Errore durante l\'elaborazione del file GPX: {e}', 'danger')
                 print(f"Errore generico upload_gpx: {e}") # Log dell'errore sul server
                 return redirect(url_for('main.upload_gpx'))
+
+            # Punti per la pagina di conferma (con tempi e quote se presenti in tutto il file)
+            points = []
+            for point in parsed_file.track.to_points():
+                item = {'lat': point['latitude'], 'lon': point['longitude']}
+                if 'timestamp' in point:
+                    item['time'] = point['timestamp']
+                if 'altitude' in point:
+                    item['ele'] = point['altitude']
+                points.append(item)
+
+            return render_template('upload_gpx_confirm.html', 
+                                   filename=filename,
+                                   points_count=parsed_file.point_count,
+                                   distance_km=parsed_file.distance_km,
+                                   duration_sec=parsed_file.duration,
+                                   gpx_points_json=json.dumps(points),
+                                   # NON passare 'name' o 'description' qui
+                                   )
         else:
-            flash('Formato file non valido. Si prega di caricare un file .gpx.', 'warning')
+            flash('Formato file non valido. Si prega di caricare un file .gpx o .tcx.', 'warning')
             return redirect(url_for('main.upload_gpx'))
             
     # Se è una richiesta GET, mostra semplicemente il form di upload
@@ -2912,6 +2797,12 @@ def save_gpx_item():
         user_id = current_user.id
         
         if item_type == 'activity':
+            # Le statistiche si ricalcolano dalla traccia: i valori del form restano solo come fallback
+            gps_track = Track.from_json(points_json)  # Salvata nel formato binario compatto
+            stats = track_stats(gps_track)
+            distance_km = stats.distance_km or distance_km
+            duration_sec = stats.duration or duration_sec
+
             # Crea una nuova Attività
             new_activity = Activity(
                 user_id=user_id,
@@ -2919,10 +2810,10 @@ def save_gpx_item():
                 name=name,
                 description=description or "",
                 activity_type=activity_type,
-                gps_track=points_json,  # Mantieni originale per Activity
+                gps_track=gps_track,
                 distance=distance_km,
                 duration=duration_sec,
-                avg_speed= (distance_km / (duration_sec / 3600.0)) if duration_sec > 0 else 0.0
+                avg_speed=average_speed(distance_km, duration_sec)
             )
             db.session.add(new_activity)
             db.session.commit()
@@ -2978,10 +2869,12 @@ def like_activity(activity_id):
     like = ActivityLike.query.filter_by(user_id=current_user.id, activity_id=activity_id).first()
     if like:
         db.session.delete(like)
+        bump_counter(Activity, activity_id, 'like_count', -1)
         action = 'unliked'
     else:
         new_like = ActivityLike(user_id=current_user.id, activity_id=activity_id)
         db.session.add(new_like)
+        bump_counter(Activity, activity_id, 'like_count', 1)
         action = 'liked'
 
     db.session.commit()
@@ -2989,7 +2882,7 @@ def like_activity(activity_id):
     return jsonify({
         'status': 'success',
         'action': action,
-        'likes_count': activity.likes.count()
+        'likes_count': activity.like_count
     })
 
 
@@ -3005,13 +2898,8 @@ def tag_search(tag_name):
     # Accediamo ai post tramite la relazione di backref e li ordiniamo
     posts = tag.posts.order_by(Post.created_at.desc()).all()
     
-    # Arricchiamo i post con le info sui like (codice che già conosci)
-    if current_user.is_authenticated:
-        post_ids = [p.id for p in posts]
-        if post_ids:
-            liked_post_ids = {like.post_id for like in PostLike.query.filter(PostLike.user_id == current_user.id, PostLike.post_id.in_(post_ids)).all()}
-            for post in posts:
-                post.current_user_liked = post.id in liked_post_ids
+    # Arricchiamo i post con le info sui like (conteggi e like dell'utente in una query)
+    attach_engagement(posts, current_user)
     
     return render_template('tag_search.html', tag=tag, posts=posts, is_homepage=False)
 
@@ -3054,12 +2942,15 @@ def delete_post_comment(comment_id):
         
     post = comment.post # Salva il post di riferimento prima di eliminare
     db.session.delete(comment)
+    db.session.flush()
+    # Le risposte vengono eliminate a cascata: riallineiamo il contatore con un unico UPDATE
+    recount_post_comments(post.id)
     db.session.commit()
     
     return jsonify({
         'status': 'success', 
         'message': 'Commento eliminato',
-        'new_comment_count': post.comments.count()
+        'new_comment_count': post.comment_count
     })
 
 
@@ -3139,9 +3030,25 @@ def featured_routes():
     """
     LIMIT = 6
     routes = []
-    
+
+    # 0. Se il client invia la sua posizione, usa prima i percorsi vicini
+    #    (range query sul centroide salvato, niente parsing del GeoJSON).
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is not None and lon is not None:
+        radius_km = request.args.get('radius_km', 25, type=float)
+        delta_lat = radius_km / 111.0
+        delta_lon = radius_km / (111.0 * max(abs(cos(radians(lat))), 0.01))
+        nearby_query = Route.query.filter(
+            Route.centroid_lat.between(lat - delta_lat, lat + delta_lat),
+            Route.centroid_lon.between(lon - delta_lon, lon + delta_lon)
+        )
+        routes = nearby_query.filter_by(is_featured=True).order_by(Route.created_at.desc()).limit(LIMIT).all()
+        if not routes:
+            routes = nearby_query.order_by(Route.created_at.desc()).limit(LIMIT).all()
+
     # 1. Prova a trovare percorsi IN EVIDENZA nella città dell'utente
-    if current_user.is_authenticated and current_user.city:
+    if not routes and current_user.is_authenticated and current_user.city:
         routes = Route.query.filter_by(
             is_featured=True, 
             classic_city=current_user.city
@@ -3182,32 +3089,27 @@ def featured_routes():
 def suggested_users():
     """
     API che restituisce una lista di utenti suggeriti.
-    Logica attuale: i 5 utenti con più attività registrate.
+    Per gli utenti loggati legge i suggerimenti precalcolati dal worker
+    (amici degli amici, gruppi, percorsi e città in comune, vedi suggestions.py),
+    per i visitatori gli utenti più attivi.
     """
-    # Escludiamo l'utente corrente dalla lista dei suggerimenti, se loggato
-    query = db.session.query(
-        User, func.count(Activity.id).label('activity_count')
-    ).join(
-        Activity
-    ).group_by(
-        User.id
-    )
-
-    if current_user.is_authenticated:
-        query = query.filter(User.id != current_user.id)
+    suggested = get_user_suggestions(current_user, limit=5)
 
-    suggested = query.order_by(
-        func.count(Activity.id).desc()
-    ).limit(5).all()
+    # Conteggio attività dei soli utenti mostrati (al massimo 5, su indice user_id)
+    shown_ids = [user.id for user, _ in suggested]
+    activity_counts = dict(db.session.query(Activity.user_id, func.count(Activity.id)).filter(
+        Activity.user_id.in_(shown_ids)
+    ).group_by(Activity.user_id).all()) if shown_ids else {}
 
     users_list = []
-    for user, activity_count in suggested:
+    for user, reason in suggested:
         users_list.append({
             'id': user.id,
             'username': user.username,
             'profile_image': url_for('main.uploaded_file', filename=f'profile_pics/{user.profile_image}'),
             'city': user.city,
-            'activity_count': activity_count,
+            'activity_count': activity_counts.get(user.id, 0),
+            'reason': reason,
             'url': url_for('main.user_profile', user_id=user.id)
         })
         
@@ -3227,14 +3129,12 @@ def propose_classic_route():
         if 'gpx_file' in request.files and request.files['gpx_file'].filename != '':
             gpx_file = request.files['gpx_file']
             try:
-                gpx_data = gpxpy.parse(gpx_file.stream)
-                points = [[p.longitude, p.latitude] for t in gpx_data.tracks for s in t.segments for p in s.points]
-                if points:
-                    coords_geojson_str = json.dumps({"type": "Feature", "geometry": {"type": "LineString", "coordinates": points}, "properties": {}})
-                    distance_km = gpx_data.length_3d() / 1000 if gpx_data.length_3d() else gpx_data.length_2d() / 1000
-                else:
-                    flash('Il file GPX non contiene dati di percorso validi.', 'danger')
-                    return redirect(url_for("main.propose_classic_route")) # Corretto redirect
+                parsed_file = read_track_file(gpx_file.stream)
+                coords_geojson_str = json.dumps(parsed_file.to_feature())
+                distance_km = parsed_file.distance_km
+            except TrackFileError:
+                flash('Il file GPX non contiene dati di percorso validi.', 'danger')
+                return redirect(url_for("main.propose_classic_route")) # Corretto redirect
             except Exception as e:
                 flash(f'Errore nella lettura del file GPX: {e}', 'danger')
                 return redirect(url_for("main.propose_classic_route")) # Corretto redirect
@@ -3245,8 +3145,7 @@ def propose_classic_route():
             try:
                 geojson_obj = json.loads(coords_geojson_str)
                 line_coords = geojson_obj['geometry']['coordinates']
-                total_distance_meters = sum(calculate_distance_meters(line_coords[i][1], line_coords[i][0], line_coords[i+1][1], line_coords[i+1][0]) for i in range(len(line_coords) - 1))
-                distance_km = total_distance_meters / 1000.0
+                distance_km = coords_length_km(line_coords)
             except (json.JSONDecodeError, KeyError, IndexError) as e:
                 distance_km = None # Lascia che sia il database a gestirlo se necessario
 
@@ -3346,9 +3245,7 @@ def group_detail(group_id):
     
     # La logica per i post del gruppo è corretta
     group_posts = group.posts.order_by(Post.created_at.desc()).all()
-    if current_user.is_authenticated:
-        for post in group_posts:
-            post.current_user_liked = post.likes.filter_by(user_id=current_user.id).first() is not None
+    attach_engagement(group_posts, current_user)
             
     # La logica per gli eventi è corretta
     now = datetime.utcnow()
@@ -3688,6 +3585,7 @@ def add_comment_to_post_ajax(post_id):
         content=processed_content
     )
     db.session.add(new_comment)
+    bump_counter(Post, post_id, 'comment_count', 1)
     add_prestige(current_user, 'new_comment')
 
     for user in mentioned_users:
@@ -3713,7 +3611,7 @@ def add_comment_to_post_ajax(post_id):
         'status': 'success',
         'message': 'Commento aggiunto!',
         'comment_html': comment_html,
-        'new_comment_count': post.comments.count()
+        'new_comment_count': post.comment_count
     })
 
 
@@ -3758,6 +3656,14 @@ def update_activity(activity_id):
     activity.name = new_name
     activity.description = new_description
 
+    # Attività salvate senza statistiche (es. vecchie importazioni): le ricalcoliamo dalla traccia
+    if not activity.distance or not activity.duration or not activity.avg_speed:
+        stats = track_stats(activity.gps_track)
+        if stats.distance_km:
+            activity.distance = activity.distance or stats.distance_km
+            activity.duration = activity.duration or stats.duration
+            activity.avg_speed = average_speed(activity.distance, activity.duration)
+
     try:
         db.session.commit()
         flash("Attività aggiornata con successo!", "success")
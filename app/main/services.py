@@ -1,74 +1,61 @@
-from flask_login import current_user
-from sqlalchemy import union_all, literal_column, or_
+from sqlalchemy import union_all, literal_column, or_, func, case
 from sqlalchemy.orm import joinedload
 from app import db
-from app.models import Post, Activity, PostLike, ActivityLike
+from app.models import Post, Activity, PostLike, PostComment, ActivityLike, Notification, User
+from app.pagination import keyset_paginate
+from .timeline import timeline_page
 
-def get_unified_feed_items(user=None, page=1, per_page=10):
+def get_unified_feed_items(user=None, cursor=None, per_page=10):
     """
-    Recupera un feed unificato e impaginato.
-    - Se l'utente è loggato (`user` viene passato), mostra un feed personalizzato.
+    Recupera un feed unificato e impaginato a cursore (vedi app/pagination.py).
+    - Se l'utente è loggato (`user` viene passato), mostra il feed personalizzato
+      letto dalla sua timeline materializzata (vedi timeline.py).
     - Se l'utente non è loggato (`user` è None), mostra il feed pubblico globale.
+
+    Ritorna (elementi, cursore della pagina successiva o None se è l'ultima).
+    Solleva InvalidCursor se `cursor` non è valido.
     """
     
     if user and user.is_authenticated:
         # --- FEED PERSONALIZZATO PER UTENTE LOGGATO ---
-        followed_user_ids = [u.id for u in user.followed]
-        joined_group_ids = [g.id for g in user.joined_groups]
-        special_categories = ['admin_announcement', 'weekly_tip', 'system_record', 'system_badge', 'system_new_classic']
-
-        posts_query = db.session.query(
-            Post.id.label('item_id'),
-            Post.created_at.label('timestamp'),
-            literal_column("'post'").label('item_type')
-        ).filter(
-            or_(
-                Post.user_id.in_(followed_user_ids),
-                Post.user_id == user.id,
-                Post.post_category.in_(special_categories)
-            ),
-            Post.group_id.is_(None)  # 👈 Escludi i post dei gruppi
-        )
+        # Un solo range scan su timeline_entries (user_id, ts): i follow sono già risolti in scrittura
+        feed_page = timeline_page(user.id, cursor=cursor, per_page=per_page)
+        return _load_feed_items(feed_page.items, user), feed_page.next_cursor
 
-        
-        activities_query = db.session.query(
-            Activity.id.label('item_id'),
-            Activity.created_at.label('timestamp'),
-            literal_column("'activity'").label('item_type')
-        ).filter(
-            or_(
-                Activity.user_id.in_(followed_user_ids),
-                Activity.user_id == user.id
-            )
-        )
-
-    else:
-        # --- FEED PUBBLICO PER VISITATORI ---
-        special_categories = ['admin_announcement', 'weekly_tip']
-         # Mostriamo gli annunci e i post pubblici (non di gruppo)
-        posts_query = db.session.query(
-            Post.id.label('item_id'),
-            Post.created_at.label('timestamp'),
-            literal_column("'post'").label('item_type')
-        ).filter(
-            Post.group_id.is_(None) # Escludi i post dei gruppi
-        )
-        
-        # Mostriamo tutte le attività
-        activities_query = db.session.query(
-            Activity.id.label('item_id'),
-            Activity.created_at.label('timestamp'),
-            literal_column("'activity'").label('item_type')
-        )
+    # --- FEED PUBBLICO PER VISITATORI ---
+    special_categories = ['admin_announcement', 'weekly_tip']
+     # Mostriamo gli annunci e i post pubblici (non di gruppo)
+    posts_query = db.session.query(
+        Post.id.label('item_id'),
+        Post.created_at.label('timestamp'),
+        literal_column("'post'", db.String).label('item_type')
+    ).filter(
+        Post.group_id.is_(None) # Escludi i post dei gruppi
+    )
+    
+    # Mostriamo tutte le attività
+    activities_query = db.session.query(
+        Activity.id.label('item_id'),
+        Activity.created_at.label('timestamp'),
+        literal_column("'activity'", db.String).label('item_type')
+    )
     
     # --- LOGICA COMUNE ---
     unified_query = union_all(posts_query, activities_query).alias('unified')
-    paginated_ids = db.session.query(unified_query).order_by(
-        unified_query.c.timestamp.desc()
-    ).paginate(page=page, per_page=per_page, error_out=False)
+    # Chiave univoca anche tra post e attività con lo stesso id e la stessa data
+    feed_page = keyset_paginate(
+        db.session.query(unified_query),
+        (unified_query.c.timestamp, unified_query.c.item_type, unified_query.c.item_id),
+        cursor=cursor, per_page=per_page
+    )
 
-    post_ids_to_fetch = [item.item_id for item in paginated_ids.items if item.item_type == 'post']
-    activity_ids_to_fetch = [item.item_id for item in paginated_ids.items if item.item_type == 'activity']
+    return _load_feed_items(feed_page.items, user), feed_page.next_cursor
+
+
+def _load_feed_items(feed_rows, user=None):
+    """Carica post e attività di una pagina di righe (item_type, item_id), nell'ordine dato."""
+    post_ids_to_fetch = [item.item_id for item in feed_rows if item.item_type == 'post']
+    activity_ids_to_fetch = [item.item_id for item in feed_rows if item.item_type == 'activity']
 
     posts = []
     if post_ids_to_fetch:
@@ -85,13 +72,139 @@ def get_unified_feed_items(user=None, page=1, per_page=10):
 
     items_map = {f'post_{p.id}': p for p in posts}
     items_map.update({f'activity_{a.id}': a for a in activities})
-    final_items = [items_map.get(f'{item.item_type}_{item.item_id}') for item in paginated_ids.items if items_map.get(f'{item.item_type}_{item.item_id}') is not None]
+    final_items = [items_map.get(f'{item.item_type}_{item.item_id}') for item in feed_rows if items_map.get(f'{item.item_type}_{item.item_id}') is not None]
 
-    if user and user.is_authenticated:
-        for item in final_items:
-            if isinstance(item, Post):
-                item.current_user_liked = PostLike.query.filter_by(user_id=user.id, post_id=item.id).first() is not None
-            elif isinstance(item, Activity):
-                item.current_user_liked = ActivityLike.query.filter_by(user_id=user.id, activity_id=item.id).first() is not None
+    attach_engagement(final_items, user)
     
-    return final_items, paginated_ids.has_next
\ No newline at end of file
+    return final_items
+
+
+def load_engagement(post_ids=(), activity_ids=(), viewer=None):
+    """
+    Carica i "mi piace" dell'utente corrente per una lista di post e di attività,
+    con una sola query per tipo. I conteggi si leggono dai contatori
+    denormalizzati (like_count), quindi per i visitatori non serve nessuna query.
+
+    Ritorna {'posts': set(post_id apprezzati), 'activities': set(activity_id apprezzati)}.
+    """
+    viewer_id = viewer.id if viewer is not None and viewer.is_authenticated else None
+
+    def liked_ids(like_model, fk_column, ids):
+        ids = list(set(ids))
+        if not ids or viewer_id is None:
+            return set()
+        rows = db.session.query(fk_column).filter(
+            fk_column.in_(ids), like_model.user_id == viewer_id
+        ).all()
+        return {item_id for (item_id,) in rows}
+
+    return {
+        'posts': liked_ids(PostLike, PostLike.post_id, post_ids),
+        'activities': liked_ids(ActivityLike, ActivityLike.activity_id, activity_ids),
+    }
+
+
+def attach_engagement(items, viewer=None):
+    """
+    Arricchisce post e attività con `current_user_liked`
+    usando load_engagement (numero di query costante per pagina).
+    """
+    items = [item for item in items if item is not None]
+    engagement = load_engagement(
+        post_ids=[item.id for item in items if isinstance(item, Post)],
+        activity_ids=[item.id for item in items if isinstance(item, Activity)],
+        viewer=viewer
+    )
+    for item in items:
+        bucket = engagement['posts'] if isinstance(item, Post) else engagement['activities']
+        item.current_user_liked = item.id in bucket
+    return engagement
+
+
+def bump_counter(model, object_id, column_name, delta=1):
+    """
+    Incrementa (o decrementa) un contatore denormalizzato con un UPDATE atomico
+    (SET x = x + delta), senza leggere il valore corrente: niente race condition
+    tra richieste concorrenti. Non scende mai sotto zero.
+    """
+    column = getattr(model, column_name)
+    query = db.session.query(model).filter(model.id == object_id)
+    if delta < 0:
+        query = query.filter(column >= -delta)
+    query.update({column: column + delta}, synchronize_session=False)
+
+
+def recount_post_comments(post_id):
+    """Riallinea comment_count di un post (es. dopo l'eliminazione di un thread)."""
+    count_subquery = db.session.query(func.count(PostComment.id)).filter(
+        PostComment.post_id == post_id
+    ).scalar_subquery()
+    db.session.query(Post).filter(Post.id == post_id).update(
+        {Post.comment_count: count_subquery}, synchronize_session=False
+    )
+
+
+def reconcile_engagement_counters():
+    """
+    Ricalcola in blocco like_count/comment_count di post e attività
+    a partire dalle tabelle dei like e dei commenti. Ritorna le righe aggiornate.
+    """
+    post_likes = db.session.query(func.count(PostLike.id)).filter(
+        PostLike.post_id == Post.id
+    ).scalar_subquery()
+    post_comments = db.session.query(func.count(PostComment.id)).filter(
+        PostComment.post_id == Post.id
+    ).scalar_subquery()
+    activity_likes = db.session.query(func.count(ActivityLike.id)).filter(
+        ActivityLike.activity_id == Activity.id
+    ).scalar_subquery()
+
+    updated_posts = db.session.query(Post).filter(
+        or_(Post.like_count != post_likes, Post.comment_count != post_comments)
+    ).update(
+        {Post.like_count: post_likes, Post.comment_count: post_comments},
+        synchronize_session=False
+    )
+    updated_activities = db.session.query(Activity).filter(
+        Activity.like_count != activity_likes
+    ).update({Activity.like_count: activity_likes}, synchronize_session=False)
+    db.session.commit()
+    return updated_posts, updated_activities
+
+
+def mark_notifications_read(user, notification_ids=None):
+    """
+    Segna come lette le notifiche dell'utente (solo `notification_ids`, se
+    indicati; tutte con None) con un solo UPDATE e
+    scala il contatore denormalizzato delle righe aggiornate (gli UPDATE in
+    blocco non passano dagli eventi di Notification): le notifiche arrivate
+    nel frattempo restano contate. Ritorna il numero di notifiche aggiornate.
+    """
+    query = Notification.query.filter_by(recipient_id=user.id, read=False)
+    if notification_ids is not None:
+        if not notification_ids:
+            return 0
+        query = query.filter(Notification.id.in_(notification_ids))
+    updated = query.update({Notification.read: True}, synchronize_session=False)
+    if updated:
+        db.session.query(User).filter(User.id == user.id).update({
+            User.unread_notifications: case(
+                (User.unread_notifications >= updated, User.unread_notifications - updated), else_=0
+            )
+        }, synchronize_session=False)
+    return updated
+
+
+def reconcile_unread_notifications():
+    """
+    Riallinea User.unread_notifications al numero reale di notifiche non
+    lette (job periodico). Ritorna gli utenti corretti.
+    """
+    unread = db.session.query(func.count(Notification.id)).filter(
+        Notification.recipient_id == User.id, Notification.read.is_(False)
+    ).scalar_subquery()
+    updated = db.session.query(User).filter(User.unread_notifications != unread).update(
+        {User.unread_notifications: unread}, synchronize_session=False
+    )
+    db.session.commit()
+    return updated
@@ -0,0 +1,275 @@
+# File: app/main/suggestions.py
+"""
+Suggerimenti "chi seguire" precalcolati (tabella user_suggestions).
+
+Il worker ricalcola periodicamente, per ogni utente, i candidati con più
+segnali in comune:
+- follow in comune (amici degli amici): utenti seguiti da chi seguo;
+- gruppi in comune;
+- percorsi in comune (dalle classifiche materializzate RouteLeaderboards);
+- stessa città.
+I candidati già seguiti sono esclusi, i primi SUGGESTIONS_PER_USER per
+punteggio vengono salvati in ordine. Se i segnali non bastano (utente
+nuovo) si completa con gli utenti più attivi.
+
+/api/suggested_users legge solo le righe dell'utente per chiave primaria
+(user_id, position); i visitatori e chi non ha ancora suggerimenti ricevono
+gli utenti più attivi, tenuti in memoria per POPULAR_TTL secondi.
+"""
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased, joinedload
+
+from app import db
+from app.jobs import enqueue, job_handler, update_progress
+from app.models import Activity, Job, RouteLeaderboard, User, UserSuggestion, followers, group_members
+from app.follow_graph import followed_ids
+
+
+SUGGESTIONS_JOB_KIND = 'user_suggestions'
+REFRESH_INTERVAL_HOURS = 6
+
+SUGGESTIONS_PER_USER = 20
+# Candidati considerati per ciascun segnale
+CANDIDATES_PER_SIGNAL = 100
+REFRESH_BATCH_SIZE = 200
+
+# Peso di ogni segnale nel punteggio
+MUTUAL_WEIGHT = 3.0
+GROUP_WEIGHT = 2.0
+ROUTE_WEIGHT = 1.5
+CITY_WEIGHT = 1.0
+
+POPULAR_LIMIT = 50
+POPULAR_TTL = 600
+
+_popular_lock = threading.Lock()
+_popular_cache = {'expires_at': 0.0, 'ids': []}
+
+
+# =====================================================================
+# SEGNALI
+# =====================================================================
+
+def _mutual_follows(user_id):
+    """{candidato: quanti degli utenti che seguo lo seguono}."""
+    mine, theirs = followers.alias('mine'), followers.alias('theirs')
+    mutual = func.count().label('mutual')
+    rows = db.session.execute(
+        select(theirs.c.followed_id, mutual)
+        .join(theirs, theirs.c.follower_id == mine.c.followed_id)
+        .where(mine.c.follower_id == user_id, theirs.c.followed_id != user_id)
+        .group_by(theirs.c.followed_id)
+        .order_by(mutual.desc())
+        .limit(CANDIDATES_PER_SIGNAL)
+    )
+    return dict(rows.all())
+
+
+def _shared_groups(user_id):
+    """{candidato: numero di gruppi in comune}."""
+    mine, theirs = group_members.alias('mine'), group_members.alias('theirs')
+    shared = func.count().label('shared')
+    rows = db.session.execute(
+        select(theirs.c.user_id, shared)
+        .join(theirs, theirs.c.group_id == mine.c.group_id)
+        .where(mine.c.user_id == user_id, theirs.c.user_id != user_id)
+        .group_by(theirs.c.user_id)
+        .order_by(shared.desc())
+        .limit(CANDIDATES_PER_SIGNAL)
+    )
+    return dict(rows.all())
+
+
+def _shared_routes(user_id):
+    """{candidato: numero di percorsi su cui entrambi hanno un tempo in classifica}."""
+    mine, theirs = aliased(RouteLeaderboard), aliased(RouteLeaderboard)
+    shared = func.count(func.distinct(theirs.route_id)).label('shared')
+    rows = db.session.query(theirs.user_id, shared).join(
+        mine, mine.route_id == theirs.route_id
+    ).filter(
+        mine.user_id == user_id, theirs.user_id != user_id
+    ).group_by(theirs.user_id).order_by(shared.desc()).limit(CANDIDATES_PER_SIGNAL)
+    return dict(rows.all())
+
+
+def _city_candidates():
+    """{città normalizzata: id degli utenti con più prestigio in quella città}, con una sola query."""
+    city = func.lower(func.trim(User.city))
+    ranked = db.session.query(
+        User.id.label('user_id'),
+        city.label('city'),
+        func.row_number().over(partition_by=city, order_by=(User.prestige.desc(), User.id)).label('position')
+    ).filter(User.city.isnot(None), func.trim(User.city) != '').subquery()
+    by_city = {}
+    for user_id, city_name in db.session.query(ranked.c.user_id, ranked.c.city).filter(
+        ranked.c.position <= CANDIDATES_PER_SIGNAL
+    ):
+        by_city.setdefault(city_name, []).append(user_id)
+    return by_city
+
+
+def _normalize_city(city):
+    return city.strip().lower() if city and city.strip() else None
+
+
+def popular_user_ids(limit=POPULAR_LIMIT):
+    """Id degli utenti con più attività (in memoria per POPULAR_TTL secondi)."""
+    now = time.monotonic()
+    with _popular_lock:
+        if _popular_cache['expires_at'] > now:
+            return _popular_cache['ids'][:limit]
+    activity_count = func.count(Activity.id)
+    ids = [user_id for (user_id,) in db.session.query(Activity.user_id).group_by(
+        Activity.user_id
+    ).order_by(activity_count.desc(), Activity.user_id).limit(POPULAR_LIMIT)]
+    with _popular_lock:
+        _popular_cache.update(expires_at=now + POPULAR_TTL, ids=ids)
+    return ids[:limit]
+
+
+# =====================================================================
+# CALCOLO
+# =====================================================================
+
+def compute_suggestions(user, city_candidates=None, popular_ids=None):
+    """
+    Lista ordinata di dict (suggested_user_id, score, segnali) per `user`,
+    al massimo SUGGESTIONS_PER_USER, esclusi l'utente stesso e chi segue già.
+    """
+    if city_candidates is None:
+        city_candidates = _city_candidates()
+    if popular_ids is None:
+        popular_ids = popular_user_ids()
+
+    excluded = {user.id} | set(
+        db.session.execute(select(followers.c.followed_id).where(followers.c.follower_id == user.id)).scalars()
+    )
+    user_city = _normalize_city(user.city)
+    mutual = _mutual_follows(user.id)
+    groups = _shared_groups(user.id)
+    routes = _shared_routes(user.id)
+    city_ids = set(city_candidates.get(user_city, ())) if user_city else set()
+
+    candidate_ids = (set(mutual) | set(groups) | set(routes) | city_ids) - excluded
+    if user_city and candidate_ids:
+        # Stessa città anche per i candidati arrivati dagli altri segnali
+        city_ids |= {
+            candidate_id for candidate_id, city in db.session.query(User.id, User.city).filter(User.id.in_(candidate_ids))
+            if _normalize_city(city) == user_city
+        }
+
+    suggestions = []
+    for candidate_id in candidate_ids:
+        signals = {
+            'mutual_follows': mutual.get(candidate_id, 0),
+            'shared_groups': groups.get(candidate_id, 0),
+            'shared_routes': routes.get(candidate_id, 0),
+            'same_city': candidate_id in city_ids,
+        }
+        score = (MUTUAL_WEIGHT * signals['mutual_follows'] + GROUP_WEIGHT * signals['shared_groups']
+                 + ROUTE_WEIGHT * signals['shared_routes'] + CITY_WEIGHT * signals['same_city'])
+        suggestions.append(dict(signals, suggested_user_id=candidate_id, score=score))
+    suggestions.sort(key=lambda s: (-s['score'], -s['mutual_follows'], s['suggested_user_id']))
+    suggestions = suggestions[:SUGGESTIONS_PER_USER]
+
+    # Utente senza segnali (nuovo o isolato): si completa con i più attivi
+    chosen = {s['suggested_user_id'] for s in suggestions}
+    for candidate_id in popular_ids:
+        if len(suggestions) >= SUGGESTIONS_PER_USER:
+            break
+        if candidate_id not in excluded and candidate_id not in chosen:
+            suggestions.append({'suggested_user_id': candidate_id, 'score': 0.0, 'mutual_follows': 0,
+                                'shared_groups': 0, 'shared_routes': 0, 'same_city': False})
+    return suggestions
+
+
+def store_suggestions(user_id, suggestions, computed_at=None):
+    """Sostituisce i suggerimenti salvati di un utente (nella transazione corrente)."""
+    computed_at = computed_at or datetime.utcnow()
+    db.session.query(UserSuggestion).filter(UserSuggestion.user_id == user_id).delete(synchronize_session=False)
+    if suggestions:
+        db.session.execute(UserSuggestion.__table__.insert(), [
+            dict(suggestion, user_id=user_id, position=position, computed_at=computed_at)
+            for position, suggestion in enumerate(suggestions, start=1)
+        ])
+
+
+@job_handler(SUGGESTIONS_JOB_KIND)
+def process_user_suggestions(job):
+    """Ricalcola i suggerimenti di tutti gli utenti, un blocco per commit."""
+    progress = dict(job.result or {})
+    after_user_id = progress.get('after_user_id', 0)
+    refreshed = progress.get('refreshed', 0)
+    total = db.session.query(func.count(User.id)).scalar()
+    city_candidates = _city_candidates()
+    popular_ids = popular_user_ids()
+
+    while True:
+        users = User.query.filter(User.id > after_user_id).order_by(User.id).limit(REFRESH_BATCH_SIZE).all()
+        if not users:
+            break
+        computed_at = datetime.utcnow()
+        for user in users:
+            store_suggestions(user.id, compute_suggestions(user, city_candidates, popular_ids), computed_at)
+        after_user_id = users[-1].id
+        refreshed += len(users)
+        # Punto di ripresa salvato insieme al blocco
+        job.result = {'after_user_id': after_user_id, 'refreshed': refreshed}
+        db.session.commit()
+        update_progress(job, 100 * min(refreshed, total) // max(total, 1), f'Suggerimenti aggiornati per {refreshed} utenti')
+    return {'refreshed': refreshed}
+
+
+def enqueue_suggestions_refresh():
+    """Accoda il ricalcolo, se non ce n'è già uno in coda o in esecuzione."""
+    pending = Job.query.filter(
+        Job.kind == SUGGESTIONS_JOB_KIND, Job.status.in_(('queued', 'running'))
+    ).first()
+    if pending is not None:
+        return pending
+    return enqueue(SUGGESTIONS_JOB_KIND)
+
+
+# =====================================================================
+# LETTURA
+# =====================================================================
+
+def suggestion_reason(suggestion):
+    """Motivo del suggerimento da mostrare all'utente."""
+    if suggestion.mutual_follows:
+        return f"{suggestion.mutual_follows} follow in comune"
+    if suggestion.shared_groups:
+        return f"{suggestion.shared_groups} gruppi in comune" if suggestion.shared_groups > 1 else "Un gruppo in comune"
+    if suggestion.shared_routes:
+        return f"{suggestion.shared_routes} percorsi in comune" if suggestion.shared_routes > 1 else "Un percorso in comune"
+    if suggestion.same_city:
+        return "Della tua città"
+    return "Tra i più attivi"
+
+
+def get_user_suggestions(user, limit=5):
+    """
+    Lista di (User, motivo) da suggerire: le righe precalcolate dell'utente
+    (range scan sulla chiave primaria) meno chi ha iniziato a seguire nel
+    frattempo; per i visitatori e per chi non ne ha ancora, i più attivi.
+    """
+    if user is not None and user.is_authenticated:
+        already_followed = followed_ids(user.id)
+        rows = UserSuggestion.query.options(joinedload(UserSuggestion.suggested_user)).filter(
+            UserSuggestion.user_id == user.id
+        ).order_by(UserSuggestion.position).limit(SUGGESTIONS_PER_USER).all()
+        suggested = [(row.suggested_user, suggestion_reason(row)) for row in rows
+                     if row.suggested_user_id not in already_followed]
+        if suggested:
+            return suggested[:limit]
+        excluded = already_followed | {user.id}
+    else:
+        excluded = set()
+
+    popular_ids = [user_id for user_id in popular_user_ids() if user_id not in excluded][:limit]
+    users = {u.id: u for u in User.query.filter(User.id.in_(popular_ids))} if popular_ids else {}
+    return [(users[user_id], "Tra i più attivi") for user_id in popular_ids if user_id in users]
@@ -0,0 +1,218 @@
+# File: app/main/timeline.py
+"""
+Timeline personale con fan-out on write (tabella timeline_entries).
+
+Quando un post (non di gruppo) o un'attività viene creato:
+- nella stessa transazione si scrive la riga della timeline dell'autore e si
+  accoda un job `timeline_fanout`;
+- il worker consegna l'elemento ai follower dell'autore a blocchi di
+  FANOUT_BATCH_SIZE (a tutti gli utenti per le categorie di sistema), con un
+  commit per blocco, così un job interrotto riparte dall'ultimo utente servito.
+
+Iniziare a seguire qualcuno accoda un job `timeline_follow` che copia i suoi
+ultimi elementi, smettere di seguirlo ne toglie subito le righe.
+La lettura del feed diventa un range scan su (user_id, ts) con paginazione keyset.
+"""
+from datetime import datetime
+
+from flask import has_app_context
+from sqlalchemy import and_, event, func, select
+from sqlalchemy.orm import Session
+
+from app import db
+from app.jobs import enqueue, enqueue_in_transaction, job_handler, setting, update_progress
+from app.models import Activity, Post, TimelineEntry, User, followers
+from app.pagination import keyset_paginate
+
+
+FANOUT_JOB_KIND = 'timeline_fanout'
+FOLLOW_JOB_KIND = 'timeline_follow'
+
+FANOUT_BATCH_SIZE = 1000
+# Elementi più recenti copiati nella timeline quando si inizia a seguire qualcuno
+FOLLOW_BACKFILL_LIMIT = 100
+
+# Post di sistema visibili nel feed di tutti gli utenti
+BROADCAST_CATEGORIES = ('admin_announcement', 'weekly_tip', 'system_record', 'system_badge', 'system_new_classic')
+
+_entries = TimelineEntry.__table__
+
+
+def timeline_item(obj):
+    """Descrizione (serializzabile nel payload del job) di un post o di un'attività da distribuire; None se non va nei feed."""
+    if isinstance(obj, Post):
+        if obj.group_id is not None:
+            return None
+        return {
+            'item_type': 'post', 'item_id': obj.id, 'author_id': obj.user_id,
+            'ts': obj.created_at.isoformat(), 'broadcast': obj.post_category in BROADCAST_CATEGORIES,
+        }
+    if isinstance(obj, Activity):
+        return {
+            'item_type': 'activity', 'item_id': obj.id, 'author_id': obj.user_id,
+            'ts': obj.created_at.isoformat(), 'broadcast': False,
+        }
+    return None
+
+
+def _insert_entries(connection, user_ids, item):
+    """Aggiunge l'elemento alle timeline indicate, saltando quelle che lo contengono già. Ritorna le righe scritte."""
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return 0
+    existing = set(connection.execute(
+        select(_entries.c.user_id).where(
+            _entries.c.item_type == item['item_type'],
+            _entries.c.item_id == item['item_id'],
+            _entries.c.user_id.in_(user_ids)
+        )
+    ).scalars())
+    ts = datetime.fromisoformat(item['ts']) if isinstance(item['ts'], str) else item['ts']
+    rows = [
+        {'user_id': user_id, 'item_type': item['item_type'], 'item_id': item['item_id'],
+         'author_id': item['author_id'], 'ts': ts}
+        for user_id in user_ids if user_id not in existing
+    ]
+    if rows:
+        connection.execute(_entries.insert(), rows)
+    return len(rows)
+
+
+def fan_out_batch(connection, item, after_user_id=0, limit=FANOUT_BATCH_SIZE):
+    """
+    Consegna l'elemento al blocco successivo di destinatari (id > after_user_id).
+    Ritorna (righe scritte, ultimo id servito) oppure (righe scritte, None) se non ne restano.
+    """
+    if item['broadcast']:
+        recipients = select(User.id).where(User.id > after_user_id).order_by(User.id)
+    else:
+        recipients = select(followers.c.follower_id).where(
+            followers.c.followed_id == item['author_id'],
+            followers.c.follower_id > after_user_id
+        ).order_by(followers.c.follower_id)
+    user_ids = connection.execute(recipients.limit(limit)).scalars().all()
+    if not user_ids:
+        return 0, None
+    return _insert_entries(connection, user_ids, item), user_ids[-1]
+
+
+def _recipient_count(item):
+    if item['broadcast']:
+        return db.session.query(func.count(User.id)).scalar()
+    return db.session.query(func.count()).select_from(followers).filter(
+        followers.c.followed_id == item['author_id']
+    ).scalar()
+
+
+# =====================================================================
+# SCRITTURA: EVENTI DI FLUSH
+# =====================================================================
+
+def _on_after_flush(session, flush_context):
+    items = [item for item in (timeline_item(obj) for obj in session.new) if item is not None]
+    if not items:
+        return
+    connection = session.connection()
+    run_inline = has_app_context() and setting('JOBS_RUN_INLINE')
+    for item in items:
+        # L'autore vede subito il proprio elemento, i follower appena il worker lo distribuisce
+        _insert_entries(connection, [item['author_id']], item)
+        if run_inline:
+            after_user_id = 0
+            while after_user_id is not None:
+                _, after_user_id = fan_out_batch(connection, item, after_user_id)
+        else:
+            enqueue_in_transaction(connection, FANOUT_JOB_KIND, payload=item, user_id=item['author_id'])
+
+
+def _remove_item(item_type):
+    def listener(mapper, connection, target):
+        connection.execute(_entries.delete().where(
+            _entries.c.item_type == item_type, _entries.c.item_id == target.id
+        ))
+    return listener
+
+
+event.listen(Session, 'after_flush', _on_after_flush)
+event.listen(Post, 'after_delete', _remove_item('post'))
+event.listen(Activity, 'after_delete', _remove_item('activity'))
+
+
+# =====================================================================
+# JOB DEL WORKER
+# =====================================================================
+
+@job_handler(FANOUT_JOB_KIND)
+def process_timeline_fanout(job):
+    """Distribuisce un elemento alle timeline dei destinatari, un blocco per commit."""
+    item = job.payload
+    progress = dict(job.result or {})
+    after_user_id = progress.get('after_user_id', 0)
+    delivered = progress.get('delivered', 0)
+    total = _recipient_count(item)
+    batches = 0
+    while after_user_id is not None:
+        written, after_user_id = fan_out_batch(db.session.connection(), item, after_user_id)
+        delivered += written
+        batches += 1
+        # Punto di ripresa salvato insieme al blocco
+        job.result = {'after_user_id': after_user_id, 'delivered': delivered}
+        db.session.commit()
+        if after_user_id is not None:
+            update_progress(job, 100 * min(batches * FANOUT_BATCH_SIZE, total) // max(total, 1),
+                            f'Consegnato a {delivered} timeline')
+    return {'delivered': delivered}
+
+
+@job_handler(FOLLOW_JOB_KIND)
+def process_timeline_follow(job):
+    """Copia nella timeline del nuovo follower gli elementi più recenti dell'utente seguito."""
+    follower_id = job.payload['follower_id']
+    followed_id = job.payload['followed_id']
+    posts = Post.query.filter(
+        Post.user_id == followed_id,
+        Post.group_id.is_(None),
+        Post.post_category.notin_(BROADCAST_CATEGORIES)     # già in tutte le timeline
+    ).order_by(Post.created_at.desc()).limit(FOLLOW_BACKFILL_LIMIT).all()
+    activities = Activity.query.filter(
+        Activity.user_id == followed_id
+    ).order_by(Activity.created_at.desc()).limit(FOLLOW_BACKFILL_LIMIT).all()
+
+    items = sorted((timeline_item(obj) for obj in posts + activities), key=lambda item: item['ts'], reverse=True)
+    connection = db.session.connection()
+    copied = sum(_insert_entries(connection, [follower_id], item) for item in items[:FOLLOW_BACKFILL_LIMIT])
+    db.session.commit()
+    return {'copied': copied}
+
+
+# =====================================================================
+# FOLLOW / UNFOLLOW E LETTURA
+# =====================================================================
+
+def on_follow(follower, followed):
+    """Da chiamare dopo il commit del follow: accoda la copia degli elementi recenti."""
+    return enqueue(FOLLOW_JOB_KIND, payload={'follower_id': follower.id, 'followed_id': followed.id},
+                   user_id=follower.id)
+
+
+def on_unfollow(follower, followed):
+    """Toglie dalla timeline del follower gli elementi dell'utente non più seguito (nella transazione corrente)."""
+    broadcast_posts = select(Post.id).where(
+        Post.user_id == followed.id, Post.post_category.in_(BROADCAST_CATEGORIES)
+    )
+    db.session.execute(_entries.delete().where(
+        _entries.c.user_id == follower.id,
+        _entries.c.author_id == followed.id,
+        ~and_(_entries.c.item_type == 'post', _entries.c.item_id.in_(broadcast_posts))
+    ))
+
+
+def timeline_page(user_id, cursor=None, per_page=10):
+    """
+    Pagina della timeline (KeysetPage di righe item_type, item_id) dal più
+    recente, con un solo range scan su (user_id, ts, id) a qualunque profondità.
+    """
+    query = db.session.query(
+        TimelineEntry.item_type, TimelineEntry.item_id, TimelineEntry.ts, TimelineEntry.id
+    ).filter(TimelineEntry.user_id == user_id)
+    return keyset_paginate(query, (TimelineEntry.ts, TimelineEntry.id), cursor=cursor, per_page=per_page)
@@ -0,0 +1,327 @@
+# app/map_cache.py
+"""
+Cache delle risposte di /api/map_data per cella geohash.
+
+Quasi tutte le richieste della mappa arrivano da pochi centri città con il
+raggio di default: la parte più costosa della risposta, i percorsi
+serializzati con record e top 5, viene calcolata una volta per (cella geohash
+di lat/lon, fascia di raggio, activity_type, livello di dettaglio, formato) e
+riusata finché non scade il TTL o finché una scrittura su percorsi, attività
+o sfide di quell'area non la invalida.
+
+Per coprire ogni punto della cella la voce è calcolata attorno al centro
+della cella con il raggio della fascia allargato di mezza cella, insieme al
+bounding box di ogni percorso: ogni richiesta tiene solo i percorsi del
+proprio riquadro e calcola su questi sfide, attività recenti e classifiche
+locali, così la risposta è quella che si avrebbe senza cache. Senza lat/lon
+(cella GLOBAL_CELL) la voce è la risposta intera. I dati del singolo utente
+(`user_has_liked`) e i contatori dei like vengono applicati ad ogni
+richiesta sopra una copia, mai sulla voce stessa.
+
+Le invalidazioni via eventi valgono solo nel worker corrente: negli altri
+worker la voce resta valida al più per MAP_DATA_CACHE_TTL secondi.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import get_history
+
+from app.models import Activity, Challenge, Route
+from app.simplify import LOD_TOLERANCES
+from app.spatial import route_bounds_changes
+
+
+# Fasce di raggio (km) e precisione del geohash usata per ognuna: celle più
+# piccole per i raggi piccoli, così l'allargamento di mezza cella resta contenuto.
+RADIUS_BUCKETS = ((5, 6), (10, 5), (20, 5), (50, 4), (100, 4), (200, 4))
+
+GLOBAL_CELL = 'global'
+
+_GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+_KM_PER_DEGREE = 111.0
+
+
+# =====================================================================
+# GEOHASH
+# =====================================================================
+
+def geohash_encode(lat, lon, precision=5):
+    """Geohash (base32) del punto lat/lon con `precision` caratteri."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True     # i bit pari codificano la longitudine
+    while len(chars) < precision:
+        value_range, value = (lon_range, lon) if even else (lat_range, lat)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+def geohash_bounds(geohash):
+    """Bounding box (min_lon, min_lat, max_lon, max_lat) di una cella geohash."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = _GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lon_range if even else lat_range
+            middle = (value_range[0] + value_range[1]) / 2
+            if (value >> shift) & 1:
+                value_range[0] = middle
+            else:
+                value_range[1] = middle
+            even = not even
+    return lon_range[0], lat_range[0], lon_range[1], lat_range[1]
+
+
+# =====================================================================
+# CHIAVI E AREE
+# =====================================================================
+
+def radius_bucket(radius_km):
+    """Coppia (fascia di raggio in km, precisione geohash); None se il raggio è fuori dalle fasce."""
+    if radius_km is None or not math.isfinite(radius_km) or radius_km <= 0:
+        return None
+    for bucket, precision in RADIUS_BUCKETS:
+        if radius_km <= bucket:
+            return bucket, precision
+    return None
+
+
+def level_tolerance(tolerance):
+    """
+    Tolleranza del livello di dettaglio effettivamente servito (app.simplify):
+    tutte le tolleranze tra due livelli producono la stessa risposta.
+    """
+    if tolerance is None:
+        return None
+    chosen = None
+    for level in LOD_TOLERANCES:
+        if level > tolerance:
+            break
+        chosen = level
+    return chosen
+
+
+def cache_area(lat, lon, radius_km):
+    """
+    Area servita dalla cache per una richiesta: (cella, fascia, lat, lon, raggio)
+    dove lat/lon è il centro della cella e il raggio è quello della fascia più
+    mezza cella. Senza lat/lon la cella è GLOBAL_CELL; None se la richiesta
+    non va messa in cache (raggio fuori dalle fasce).
+    """
+    if lat is None or lon is None:
+        return GLOBAL_CELL, None, None, None, None
+    if not (math.isfinite(lat) and math.isfinite(lon)) or abs(lat) > 90 or abs(lon) > 180:
+        return None
+    bucket = radius_bucket(radius_km)
+    if bucket is None:
+        return None
+    bucket_km, precision = bucket
+    cell = geohash_encode(lat, lon, precision)
+    min_lon, min_lat, max_lon, max_lat = geohash_bounds(cell)
+    center_lat = (min_lat + max_lat) / 2
+    center_lon = (min_lon + max_lon) / 2
+    # Il raggio di /api/map_data è il mezzo lato del riquadro: per contenere il
+    # riquadro di ogni punto della cella basta aggiungere il mezzo lato della cella
+    half_height_km = (max_lat - min_lat) / 2 * _KM_PER_DEGREE
+    half_width_km = (max_lon - min_lon) / 2 * _KM_PER_DEGREE * abs(math.cos(math.radians(center_lat)))
+    return cell, bucket_km, center_lat, center_lon, bucket_km + max(half_height_km, half_width_km)
+
+
+def _intersects(area, bounds):
+    min_lon, min_lat, max_lon, max_lat = bounds
+    return not (max_lon < area[0] or min_lon > area[2] or max_lat < area[1] or min_lat > area[3])
+
+
+# =====================================================================
+# CACHE
+# =====================================================================
+
+class _CachedMapData:
+    __slots__ = ('value', 'expires_at', 'area', 'route_ids')
+
+    def __init__(self, value, expires_at, area, route_ids):
+        self.value = value
+        self.expires_at = expires_at
+        self.area = area                # (min_lon, min_lat, max_lon, max_lat) interrogato, None = globale
+        self.route_ids = route_ids      # percorsi da cui dipendono sfide, attività e classifiche
+
+
+class MapDataCache:
+    """
+    Cache LRU con TTL delle parti di /api/map_data indipendenti dall'utente.
+    Dimensione e TTL si leggono da MAP_DATA_CACHE_SIZE e MAP_DATA_CACHE_TTL.
+    """
+
+    def __init__(self, maxsize=512, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()   # chiave -> _CachedMapData
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.build_seconds = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _configure(self):
+        if has_app_context():
+            self.maxsize = current_app.config.get('MAP_DATA_CACHE_SIZE', self.maxsize)
+            self.ttl = current_app.config.get('MAP_DATA_CACHE_TTL', self.ttl)
+
+    def get(self, key):
+        """Valore in cache per la chiave (da non modificare), None se assente o scaduto."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def put(self, key, value, area, route_ids, build_seconds=0.0):
+        self._configure()
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        entry = _CachedMapData(value, time.monotonic() + self.ttl, area, frozenset(route_ids))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self.build_seconds += build_seconds
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, bounds=(), route_ids=()):
+        """
+        Elimina le voci il cui riquadro interseca uno dei `bounds` o che
+        contengono uno dei `route_ids`, più quelle globali (senza lat/lon).
+        Ritorna il numero di voci eliminate.
+        """
+        route_ids = set(route_ids)
+        with self._lock:
+            stale = [
+                key for key, entry in self._entries.items()
+                if entry.area is None
+                or not entry.route_ids.isdisjoint(route_ids)
+                or any(_intersects(entry.area, b) for b in bounds)
+            ]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'avg_build_ms': round(self.build_seconds * 1000 / self.misses, 2) if self.misses else 0.0,
+            }
+
+
+map_data_cache = MapDataCache()
+
+
+# =====================================================================
+# INVALIDAZIONE DOPO LE SCRITTURE
+# =====================================================================
+
+def _dirty(session):
+    return session.info.setdefault('dirty_map_data', {'bounds': set(), 'route_ids': set()})
+
+
+def _route_ids_changed(target, include_old):
+    route_ids = {target.route_id}
+    if include_old:
+        history = get_history(target, 'route_id')
+        route_ids.update(history.deleted or ())
+    route_ids.discard(None)
+    return route_ids
+
+
+def _on_route_written(include_old):
+    def listener(mapper, connection, target):
+        session = object_session(target)
+        if session is None:
+            return
+        dirty = _dirty(session)
+        dirty['bounds'].update(route_bounds_changes(target, include_old))
+        if target.id is not None:
+            dirty['route_ids'].add(target.id)
+    return listener
+
+
+def _on_route_child_written(include_old):
+    def listener(mapper, connection, target):
+        session = object_session(target)
+        if session is None:
+            return
+        _dirty(session)['route_ids'].update(_route_ids_changed(target, include_old))
+    return listener
+
+
+def _invalidate_after_commit(session):
+    dirty = session.info.pop('dirty_map_data', None)
+    if not dirty:
+        return
+    removed = map_data_cache.invalidate(bounds=dirty['bounds'], route_ids=dirty['route_ids'])
+    if removed:
+        print(f"🧹 Risposte della mappa invalidate dopo le modifiche: {removed}.")
+
+
+def _discard_after_rollback(session, previous_transaction):
+    session.info.pop('dirty_map_data', None)
+
+
+for _model, _listener_factory in ((Route, _on_route_written),
+                                  (Activity, _on_route_child_written),
+                                  (Challenge, _on_route_child_written)):
+    event.listen(_model, 'after_insert', _listener_factory(include_old=False))
+    event.listen(_model, 'after_update', _listener_factory(include_old=True))
+    event.listen(_model, 'after_delete', _listener_factory(include_old=False))
+event.listen(Session, 'after_commit', _invalidate_after_commit)
+event.listen(Session, 'after_soft_rollback', _discard_after_rollback)
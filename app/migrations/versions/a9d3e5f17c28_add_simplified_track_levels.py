@@ -0,0 +1,169 @@
+"""Add simplified track levels to Route and Activity
+
+Revision ID: a9d3e5f17c28
+Revises: f4b2d7e90a15
+Create Date: 2026-10-18 14:05:31.774210
+
+"""
+import json
+import struct
+import zlib
+
+from alembic import op
+import numpy as np
+import shapely
+from shapely.geometry import LineString
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d3e5f17c28'
+down_revision = 'f4b2d7e90a15'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+# Livelli di dettaglio e formati binari alla data di questa migrazione (vedi
+# app/simplify.py e app/tracks.py), copiati qui perché la migrazione non
+# dipenda dal codice dell'applicazione. I livelli contengono solo lon/lat.
+LOD_TOLERANCES = (4.0, 16.0, 64.0, 256.0)
+MIN_POINTS = 16
+EARTH_RADIUS_M = 6371000.0
+
+LOD_MAGIC = b'LOD'
+LOD_VERSION = 1
+_LOD_HEADER = struct.Struct('<3sBB')
+_LOD_LEVEL = struct.Struct('<fI')
+
+TRACK_MAGIC = b'GTK'
+TRACK_VERSION = 1
+_TRACK_HEADER = struct.Struct('<3sBBIq')
+COORD_SCALE = 1e6
+
+
+def _route_lonlat(raw_coordinates):
+    """lon/lat di Route.coordinates (Feature, LineString o Point GeoJSON, o array)."""
+    try:
+        loaded = json.loads(raw_coordinates) if isinstance(raw_coordinates, str) else raw_coordinates
+    except (json.JSONDecodeError, TypeError):
+        loaded = None
+    if isinstance(loaded, dict) and loaded.get('type') == 'Feature':
+        loaded = loaded.get('geometry') or {}
+    if isinstance(loaded, dict) and loaded.get('type') in ('LineString', 'Point'):
+        loaded = loaded.get('coordinates')
+        if loaded and not isinstance(loaded[0], (list, tuple)):
+            loaded = [loaded]
+    if not (isinstance(loaded, list) and loaded and all(isinstance(c, (list, tuple)) and len(c) >= 2 for c in loaded)):
+        return np.empty(0), np.empty(0)
+    return np.array([float(c[0]) for c in loaded]), np.array([float(c[1]) for c in loaded])
+
+
+def _activity_lonlat(value):
+    """lon/lat di Activity.gps_track, già nel formato binario compatto."""
+    value = bytes(value)
+    magic, version, flags, count, base_time_ms = _TRACK_HEADER.unpack_from(value)
+    if magic != TRACK_MAGIC or version != TRACK_VERSION:
+        raise ValueError(f"Formato traccia non supportato (versione {version}).")
+    body = zlib.decompress(value[_TRACK_HEADER.size:])
+    lat = np.cumsum(np.frombuffer(body, dtype='<i4', count=count, offset=0), dtype=np.int64)
+    lon = np.cumsum(np.frombuffer(body, dtype='<i4', count=count, offset=count * 4), dtype=np.int64)
+    return lon / COORD_SCALE, lat / COORD_SCALE
+
+
+def _delta_encode(values):
+    deltas = np.diff(np.asarray(values, dtype=np.int64), prepend=0)
+    if deltas.size and (deltas.max() > np.iinfo(np.int32).max or deltas.min() < np.iinfo(np.int32).min):
+        raise ValueError("Delta fuori dal range int32.")
+    return deltas.astype('<i4').tobytes()
+
+
+def _encode_lonlat(lon, lat):
+    channels = _delta_encode(np.round(lat * COORD_SCALE)) + _delta_encode(np.round(lon * COORD_SCALE))
+    return _TRACK_HEADER.pack(TRACK_MAGIC, TRACK_VERSION, 0, len(lat), 0) + zlib.compress(channels, 6)
+
+
+def _levels(lon, lat):
+    """
+    Livelli (tolleranza, lon, lat) semplificati con Douglas–Peucker in
+    proiezione equirettangolare locale; si tengono solo quelli che riducono i punti.
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    if lon.size < MIN_POINTS:
+        return []
+    lon0, lat0 = (lon.min() + lon.max()) / 2.0, (lat.min() + lat.max()) / 2.0
+    kx = np.radians(1.0) * EARTH_RADIUS_M * np.cos(np.radians(lat0))
+    ky = np.radians(1.0) * EARTH_RADIUS_M
+    line = LineString(np.column_stack(((lon - lon0) * kx, (lat - lat0) * ky)))
+    levels = []
+    previous_count = lon.size
+    for tolerance in sorted(LOD_TOLERANCES):
+        simplified = shapely.get_coordinates(shapely.simplify(line, tolerance, preserve_topology=False))
+        if len(simplified) < 2 or len(simplified) >= previous_count:
+            continue
+        levels.append((float(tolerance), simplified[:, 0] / kx + lon0, simplified[:, 1] / ky + lat0))
+        previous_count = len(simplified)
+    return levels
+
+
+def _encode_levels(levels):
+    parts = [_LOD_HEADER.pack(LOD_MAGIC, LOD_VERSION, len(levels))]
+    for tolerance, lon, lat in levels:
+        blob = _encode_lonlat(lon, lat)
+        parts.append(_LOD_LEVEL.pack(tolerance, len(blob)))
+        parts.append(blob)
+    return b''.join(parts)
+
+
+def _backfill(table_name, source_column, target_column, to_lonlat):
+    conn = op.get_bind()
+    table = sa.table(table_name,
+        sa.column('id', sa.Integer),
+        sa.column(source_column),
+        sa.column(target_column),
+    )
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(table.c.id, table.c[source_column])
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        for row_id, value in rows:
+            try:
+                levels = _encode_levels(_levels(*to_lonlat(value)))
+            except Exception as e:
+                print(f"⚠️ Livelli di dettaglio non calcolabili per {table_name} {row_id}: {e}")
+                continue
+            conn.execute(table.update().where(table.c.id == row_id).values({target_column: levels}))
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    with op.batch_alter_table('Routes', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('coordinates_lod', sa.LargeBinary(), nullable=True))
+
+    with op.batch_alter_table('Activities', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('gps_track_lod', sa.LargeBinary(), nullable=True))
+
+    # ### end Alembic commands ###
+
+    # Backfill dei percorsi e delle attività esistenti
+    _backfill('Routes', 'coordinates', 'coordinates_lod', _route_lonlat)
+    _backfill('Activities', 'gps_track', 'gps_track_lod', _activity_lonlat)
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    with op.batch_alter_table('Activities', schema=None) as batch_op:
+        batch_op.drop_column('gps_track_lod')
+
+    with op.batch_alter_table('Routes', schema=None) as batch_op:
+        batch_op.drop_column('coordinates_lod')
+
+    # ### end Alembic commands ###
@@ -0,0 +1,110 @@
+"""Add materialized timeline_entries table for the personal feed
+
+Revision ID: d7f3a2c8e415
+Revises: c61e8b2f4d93
+Create Date: 2026-10-18 16:40:27.913624
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7f3a2c8e415'
+down_revision = 'c61e8b2f4d93'
+branch_labels = None
+depends_on = None
+
+
+# Devono restare allineate a BROADCAST_CATEGORIES in app/main/timeline.py
+BROADCAST_CATEGORIES = ('admin_announcement', 'weekly_tip', 'system_record', 'system_badge', 'system_new_classic')
+
+
+def _backfill():
+    """
+    Timeline iniziale con un solo INSERT ... SELECT: elementi propri, post e
+    attività degli utenti seguiti e post di sistema per tutti gli utenti.
+    """
+    users = sa.table('user', sa.column('id', sa.Integer))
+    followers = sa.table('followers',
+        sa.column('follower_id', sa.Integer),
+        sa.column('followed_id', sa.Integer),
+    )
+    posts = sa.table('posts',
+        sa.column('id', sa.Integer),
+        sa.column('user_id', sa.Integer),
+        sa.column('group_id', sa.Integer),
+        sa.column('post_category', sa.String),
+        sa.column('created_at', sa.DateTime),
+    )
+    activities = sa.table('Activities',
+        sa.column('id', sa.Integer),
+        sa.column('user_id', sa.Integer),
+        sa.column('created_at', sa.DateTime),
+    )
+    entries = sa.table('timeline_entries',
+        sa.column('user_id', sa.Integer),
+        sa.column('item_type', sa.String),
+        sa.column('item_id', sa.Integer),
+        sa.column('author_id', sa.Integer),
+        sa.column('ts', sa.DateTime),
+    )
+
+    def post_rows(owner_id, *criteria):
+        return sa.select(
+            owner_id.label('user_id'), sa.literal('post').label('item_type'), posts.c.id.label('item_id'),
+            posts.c.user_id.label('author_id'), posts.c.created_at.label('ts')
+        ).where(posts.c.group_id.is_(None), posts.c.created_at.isnot(None), *criteria)
+
+    def activity_rows(owner_id, *criteria):
+        return sa.select(
+            owner_id.label('user_id'), sa.literal('activity').label('item_type'), activities.c.id.label('item_id'),
+            activities.c.user_id.label('author_id'), activities.c.created_at.label('ts')
+        ).where(activities.c.created_at.isnot(None), *criteria)
+
+    is_broadcast = posts.c.post_category.in_(BROADCAST_CATEGORIES)
+    rows = sa.union(
+        post_rows(posts.c.user_id),
+        activity_rows(activities.c.user_id),
+        post_rows(followers.c.follower_id, followers.c.followed_id == posts.c.user_id, ~is_broadcast),
+        activity_rows(followers.c.follower_id, followers.c.followed_id == activities.c.user_id),
+        # Post di sistema per tutti gli utenti: join esplicito sulla sola categoria
+        post_rows(users.c.id).select_from(users.join(posts, is_broadcast)),
+    )
+    op.execute(entries.insert().from_select(['user_id', 'item_type', 'item_id', 'author_id', 'ts'], rows))
+
+
+def upgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_table('timeline_entries',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('item_type', sa.String(length=20), nullable=False),
+    sa.Column('item_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column('ts', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['author_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'item_type', 'item_id', name='_timeline_user_item_uc')
+    )
+    with op.batch_alter_table('timeline_entries', schema=None) as batch_op:
+        batch_op.create_index('ix_timeline_entries_item', ['item_type', 'item_id'], unique=False)
+        batch_op.create_index('ix_timeline_entries_user_author', ['user_id', 'author_id'], unique=False)
+        batch_op.create_index('ix_timeline_entries_user_ts', ['user_id', 'ts', 'id'], unique=False)
+
+    # ### end Alembic commands ###
+
+    # Timeline iniziale dai post, dalle attività e dai follow esistenti
+    _backfill()
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    with op.batch_alter_table('timeline_entries', schema=None) as batch_op:
+        batch_op.drop_index('ix_timeline_entries_user_ts')
+        batch_op.drop_index('ix_timeline_entries_user_author')
+        batch_op.drop_index('ix_timeline_entries_item')
+
+    op.drop_table('timeline_entries')
+    # ### end Alembic commands ###
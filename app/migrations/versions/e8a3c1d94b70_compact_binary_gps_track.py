@@ -0,0 +1,215 @@
+"""Store Activity.gps_track in compact binary format
+
+Revision ID: e8a3c1d94b70
+Revises: d5f1b8c27e63
+Create Date: 2026-10-18 12:41:16.905532
+
+"""
+import json
+import struct
+import zlib
+from datetime import datetime, timezone
+
+from alembic import op
+import numpy as np
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8a3c1d94b70'
+down_revision = 'd5f1b8c27e63'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+# Formato binario della traccia alla data di questa migrazione (vedi app/tracks.py),
+# copiato qui perché la migrazione non dipenda dal codice dell'applicazione:
+#   header:  magic b'GTK' | versione (B) | flags (B) | numero punti (I) | tempo base epoch ms (q)
+#   corpo (zlib): lat µgradi | lon µgradi | [offset tempo ms] | [quota dm], int32 a delta
+MAGIC = b'GTK'
+VERSION = 1
+FLAG_TIME = 0x01
+FLAG_ELEVATION = 0x02
+_HEADER = struct.Struct('<3sBBIq')
+COORD_SCALE = 1e6
+ELEVATION_SCALE = 10.0
+
+
+def _epoch_ms(value):
+    """Epoch in ms di un timestamp (ISO 8601, datetime o epoch in s/ms); None se assente."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        seconds = value / 1000.0 if value > 1e11 else float(value)
+        return int(round(seconds * 1000))
+    parsed = value if isinstance(value, datetime) else datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return int(round(parsed.replace(tzinfo=timezone.utc).timestamp() * 1000))
+
+
+def _legacy_track(raw):
+    """(lon, lat, tempi in s o None, quote o None) da una traccia JSON in uno dei formati storici."""
+    if raw is None or raw == '':
+        return [], [], None, None
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        raw = bytes(raw).decode('utf-8')
+    data = json.loads(raw) if isinstance(raw, str) else raw
+    if isinstance(data, dict) and data.get('type') == 'Feature':
+        data = data.get('geometry') or {}
+    if isinstance(data, dict) and data.get('type') == 'LineString':
+        data = data.get('coordinates') or []
+    if not isinstance(data, list) or not data:
+        return [], [], None, None
+
+    if isinstance(data[0], (list, tuple)):
+        rows = [p for p in data if isinstance(p, (list, tuple)) and len(p) >= 2]
+        ele = None
+        if rows and all(len(p) >= 3 and p[2] is not None for p in rows):
+            ele = [float(p[2]) for p in rows]
+        return [float(p[0]) for p in rows], [float(p[1]) for p in rows], None, ele
+
+    lon, lat, times, ele = [], [], [], []
+    for p in data:
+        if not isinstance(p, dict):
+            continue
+        p_lat = p.get('latitude', p.get('lat'))
+        p_lon = p.get('longitude', p.get('lon', p.get('lng')))
+        if p_lat is None or p_lon is None:
+            continue
+        lat.append(float(p_lat))
+        lon.append(float(p_lon))
+        try:
+            times.append(_epoch_ms(p.get('timestamp', p.get('time'))))
+        except (TypeError, ValueError, OverflowError, OSError):
+            times.append(None)
+        p_ele = p.get('altitude', p.get('ele'))
+        ele.append(None if p_ele is None else float(p_ele))
+
+    time = [t / 1000.0 for t in times] if times and all(t is not None for t in times) else None
+    return lon, lat, time, (ele if ele and all(e is not None for e in ele) else None)
+
+
+def _delta_encode(values):
+    values = np.asarray(values, dtype=np.int64)
+    deltas = np.diff(values, prepend=0)
+    if deltas.size and (deltas.max() > np.iinfo(np.int32).max or deltas.min() < np.iinfo(np.int32).min):
+        raise ValueError("Delta fuori dal range int32.")
+    return deltas.astype('<i4').tobytes()
+
+
+def _delta_decode(buffer, offset, count):
+    deltas = np.frombuffer(buffer, dtype='<i4', count=count, offset=offset)
+    return np.cumsum(deltas, dtype=np.int64), offset + count * 4
+
+
+def _encode_track(lon, lat, time, ele):
+    count = len(lat)
+    flags = 0
+    base_time_ms = 0
+    channels = [
+        _delta_encode(np.round(np.asarray(lat, dtype=np.float64) * COORD_SCALE)),
+        _delta_encode(np.round(np.asarray(lon, dtype=np.float64) * COORD_SCALE)),
+    ]
+    if time is not None and count:
+        flags |= FLAG_TIME
+        time_ms = np.round(np.asarray(time, dtype=np.float64) * 1000.0).astype(np.int64)
+        base_time_ms = int(time_ms[0])
+        channels.append(_delta_encode(time_ms - base_time_ms))
+    if ele is not None and count:
+        flags |= FLAG_ELEVATION
+        channels.append(_delta_encode(np.round(np.asarray(ele, dtype=np.float64) * ELEVATION_SCALE)))
+    return _HEADER.pack(MAGIC, VERSION, flags, count, base_time_ms) + zlib.compress(b''.join(channels), 6)
+
+
+def _decode_track(value):
+    value = bytes(value)
+    magic, version, flags, count, base_time_ms = _HEADER.unpack_from(value)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Formato traccia non supportato (versione {version}).")
+    body = zlib.decompress(value[_HEADER.size:])
+
+    offset = 0
+    lat, offset = _delta_decode(body, offset, count)
+    lon, offset = _delta_decode(body, offset, count)
+    time = ele = None
+    if flags & FLAG_TIME:
+        time_ms, offset = _delta_decode(body, offset, count)
+        time = (time_ms + base_time_ms) / 1000.0
+    if flags & FLAG_ELEVATION:
+        ele_dm, offset = _delta_decode(body, offset, count)
+        ele = ele_dm / ELEVATION_SCALE
+    return lon / COORD_SCALE, lat / COORD_SCALE, time, ele
+
+
+def _track_json(lon, lat, time, ele):
+    """JSON della traccia: lista di punti, oppure [[lon, lat]] se senza tempi né quote."""
+    if time is None and ele is None:
+        return json.dumps([[float(x), float(y)] for x, y in zip(lon, lat)])
+    points = []
+    for i in range(len(lat)):
+        point = {'latitude': float(lat[i]), 'longitude': float(lon[i])}
+        if time is not None:
+            moment = datetime.fromtimestamp(time[i], tz=timezone.utc).replace(tzinfo=None)
+            point['timestamp'] = moment.isoformat() + 'Z'
+        if ele is not None:
+            point['altitude'] = float(ele[i])
+        points.append(point)
+    return json.dumps(points)
+
+
+def _convert(source_column, target_column, converter):
+    conn = op.get_bind()
+    activities = sa.table('Activities',
+        sa.column('id', sa.Integer),
+        sa.column(source_column),
+        sa.column(target_column),
+    )
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(activities.c.id, activities.c[source_column])
+            .where(activities.c.id > last_id)
+            .order_by(activities.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        for activity_id, value in rows:
+            try:
+                converted = converter(value)
+            except Exception as e:
+                print(f"⚠️ Traccia dell'attività {activity_id} non convertibile ({e}): salvata vuota.")
+                converted = converter(None)
+            conn.execute(
+                activities.update().where(activities.c.id == activity_id).values({target_column: converted})
+            )
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    with op.batch_alter_table('Activities', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('gps_track_bin', sa.LargeBinary(), nullable=True))
+
+    # Converte le tracce JSON (in tutti i formati storici) nel formato binario compatto
+    _convert('gps_track', 'gps_track_bin', lambda value: _encode_track(*_legacy_track(value)))
+
+    with op.batch_alter_table('Activities', schema=None) as batch_op:
+        batch_op.drop_column('gps_track')
+        batch_op.alter_column('gps_track_bin', new_column_name='gps_track',
+               existing_type=sa.LargeBinary(), nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('Activities', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('gps_track_text', sa.Text(), nullable=True))
+
+    # Le tracce tornano JSON (lista di punti, oppure [[lon, lat]] se senza tempi)
+    _convert('gps_track', 'gps_track_text',
+             lambda value: _track_json(*_decode_track(value)) if value is not None else '[]')
+
+    with op.batch_alter_table('Activities', schema=None) as batch_op:
+        batch_op.drop_column('gps_track')
+        batch_op.alter_column('gps_track_text', new_column_name='gps_track',
+               existing_type=sa.Text(), nullable=False)
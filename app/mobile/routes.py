@@ -5,57 +5,25 @@ from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identi
 from app.models import User, Activity, Route, Challenge 
 from app import db
 from datetime import datetime
-import math
 import json
 import uuid # Assicurati che questo sia importato
+from app.tracks import Track
+from app.geo import haversine, track_stats
+from .tracking import (parse_location, prepare_batch, filter_new_points, append_track_points,
+                       finalize_track, format_timestamp)
 
 mobile = Blueprint('mobile', __name__)
 
 # Funzione helper per calcolare distanza
 def calculate_distance(lat1, lon1, lat2, lon2):
-    R = 6371  # Raggio della Terra in km
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = (math.sin(dlat/2) * math.sin(dlat/2) + 
-         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * 
-         math.sin(dlon/2) * math.sin(dlon/2))
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    return R * c
+    """Distanza in km tra due punti (vedi app.geo.haversine)."""
+    return float(haversine(lat1, lon1, lat2, lon2)) / 1000.0
 
 # NUOVA FUNZIONE: Calcola statistiche da GPS track
-def calculate_activity_stats(gps_track_json):
-    coordinates = json.loads(gps_track_json)
-    if not coordinates or len(coordinates) < 2:
-        return 0.0, 0, 0.0 # (distance_km, duration_seconds, avg_speed_kmh)
-
-    total_distance_km = 0.0
-    
-    # Calcola la distanza totale sommando i segmenti
-    for i in range(1, len(coordinates)):
-        prev = coordinates[i-1]
-        curr = coordinates[i]
-        total_distance_km += calculate_distance(
-            prev['latitude'], prev['longitude'],
-            curr['latitude'], curr['longitude']
-        )
-    
-    # Calcola la durata totale
-    try:
-        start_time = datetime.fromisoformat(coordinates[0]['timestamp'].replace('Z', '+00:00'))
-        end_time = datetime.fromisoformat(coordinates[-1]['timestamp'].replace('Z', '+00:00'))
-        duration_seconds = (end_time - start_time).total_seconds()
-    except ValueError:
-        try:
-            start_time = datetime.fromisoformat(coordinates[0]['timestamp'])
-            end_time = datetime.fromisoformat(coordinates[-1]['timestamp'])
-            duration_seconds = (end_time - start_time).total_seconds()
-        except Exception:
-            duration_seconds = 0
-
-
-    avg_speed_kmh = (total_distance_km / duration_seconds) * 3600 if duration_seconds > 0 else 0.0
-    
-    return total_distance_km, int(duration_seconds), avg_speed_kmh
+def calculate_activity_stats(gps_track):
+    """Calcola (distanza_km, durata_secondi, velocità_media_kmh) da una traccia (Track o JSON)."""
+    stats = track_stats(gps_track)
+    return stats.distance_km, stats.duration, stats.avg_speed
 
 
 # ========== AUTENTICAZIONE MOBILE ==========
@@ -227,7 +195,7 @@ def start_tracking():
             route_id=target_route_id,
             challenge_id=target_challenge_id,
             activity_type=activity_type,
-            gps_track='[]',
+            gps_track=Track.empty(),
             duration=0,
             avg_speed=0.0,
             distance=0.0
@@ -272,36 +240,29 @@ def update_tracking():
         if not location_point:
             return jsonify({"success": False, "error": "Dati di localizzazione mancanti."}), 400
 
+        try:
+            point = parse_location(location_point)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
         activity = Activity.query.filter_by(id=activity_id, user_id=user_id).first()
         if not activity:
             return jsonify({"success": False, "error": "Attività non trovata o non autorizzata"}), 404
+        if activity.track_finished_at is not None:
+            return jsonify({"success": False, "error": "Sessione di tracciamento già terminata."}), 409
         
-        gps_track_data = json.loads(activity.gps_track) if activity.gps_track else []
-        
-        new_coord_formatted = {
-            'latitude': location_point['latitude'],
-            'longitude': location_point['longitude'],
-            'timestamp': location_point['timestamp'],
-            'speed': location_point.get('speed', 0),
-            'altitude': location_point.get('altitude', 0),
-            'accuracy': location_point.get('accuracy', 0)
-        }
-        gps_track_data.append(new_coord_formatted)
-        
-        activity.gps_track = json.dumps(gps_track_data)
-        
-        total_distance, duration, avg_speed = calculate_activity_stats(activity.gps_track)
-        
-        activity.distance = total_distance
-        activity.duration = duration
-        activity.avg_speed = avg_speed
+        # Ingest append-only: si calcola solo il nuovo segmento, senza rileggere la traccia.
+        # Un punto ritrasmesso (timestamp già visto) viene ignorato.
+        new_points, _ = filter_new_points(activity, [point])
+        if new_points:
+            append_track_points(activity, new_points)
         
         db.session.commit()
         
         return jsonify({
             "success": True,
             "activity_id": activity.id,
-            "locations_count": len(gps_track_data),
+            "locations_count": activity.track_points_count,
             "current_distance": round(activity.distance, 3),
             "current_speed": round(activity.avg_speed, 2) if activity.avg_speed else 0,
             "message": "Posizione aggiornata"
@@ -311,6 +272,89 @@ def update_tracking():
         print(f"❌ Errore update_tracking: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+MAX_BATCH_POINTS = 5000
+
+
+@mobile.route('/tracking/update_batch', methods=['POST'])
+@jwt_required()
+def update_tracking_batch():
+    """
+    Variante a lotti di /tracking/update: il client invia i punti accumulati
+    ogni N secondi invece di una richiesta per ogni fix GPS.
+
+    Formati accettati:
+    - JSON: {"activity_id": 1, "locations": [{latitude, longitude, timestamp, ...}, ...]}
+    - NDJSON (Content-Type: application/x-ndjson): un punto per riga,
+      con activity_id nella query string (?activity_id=1).
+
+    I punti vengono validati, ordinati per timestamp, deduplicati (anche rispetto
+    a quelli già ricevuti, così i lotti ritrasmessi sono idempotenti) e applicati
+    in un'unica transazione.
+    """
+    try:
+        user_id = get_jwt_identity()
+        activity_id = request.args.get('activity_id', type=int)
+
+        if request.mimetype in ('application/x-ndjson', 'application/ndjson'):
+            raw_points = []
+            for line in request.get_data(as_text=True).splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    raw_points.append(json.loads(line))
+                except json.JSONDecodeError:
+                    raw_points.append(None) # verrà contato tra gli scartati
+        else:
+            data = request.get_json(silent=True)
+            if isinstance(data, list):
+                raw_points = data
+            elif isinstance(data, dict):
+                raw_points = data.get('locations') or []
+                activity_id = data.get('activity_id', activity_id)
+            else:
+                return jsonify({"success": False, "error": "Corpo della richiesta non valido."}), 400
+
+        if not activity_id:
+            return jsonify({"success": False, "error": "activity_id mancante."}), 400
+        if not isinstance(raw_points, list) or not raw_points:
+            return jsonify({"success": False, "error": "Nessun punto di localizzazione ricevuto."}), 400
+        if len(raw_points) > MAX_BATCH_POINTS:
+            return jsonify({"success": False, "error": f"Massimo {MAX_BATCH_POINTS} punti per richiesta."}), 413
+
+        points, rejected = prepare_batch(raw_points)
+
+        # Lock della riga attività: due lotti concorrenti della stessa sessione
+        # vengono applicati uno dopo l'altro (su SQLite il lock è ignorato).
+        activity = Activity.query.filter_by(id=activity_id, user_id=user_id).with_for_update().first()
+        if not activity:
+            return jsonify({"success": False, "error": "Attività non trovata o non autorizzata"}), 404
+        if activity.track_finished_at is not None:
+            return jsonify({"success": False, "error": "Sessione di tracciamento già terminata."}), 409
+
+        new_points, duplicates = filter_new_points(activity, points)
+        if new_points:
+            append_track_points(activity, new_points)
+
+        db.session.commit()
+
+        return jsonify({
+            "success": True,
+            "activity_id": activity.id,
+            "accepted": len(new_points),
+            "duplicates": duplicates,
+            "rejected": rejected,
+            "locations_count": activity.track_points_count,
+            "last_timestamp": format_timestamp(activity.last_point_at),
+            "current_distance": round(activity.distance, 3),
+            "current_speed": round(activity.avg_speed, 2) if activity.avg_speed else 0,
+            "message": "Posizioni aggiornate"
+        })
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Errore update_tracking_batch: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @mobile.route('/tracking/stop', methods=['POST'])
 @jwt_required()
 def stop_tracking():
@@ -319,7 +363,8 @@ def stop_tracking():
         data = request.json
         activity_id = data.get('activity_id')
         
-        activity = Activity.query.filter_by(id=activity_id, user_id=user_id).first()
+        # Lock della riga: un lotto in arrivo durante lo stop viene applicato prima o rifiutato dopo
+        activity = Activity.query.filter_by(id=activity_id, user_id=user_id).with_for_update().first()
         if not activity:
             return jsonify({"success": False, "error": "Attività non trovata o non autorizzata"}), 404
         
@@ -327,11 +372,20 @@ def stop_tracking():
         if not route:
             return jsonify({"success": False, "error": "Percorso associato all'attività non trovato"}), 404
         
-        final_distance, final_duration, final_avg_speed = calculate_activity_stats(activity.gps_track)
-        
-        activity.distance = final_distance
-        activity.duration = final_duration
-        activity.avg_speed = final_avg_speed
+        if activity.track_finished_at is not None:
+            # Stop ripetuto: la traccia è già stata salvata
+            total_locations = len(activity.gps_track) if activity.gps_track is not None else 0
+        elif activity.track_points_count:
+            # I totali sono già aggiornati dall'ingest: basta salvare la traccia completa
+            total_locations = finalize_track(activity) or activity.track_points_count
+        else:
+            # Sessione senza punti incrementali (vecchio formato): calcolo completo
+            final_distance, final_duration, final_avg_speed = calculate_activity_stats(activity.gps_track)
+            activity.distance = final_distance
+            activity.duration = final_duration
+            activity.avg_speed = final_avg_speed
+            total_locations = len(activity.gps_track) if activity.gps_track is not None else 0
+        activity.track_finished_at = activity.track_finished_at or datetime.utcnow()
         
         db.session.commit()
         
@@ -341,7 +395,7 @@ def stop_tracking():
                 "id": activity.id,
                 "route_id": route.id,
                 "route_name": route.name,
-                "total_locations": len(json.loads(activity.gps_track)),
+                "total_locations": total_locations,
                 "total_distance": round(activity.distance, 3),
                 "average_speed": round(activity.avg_speed, 2) if activity.avg_speed else 0,
                 "duration": activity.duration,
@@ -0,0 +1,166 @@
+# app/mobile/tracking.py
+"""
+Ingest incrementale dei punti GPS del tracciamento live.
+
+Ogni punto viene salvato come riga append-only (TrackPoint) e l'attività tiene
+i totali progressivi (distanza, primo timestamp, ultimo punto): per ogni nuovo
+punto si calcola solo l'ultimo segmento, quindi il costo per aggiornamento
+resta costante per tutta la durata della sessione.
+"""
+from app import db
+from app.geo import average_speed, path_length
+from app.models import TrackPoint
+from app.tracks import Track, parse_timestamp, to_epoch_seconds
+
+
+def format_timestamp(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+def parse_location(location_point):
+    """
+    Valida un punto inviato dal client e lo normalizza.
+    Solleva ValueError se mancano le coordinate o se non sono valide.
+    """
+    if not isinstance(location_point, dict):
+        raise ValueError("Punto di localizzazione non valido.")
+    try:
+        latitude = float(location_point['latitude'])
+        longitude = float(location_point['longitude'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Latitudine/longitudine mancanti o non valide.")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("Coordinate fuori intervallo.")
+    try:
+        recorded_at = parse_timestamp(location_point.get('timestamp'))
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise ValueError("Timestamp non valido.")
+
+    return {
+        'latitude': latitude,
+        'longitude': longitude,
+        'recorded_at': recorded_at,
+        'speed': location_point.get('speed') or 0,
+        'altitude': location_point.get('altitude') or 0,
+        'accuracy': location_point.get('accuracy') or 0,
+    }
+
+
+def prepare_batch(raw_points):
+    """
+    Valida un lotto di punti, scarta quelli non validi o senza timestamp e
+    li ordina per timestamp eliminando i duplicati interni al lotto.
+    Ritorna (punti_validi_ordinati, numero_scartati).
+    """
+    valid = {}
+    rejected = 0
+    for raw in raw_points:
+        try:
+            point = parse_location(raw)
+        except ValueError:
+            rejected += 1
+            continue
+        if point['recorded_at'] is None:
+            rejected += 1
+            continue
+        # A parità di timestamp vince il primo punto ricevuto
+        valid.setdefault(point['recorded_at'], point)
+    return [valid[ts] for ts in sorted(valid)], rejected
+
+
+def filter_new_points(activity, points):
+    """
+    Rende l'ingest idempotente: i punti con timestamp non successivo all'ultimo
+    già registrato sono ritrasmissioni e vengono ignorati.
+    Ritorna (punti_nuovi, numero_duplicati).
+    """
+    if activity.last_point_at is None:
+        return points, 0
+    new_points = [p for p in points if p['recorded_at'] is None or p['recorded_at'] > activity.last_point_at]
+    return new_points, len(points) - len(new_points)
+
+
+def _seed_from_legacy_track(activity):
+    """
+    Sessioni avviate prima dell'ingest incrementale hanno i punti solo in
+    gps_track: li riversiamo una volta sola nella tabella dei punti.
+    """
+    legacy_points = activity.gps_track.to_points() if activity.gps_track is not None else []
+    parsed = []
+    seen_timestamps = set()
+    for raw in legacy_points:
+        try:
+            point = parse_location(raw)
+        except ValueError:
+            continue
+        if point['recorded_at'] is not None:
+            if point['recorded_at'] in seen_timestamps:
+                continue
+            seen_timestamps.add(point['recorded_at'])
+        parsed.append(point)
+    if parsed:
+        activity.distance = 0.0
+        _apply_points(activity, parsed)
+
+
+def append_track_points(activity, points):
+    """
+    Aggiunge i punti (già validati con parse_location) all'attività e aggiorna
+    i totali progressivi. Non fa commit: il chiamante decide la transazione.
+    """
+    if not activity.track_points_count and activity.gps_track is not None and len(activity.gps_track):
+        _seed_from_legacy_track(activity)
+    _apply_points(activity, points)
+
+
+def _apply_points(activity, points):
+    if not points:
+        return
+    count = activity.track_points_count or 0
+
+    # Distanza del lotto in un'unica passata vettorizzata, partendo dall'ultimo punto salvato
+    lats = [p['latitude'] for p in points]
+    lons = [p['longitude'] for p in points]
+    if count and activity.last_latitude is not None:
+        lats.insert(0, activity.last_latitude)
+        lons.insert(0, activity.last_longitude)
+    distance_km = (activity.distance or 0.0) + path_length(lats, lons) / 1000.0
+
+    for point in points:
+        db.session.add(TrackPoint(activity_id=activity.id, **point))
+
+        if activity.track_started_at is None and point['recorded_at'] is not None:
+            activity.track_started_at = point['recorded_at']
+        if point['recorded_at'] is not None:
+            activity.last_point_at = point['recorded_at']
+        activity.last_latitude = point['latitude']
+        activity.last_longitude = point['longitude']
+        count += 1
+
+    activity.track_points_count = count
+    activity.distance = distance_km
+    if activity.track_started_at and activity.last_point_at:
+        activity.duration = max(int((activity.last_point_at - activity.track_started_at).total_seconds()), 0)
+    else:
+        activity.duration = 0
+    activity.avg_speed = average_speed(distance_km, activity.duration)
+
+
+def finalize_track(activity):
+    """
+    Alla fine della sessione riversa i punti in Activity.gps_track (formato
+    binario compatto) ed elimina le righe temporanee.
+    Ritorna il numero di punti della traccia.
+    """
+    points = activity.track_points.order_by(TrackPoint.id.asc()).all()
+    if not points:
+        return 0
+    with_time = all(p.recorded_at is not None for p in points)
+    activity.gps_track = Track(
+        [p.longitude for p in points],
+        [p.latitude for p in points],
+        time=[to_epoch_seconds(p.recorded_at) for p in points] if with_time else None,
+        ele=[p.altitude or 0.0 for p in points]
+    )
+    activity.track_points.delete(synchronize_session=False)
+    return len(points)
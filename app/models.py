@@ -8,6 +8,8 @@ from sqlalchemy.orm.attributes import get_history
 import random
 from sqlalchemy.dialects.postgresql import JSONB
 from hashlib import md5
+from .tracks import CompactTrack
+from .simplify import CompactTrackLevels
 # =====================================================================
 # TABELLE DI ASSOCIAZIONE (Molti-a-Molti)
 # Definite qui all'inizio per essere disponibili a tutti i modelli.
@@ -62,6 +64,8 @@ class User(db.Model, UserMixin):
     title = db.Column(db.String(50), default='Popolano', nullable=False)
     # --- FINE NUOVI CAMPI ---
     onboarding_steps = db.Column(db.JSON, nullable=True)
+    # Contatore denormalizzato delle notifiche non lette, aggiornato dagli eventi su Notification
+    unread_notifications = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     followed = db.relationship(
         'User', secondary=followers,
         primaryjoin=(followers.c.follower_id == id),
@@ -75,15 +79,21 @@ class User(db.Model, UserMixin):
         return check_password_hash(self.password_hash, password)
 
     def follow(self, user):
-        if not self.is_following(user):
+        if not self._follow_row_exists(user):
             self.followed.append(user)
 
     def unfollow(self, user):
-        if self.is_following(user):
+        if self._follow_row_exists(user):
             self.followed.remove(user)
 
-    def is_following(self, user):
+    def _follow_row_exists(self, user):
+        # Le scritture controllano il database, non la cache del grafo (che in un altro worker può essere indietro)
         return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+
+    def is_following(self, user):
+        # Appartenenza all'insieme in cache dei seguiti (app/follow_graph.py)
+        from app.follow_graph import is_following
+        return is_following(self.id, user.id)
     
     def followed_posts(self):
         return Activity.query.join(
@@ -155,6 +165,24 @@ class Route(db.Model):
     difficulty = db.Column(db.String(20))
     estimated_time = db.Column(db.String(50))
     landmarks = db.Column(db.Text)
+
+    # --- BOUNDING BOX E CENTROIDE (calcolati da 'coordinates') ---
+    # Permettono di filtrare i percorsi per area con una range query indicizzata,
+    # senza decodificare il GeoJSON in Python.
+    min_lat = db.Column(db.Float, nullable=True)
+    max_lat = db.Column(db.Float, nullable=True)
+    min_lon = db.Column(db.Float, nullable=True)
+    max_lon = db.Column(db.Float, nullable=True)
+    centroid_lat = db.Column(db.Float, nullable=True)
+    centroid_lon = db.Column(db.Float, nullable=True)
+
+    # Versioni semplificate di 'coordinates' per le mappe a zoom bassi (vedi app/simplify.py)
+    coordinates_lod = db.deferred(db.Column(CompactTrackLevels, nullable=True))
+
+    __table_args__ = (
+        db.Index('ix_Routes_bbox', 'min_lat', 'max_lat', 'min_lon', 'max_lon'),
+        db.Index('ix_Routes_centroid', 'centroid_lat', 'centroid_lon'),
+    )
     
     challenges = db.relationship('Challenge', backref='route_info', lazy='dynamic')
     activities = db.relationship('Activity', backref='route_activity', lazy='dynamic')
@@ -168,14 +196,51 @@ class Route(db.Model):
     # 'proposed' -> Proposto come classico, in attesa di revisione
     # 'approved' -> Approvato come classico dall'admin
     # 'rejected' -> Rifiutato come classico dall'admin
+    def update_bounds(self):
+        """Ricalcola bounding box e centroide a partire da 'coordinates'."""
+        from .spatial import route_geometry
+
+        geometry = route_geometry(self.coordinates)
+        if geometry is None or geometry.is_empty:
+            self.min_lat = self.max_lat = self.min_lon = self.max_lon = None
+            self.centroid_lat = self.centroid_lon = None
+            return
+        self.min_lon, self.min_lat, self.max_lon, self.max_lat = geometry.bounds
+        centroid = geometry.centroid
+        self.centroid_lon, self.centroid_lat = centroid.x, centroid.y
+
+    def update_simplified(self):
+        """Ricalcola i livelli semplificati a partire da 'coordinates'."""
+        from .simplify import build_levels
+        from .spatial import parse_route_coordinates
+        from .tracks import Track
+
+        self.coordinates_lod = build_levels(Track.from_points(parse_route_coordinates(self.coordinates) or []))
+
+    def coordinates_for_tolerance(self, tolerance):
+        """
+        Coordinate [[lon, lat], ...] semplificate entro `tolerance` metri,
+        None se va usata la geometria completa.
+        """
+        if tolerance is None or self.coordinates_lod is None:
+            return None
+        track = self.coordinates_lod.for_tolerance(tolerance)
+        return track.coordinates() if track is not None else None
+
+    @classmethod
+    def bbox_intersects(cls, min_lat, max_lat, min_lon, max_lon):
+        """Condizione SQL: il bounding box del percorso interseca quello dato."""
+        return db.and_(
+            cls.max_lat >= min_lat, cls.min_lat <= max_lat,
+            cls.max_lon >= min_lon, cls.min_lon <= max_lon
+        )
+
     def get_fastest_time(self):
         """Restituisce il record più veloce per questo percorso"""
-        from sqlalchemy import func
-        
-        # Trova l'attività con la durata minima per questo percorso
-        fastest_activity = Activity.query.filter_by(route_id=self.id).order_by(Activity.duration.asc()).first()
-        
-        return fastest_activity
+        from app.main.leaderboards import get_route_leaderboards
+
+        # Attività con la durata minima, dalla classifica del percorso
+        return get_route_leaderboards([self.id], limit=1, include_record=False)[self.id].fastest
 
     def __repr__(self):
         return f'<Route {self.name}>'
@@ -196,6 +261,9 @@ class Challenge(db.Model):
     bet_value = db.Column(db.String(100))
     is_active = db.Column(db.Boolean, default=True, nullable=False, index=True)
 
+    # Paginazione a cursore delle sfide terminate su (end_date, id)
+    __table_args__ = (db.Index('ix_Challenges_end_date_id', 'end_date', 'id'),)
+
     activities = db.relationship('Activity', backref='challenge', lazy='dynamic')
     invitations = db.relationship('ChallengeInvitation', backref='challenge', lazy='dynamic')
 
@@ -210,20 +278,81 @@ class Activity(db.Model):
     route_id = db.Column(db.Integer, db.ForeignKey('Routes.id'), nullable=True, index=True)
     challenge_id = db.Column(db.Integer, db.ForeignKey('Challenges.id'), nullable=True, index=True)
     activity_type = db.Column(db.String(50), nullable=False, default='Corsa', index=True)
-    gps_track = db.Column(db.Text, nullable=False)
+    # Traccia in formato binario compatto (vedi app/tracks.py): in lettura è un oggetto Track
+    gps_track = db.Column(CompactTrack, nullable=False)
+    # Versioni semplificate della traccia per le mappe a zoom bassi (vedi app/simplify.py)
+    gps_track_lod = db.deferred(db.Column(CompactTrackLevels, nullable=True))
     duration = db.Column(db.Integer, nullable=False, index=True)
     avg_speed = db.Column(db.Float, nullable=False)
     distance = db.Column(db.Float, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     name = db.Column(db.String(100), nullable=True) 
     description = db.Column(db.String(500), nullable=True) 
 
+    # Contatore denormalizzato, aggiornato con UPDATE atomici dagli endpoint dei like
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # --- TOTALI PROGRESSIVI DEL TRACCIAMENTO LIVE ---
+    # Aggiornati ad ogni punto ricevuto, così l'ingest non rilegge mai la traccia intera.
+    track_points_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    track_started_at = db.Column(db.DateTime, nullable=True)
+    last_point_at = db.Column(db.DateTime, nullable=True)
+    last_latitude = db.Column(db.Float, nullable=True)
+    last_longitude = db.Column(db.Float, nullable=True)
+    # Impostato da /tracking/stop: dopo la chiusura la sessione non accetta altri punti
+    track_finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # Ricalcolo della riga di classifica di un utente su un percorso (RouteLeaderboards)
+        db.Index('ix_Activities_route_user', 'route_id', 'user_id'),
+        # Paginazione a cursore su (created_at, id), globale e per utente
+        db.Index('ix_Activities_created_id', 'created_at', 'id'),
+        db.Index('ix_Activities_user_created_id', 'user_id', 'created_at', 'id'),
+    )
+
     likes = db.relationship('ActivityLike', backref='activity', lazy='dynamic', cascade="all, delete-orphan")
+    track_points = db.relationship('TrackPoint', backref='activity', lazy='dynamic', cascade="all, delete-orphan")
+
+    def update_simplified(self):
+        """Ricalcola i livelli semplificati a partire da 'gps_track'."""
+        from .simplify import build_levels
+
+        self.gps_track_lod = build_levels(self.gps_track)
+
+    def track_for_tolerance(self, tolerance):
+        """Traccia semplificata entro `tolerance` metri, altrimenti quella completa."""
+        if tolerance is not None and self.gps_track_lod is not None:
+            track = self.gps_track_lod.for_tolerance(tolerance)
+            if track is not None:
+                return track
+        return self.gps_track
 
     def __repr__(self):
         return f'<Activity {self.id}>'
 
 
+class TrackPoint(db.Model):
+    """
+    Punto GPS ricevuto durante un tracciamento live (append-only).
+    Alla fine della sessione i punti vengono riversati in Activity.gps_track.
+    """
+    __tablename__ = 'activity_track_points'
+    id = db.Column(db.Integer, primary_key=True)
+    activity_id = db.Column(db.Integer, db.ForeignKey('Activities.id'), nullable=False, index=True)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=True)
+    speed = db.Column(db.Float, default=0)
+    altitude = db.Column(db.Float, default=0)
+    accuracy = db.Column(db.Float, default=0)
+
+    # Garanzia a livello DB contro i punti ritrasmessi due volte
+    __table_args__ = (db.UniqueConstraint('activity_id', 'recorded_at', name='_activity_point_time_uc'),)
+
+    def __repr__(self):
+        return f'<TrackPoint {self.id} of Activity {self.activity_id}>'
+
+
 # =====================================================================
 # MODELLI PER POST, COMMENTI, LIKE E TAG
 # Riordinati per una corretta definizione delle dipendenze
@@ -244,10 +373,14 @@ class Post(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     content = db.Column(db.Text, nullable=False)
     image_url = db.Column(db.String(120), nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     post_type = db.Column(db.String(50), default='text', index=True)
     post_category = db.Column(db.String(50), default='user_post', nullable=False, index=True)
     meta_data = db.Column(JSONB) # Usa JSONB invece di db.JSON
+
+    # Contatori denormalizzati, aggiornati con UPDATE atomici dagli endpoint di like/commenti
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     user = db.relationship('User', backref='posts')
     comments = db.relationship('PostComment', backref='post', lazy='dynamic', cascade="all, delete-orphan")
@@ -350,7 +483,41 @@ class RouteRecord(db.Model):
     activity_type = db.Column(db.String(50), nullable=False, default='Corsa', index=True)
     duration = db.Column(db.Integer, nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    activity = db.relationship('Activity', backref=db.backref('record_info', uselist=False))
+    # Alla cancellazione dell'attività il record viene riallineato dagli eventi della classifica
+    # (app/main/leaderboards.py): l'ORM non deve provare ad azzerare activity_id
+    activity = db.relationship('Activity', backref=db.backref('record_info', uselist=False, passive_deletes='all'))
+
+
+class RouteLeaderboard(db.Model):
+    """
+    Classifica materializzata: il miglior tempo di ogni utente per
+    (percorso, tipo di attività). Aggiornata dagli eventi su Activity
+    (app/main/leaderboards.py), così posizione e top N sono lookup su indice
+    invece di ordinare tutte le attività del percorso.
+    """
+    __tablename__ = 'RouteLeaderboards'
+    id = db.Column(db.Integer, primary_key=True)
+    route_id = db.Column(db.Integer, db.ForeignKey('Routes.id'), nullable=False)
+    activity_type = db.Column(db.String(50), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # Attività con il miglior tempo dell'utente
+    activity_id = db.Column(db.Integer, db.ForeignKey('Activities.id'), unique=True, nullable=False)
+    duration = db.Column(db.Integer, nullable=False)
+    # Tentativi dell'utente su (percorso, tipo)
+    attempts = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    user = db.relationship('User')
+    activity = db.relationship('Activity')
+
+    __table_args__ = (
+        db.UniqueConstraint('route_id', 'activity_type', 'user_id', name='_route_type_user_uc'),
+        # Ordine della classifica: (durata, activity_id) per spareggiare a favore del tempo più vecchio
+        db.Index('ix_RouteLeaderboards_rank', 'route_id', 'activity_type', 'duration', 'activity_id'),
+    )
+
+    def __repr__(self):
+        return f'<RouteLeaderboard route={self.route_id} {self.activity_type} user={self.user_id} {self.duration}s>'
 
 class Badge(db.Model):
     __tablename__ = 'Badges'
@@ -378,11 +545,15 @@ class Notification(db.Model):
     action = db.Column(db.String(50), nullable=False)
     object_id = db.Column(db.Integer, nullable=True)
     object_type = db.Column(db.String(50), nullable=True)
-    read = db.Column(db.Boolean, default=False, nullable=False, index=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # active_history: il valore precedente serve all'evento che aggiorna User.unread_notifications
+    read = db.column_property(db.Column(db.Boolean, default=False, nullable=False, index=True), active_history=True)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     recipient = db.relationship('User', foreign_keys=[recipient_id], backref=db.backref('notifications', lazy='dynamic'))
     actor = db.relationship('User', foreign_keys=[actor_id])
 
+    # Paginazione a cursore delle notifiche di un utente su (timestamp, id)
+    __table_args__ = (db.Index('ix_notifications_recipient_ts', 'recipient_id', 'timestamp', 'id'),)
+
 class ChallengeInvitation(db.Model):
     __tablename__ = 'ChallengeInvitations'
     id = db.Column(db.Integer, primary_key=True)
@@ -408,6 +579,119 @@ class Bet(db.Model):
     winner = db.relationship('User', foreign_keys=[winner_id], backref='bets_won')
     loser = db.relationship('User', foreign_keys=[loser_id], backref='bets_lost')
     related_post_id = db.Column(db.Integer, nullable=True)
+
+
+class TimelineEntry(db.Model):
+    """
+    Timeline personale materializzata (fan-out on write): una riga per ogni
+    post o attività che un utente vede nel proprio feed. La riga dell'autore
+    si scrive insieme all'elemento, quelle dei follower le scrive il worker
+    (vedi app/main/timeline.py).
+    """
+    __tablename__ = 'timeline_entries'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)   # proprietario della timeline
+    item_type = db.Column(db.String(20), nullable=False)                        # 'post' o 'activity'
+    item_id = db.Column(db.Integer, nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    ts = db.Column(db.DateTime, nullable=False)                                 # created_at dell'elemento
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'item_type', 'item_id', name='_timeline_user_item_uc'),
+        # Lettura del feed: range scan su (user_id, ts)
+        db.Index('ix_timeline_entries_user_ts', 'user_id', 'ts', 'id'),
+        db.Index('ix_timeline_entries_item', 'item_type', 'item_id'),
+        db.Index('ix_timeline_entries_user_author', 'user_id', 'author_id'),
+    )
+
+    def __repr__(self):
+        return f'<TimelineEntry user={self.user_id} {self.item_type} {self.item_id}>'
+
+
+class UserSuggestion(db.Model):
+    """
+    Utenti suggeriti da seguire, precalcolati periodicamente dal worker
+    (vedi app/main/suggestions.py). La chiave primaria (user_id, position) rende
+    la lettura dei suggerimenti di un utente un range scan già ordinato.
+    """
+    __tablename__ = 'user_suggestions'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True, autoincrement=False)            # 1 = più rilevante
+    suggested_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    score = db.Column(db.Float, nullable=False, default=0.0)
+    # Segnali che hanno prodotto il suggerimento
+    mutual_follows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    shared_groups = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    shared_routes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    same_city = db.Column(db.Boolean, nullable=False, default=False)
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    suggested_user = db.relationship('User', foreign_keys=[suggested_user_id])
+
+    __table_args__ = (db.UniqueConstraint('user_id', 'suggested_user_id', name='_user_suggestion_uc'),)
+
+    def __repr__(self):
+        return f'<UserSuggestion {self.user_id} #{self.position} -> {self.suggested_user_id}>'
+
+
+class Job(db.Model):
+    """
+    Lavoro in background nella coda persistente su DB (vedi app/jobs.py),
+    eseguito dal processo worker.py.
+    """
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False, index=True)
+    # queued -> running -> succeeded / failed (in caso di errore torna queued finché ci sono tentativi)
+    status = db.Column(db.String(20), nullable=False, default='queued', server_default='queued')
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+    payload = db.Column(db.JSON, nullable=True)
+    # File allegato (es. GPX caricato) compresso con zlib, cancellato a lavoro concluso
+    file_data = db.Column(db.LargeBinary, nullable=True)
+    result = db.Column(db.JSON, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    progress = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    progress_message = db.Column(db.String(200), nullable=True)
+
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    max_attempts = db.Column(db.Integer, nullable=False, default=3, server_default='3')
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Visibility timeout: se il worker non rinnova il lock entro questa data il job torna disponibile
+    locked_until = db.Column(db.DateTime, nullable=True)
+    locked_by = db.Column(db.String(100), nullable=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    user = db.relationship('User', backref=db.backref('jobs', lazy='dynamic'))
+
+    __table_args__ = (db.Index('ix_jobs_status_run_after', 'status', 'run_after'),)
+
+    @property
+    def is_finished(self):
+        return self.status in ('succeeded', 'failed')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'progress_message': self.progress_message,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() + 'Z' if self.created_at else None,
+            'started_at': self.started_at.isoformat() + 'Z' if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() + 'Z' if self.finished_at else None,
+        }
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
+
+
 # =====================================================================
 # FUNZIONI HELPER (associate ai modelli)
 # =====================================================================
@@ -468,8 +752,67 @@ def after_route_approved(mapper, connection, target):
         # --- FINE BLOCCO INDENTATO ---
 
 
+def update_route_bounds(mapper, connection, target):
+    """
+    Tiene allineati bounding box e centroide ogni volta che 'coordinates'
+    viene scritto (creazione, proposta classico, salvataggio GPX, admin...).
+    """
+    if target.min_lat is None or get_history(target, 'coordinates').has_changes():
+        target.update_bounds()
+
+
+def update_route_simplified(mapper, connection, target):
+    """Calcola i livelli di dettaglio del percorso alla creazione e quando cambia 'coordinates'."""
+    if target.id is None or get_history(target, 'coordinates').has_changes():
+        target.update_simplified()
+
+
+def update_activity_simplified(mapper, connection, target):
+    """Calcola i livelli di dettaglio dell'attività alla creazione e quando cambia 'gps_track'."""
+    if target.id is None or get_history(target, 'gps_track').has_changes():
+        target.update_simplified()
+
+
+def _bump_unread_notifications(connection, user_id, delta):
+    """UPDATE atomico di User.unread_notifications (mai sotto zero), nella transazione del flush."""
+    users = User.__table__
+    statement = users.update().where(users.c.id == user_id)
+    if delta < 0:
+        statement = statement.where(users.c.unread_notifications >= -delta)
+    connection.execute(statement.values(unread_notifications=users.c.unread_notifications + delta))
+
+
+def notification_inserted(mapper, connection, target):
+    """Ogni notifica creata non letta incrementa il contatore del destinatario, ovunque venga creata."""
+    if not target.read:
+        _bump_unread_notifications(connection, target.recipient_id, 1)
+
+
+def notification_updated(mapper, connection, target):
+    """Notifica segnata come letta (o di nuovo non letta) su un singolo oggetto."""
+    history = get_history(target, 'read')
+    if history.has_changes():
+        was_read = bool(history.deleted and history.deleted[0])
+        if was_read != bool(target.read):
+            _bump_unread_notifications(connection, target.recipient_id, -1 if target.read else 1)
+
+
+def notification_deleted(mapper, connection, target):
+    if not target.read:
+        _bump_unread_notifications(connection, target.recipient_id, -1)
+
+
 # Registra il listener per il modello Route
 event.listen(Route, 'after_update', after_route_approved)
+event.listen(Route, 'before_insert', update_route_bounds)
+event.listen(Route, 'before_update', update_route_bounds)
+event.listen(Route, 'before_insert', update_route_simplified)
+event.listen(Route, 'before_update', update_route_simplified)
+event.listen(Activity, 'before_insert', update_activity_simplified)
+event.listen(Activity, 'before_update', update_activity_simplified)
+event.listen(Notification, 'after_insert', notification_inserted)
+event.listen(Notification, 'after_update', notification_updated)
+event.listen(Notification, 'after_delete', notification_deleted)
 
 
 
@@ -0,0 +1,172 @@
+# app/pagination.py
+"""
+Paginazione keyset ("a cursore") per le liste ordinate per data.
+
+Invece di OFFSET, ogni pagina riparte dalla chiave dell'ultimo elemento
+mostrato, ad esempio (created_at, id): la query diventa un range scan
+sull'indice e la pagina N costa quanto la prima. Gli elementi inseriti
+mentre l'utente scorre non fanno slittare quelli già visti.
+
+Il cursore è un token opaco (JSON in base64 url-safe) con la direzione
+('next' o 'prev') e i valori della chiave. Le colonne della chiave devono
+identificare univocamente la riga (per questo si aggiunge sempre l'id) e non
+devono essere NULL.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import request
+from sqlalchemy import tuple_
+
+
+NEXT = 'next'
+PREV = 'prev'
+
+
+class InvalidCursor(ValueError):
+    """Cursore malformato o non compatibile con la lista richiesta."""
+
+
+# =====================================================================
+# CURSORI
+# =====================================================================
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    return value
+
+
+def _load_value(value):
+    # Solo i tipi che _dump_value può produrre: liste, oggetti o null
+    # finirebbero nel confronto tra tuple e farebbero fallire la query
+    if isinstance(value, dict):
+        if set(value) != {'dt'} or not isinstance(value['dt'], str):
+            raise InvalidCursor('Valore del cursore non riconosciuto.')
+        return datetime.fromisoformat(value['dt'])
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise InvalidCursor('Valore del cursore non riconosciuto.')
+    return value
+
+
+def _check_key_types(keys, values):
+    """InvalidCursor se un valore non è del tipo Python della sua colonna (es. testo al posto di una data)."""
+    for column, value in zip(keys, values):
+        try:
+            expected = column.type.python_type
+        except NotImplementedError:
+            continue    # tipo senza equivalente Python: nessun controllo possibile
+        if expected is float and isinstance(value, int):
+            continue
+        if not isinstance(value, expected):
+            raise InvalidCursor('Il cursore non appartiene a questa lista.')
+
+
+def encode_cursor(values, direction=NEXT):
+    """Token opaco per riprendere la lista dopo (NEXT) o prima (PREV) della chiave `values`."""
+    raw = json.dumps({'d': direction, 'k': [_dump_value(v) for v in values]}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """(direzione, valori della chiave) di un token; InvalidCursor se non è valido."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        data = json.loads(raw)
+        direction, values = data['d'], data['k']
+        if direction not in (NEXT, PREV) or not isinstance(values, list):
+            raise InvalidCursor('Cursore non valido.')
+        return direction, tuple(_load_value(v) for v in values)
+    except (binascii.Error, UnicodeDecodeError, TypeError, KeyError, ValueError) as e:
+        if isinstance(e, InvalidCursor):
+            raise
+        raise InvalidCursor('Cursore non valido.') from e
+
+
+# =====================================================================
+# PAGINE
+# =====================================================================
+
+class KeysetPage:
+    """Una pagina di risultati con i cursori per la pagina successiva e precedente."""
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def keyset_paginate(query, keys, cursor=None, per_page=10, descending=True, key_of=None):
+    """
+    Pagina di `query` ordinata per le colonne `keys` (tutte discendenti o
+    tutte ascendenti), a partire dal token `cursor` (None = prima pagina).
+
+    `key_of(item)` ricava i valori della chiave da un elemento; di default
+    legge gli attributi con il nome delle colonne (funziona con i modelli e
+    con le righe di select etichettate). Solleva InvalidCursor se il token
+    non è valido per questa chiave.
+    """
+    if key_of is None:
+        names = [column.key for column in keys]
+
+        def key_of(item):
+            return tuple(getattr(item, name) for name in names)
+
+    direction, values = decode_cursor(cursor) if cursor else (NEXT, None)
+    if values is not None:
+        if len(values) != len(keys):
+            raise InvalidCursor('Il cursore non appartiene a questa lista.')
+        _check_key_types(keys, values)
+
+    # Verso la pagina precedente si scorre la lista al contrario e poi si ribalta
+    backwards = direction == PREV
+    ascending = descending == backwards
+    ordering = [column.asc() if ascending else column.desc() for column in keys]
+    if values is not None:
+        key = tuple_(*keys)
+        query = query.filter(key > tuple_(*values) if ascending else key < tuple_(*values))
+
+    rows = query.order_by(None).order_by(*ordering).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+    if backwards:
+        items.reverse()
+
+    # Dal lato del cursore c'è sempre almeno l'elemento da cui si è partiti
+    has_next = has_more if not backwards else values is not None
+    has_prev = has_more if backwards else values is not None
+    next_cursor = encode_cursor(key_of(items[-1]), NEXT) if items and has_next else None
+    prev_cursor = encode_cursor(key_of(items[0]), PREV) if items and has_prev else None
+    return KeysetPage(items, per_page, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+def paginate_request(query, keys, per_page=10, descending=True, key_of=None):
+    """
+    keyset_paginate con il cursore del parametro `cursor` della richiesta
+    corrente; un cursore non valido (link vecchio o modificato) riporta alla
+    prima pagina.
+    """
+    cursor = request.args.get('cursor') or None
+    try:
+        return keyset_paginate(query, keys, cursor=cursor, per_page=per_page,
+                               descending=descending, key_of=key_of)
+    except InvalidCursor:
+        print(f"⚠️ Cursore di paginazione non valido ignorato: {cursor[:40]}")
+        return keyset_paginate(query, keys, per_page=per_page, descending=descending, key_of=key_of)
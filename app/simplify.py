@@ -0,0 +1,213 @@
+# app/simplify.py
+"""
+Semplificazione delle tracce e livelli di dettaglio per zoom.
+
+Le mappe di panoramica ricevevano percorsi e attività a piena risoluzione
+(spesso migliaia di punti). Alla scrittura di Route.coordinates e
+Activity.gps_track calcoliamo qui, con Douglas–Peucker in proiezione metrica
+locale, alcune versioni semplificate (LOD_TOLERANCES, in metri) salvate in
+formato binario compatto nelle colonne `coordinates_lod` / `gps_track_lod`.
+
+Le API scelgono il livello in base a `zoom` (o direttamente `tolerance` in
+metri): la tolleranza è circa la dimensione di un pixel a quello zoom, quindi
+la linea disegnata è indistinguibile da quella completa.
+
+    header:  magic b'LOD' | versione (B) | numero livelli (B)
+    livello: tolleranza in metri (f) | lunghezza (I) | traccia (formato app.tracks)
+"""
+import math
+import struct
+import zlib
+
+import numpy as np
+import shapely
+from shapely.geometry import LineString
+from sqlalchemy.types import LargeBinary, TypeDecorator
+
+from app.geofence import LocalProjection
+from app.tracks import Track, decode_track, encode_track, to_track
+
+
+# Tolleranze dei livelli salvati (metri): ~1 pixel agli zoom 15, 13, 11 e 9 alle nostre latitudini
+LOD_TOLERANCES = (4.0, 16.0, 64.0, 256.0)
+# Sotto questo numero di punti non vale la pena semplificare
+MIN_POINTS = 16
+
+MAGIC = b'LOD'
+VERSION = 1
+_HEADER = struct.Struct('<3sBB')
+_LEVEL = struct.Struct('<fI')
+
+# Metri per pixel all'equatore a zoom 0 (tile Web Mercator da 256 px)
+_METERS_PER_PIXEL_Z0 = 156543.03392
+MAX_ZOOM = 22
+
+
+# =====================================================================
+# DOUGLAS–PEUCKER
+# =====================================================================
+
+def simplify_track(track, tolerance, projection=None):
+    """
+    Traccia semplificata (solo lon/lat) con Douglas–Peucker: la linea
+    risultante resta entro `tolerance` metri da quella originale.
+    La semplificazione gira in GEOS (shapely) sulle coordinate proiettate.
+    """
+    track = to_track(track)
+    if len(track) <= 2:
+        return Track(track.lon, track.lat)
+    if projection is None:
+        projection = LocalProjection.for_coordinates(track.lon, track.lat)
+    x, y = projection.forward(track.lon, track.lat)
+    return _simplified(LineString(np.column_stack((x, y))), tolerance, projection)
+
+
+def _simplified(line, tolerance, projection):
+    simplified = shapely.get_coordinates(shapely.simplify(line, tolerance, preserve_topology=False))
+    lon, lat = projection.inverse(simplified[:, 0], simplified[:, 1])
+    return Track(lon, lat)
+
+
+# =====================================================================
+# LIVELLI DI DETTAGLIO
+# =====================================================================
+
+class TrackLevels:
+    """
+    Versioni semplificate di una traccia, ordinate per tolleranza crescente.
+    Un insieme vuoto significa "usa sempre la traccia completa".
+    """
+
+    __slots__ = ('levels',)
+
+    def __init__(self, levels=()):
+        self.levels = tuple(sorted(levels, key=lambda level: level[0]))
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __repr__(self):
+        counts = ', '.join(f'{tolerance:g}m: {len(track)}' for tolerance, track in self.levels)
+        return f'<TrackLevels {counts}>'
+
+    def level_for(self, tolerance):
+        """Coppia (tolleranza, traccia) più semplificata entro `tolerance` metri, None se nessuna."""
+        if tolerance is None:
+            return None
+        chosen = None
+        for level in self.levels:
+            if level[0] > tolerance:
+                break
+            chosen = level
+        return chosen
+
+    def for_tolerance(self, tolerance):
+        """Livello più semplificato entro `tolerance` metri; None = traccia completa."""
+        level = self.level_for(tolerance)
+        return level[1] if level is not None else None
+
+    def point_counts(self):
+        return {tolerance: len(track) for tolerance, track in self.levels}
+
+
+def build_levels(track, tolerances=LOD_TOLERANCES):
+    """
+    Calcola i livelli semplificati di una traccia. I livelli che non
+    riducono i punti rispetto al precedente non vengono salvati.
+    """
+    track = to_track(track)
+    if len(track) < MIN_POINTS:
+        return TrackLevels()
+
+    projection = LocalProjection.for_coordinates(track.lon, track.lat)
+    x, y = projection.forward(track.lon, track.lat)
+    line = LineString(np.column_stack((x, y)))
+    levels = []
+    previous_count = len(track)
+    for tolerance in sorted(tolerances):
+        simplified = _simplified(line, tolerance, projection)
+        if len(simplified) < 2 or len(simplified) >= previous_count:
+            continue
+        levels.append((float(tolerance), simplified))
+        previous_count = len(simplified)
+    return TrackLevels(levels)
+
+
+def tolerance_for_zoom(zoom, lat=0.0):
+    """Dimensione in metri di un pixel della mappa a quello zoom e latitudine."""
+    zoom = min(max(float(zoom), 0.0), MAX_ZOOM)
+    return _METERS_PER_PIXEL_Z0 * math.cos(math.radians(lat or 0.0)) / (2 ** zoom)
+
+
+def requested_tolerance(args, lat=None):
+    """
+    Tolleranza in metri richiesta dai parametri `tolerance` o `zoom` di
+    request.args; None (traccia completa) se nessuno dei due è valido.
+    """
+    tolerance = args.get('tolerance', type=float)
+    if tolerance is not None and math.isfinite(tolerance):
+        return max(tolerance, 0.0)
+    zoom = args.get('zoom', type=float)
+    if zoom is not None and math.isfinite(zoom):
+        return tolerance_for_zoom(zoom, lat or 0.0)
+    return None
+
+
+def with_coordinates(geojson, coordinates):
+    """
+    Copia di una Feature o LineString GeoJSON con le coordinate sostituite
+    (properties conservate). Se `coordinates` è None la restituisce invariata.
+    """
+    if coordinates is None or not isinstance(geojson, dict):
+        return geojson
+    if geojson.get('type') == 'Feature':
+        return dict(geojson, geometry={"type": "LineString", "coordinates": coordinates})
+    return {"type": "LineString", "coordinates": coordinates}
+
+
+# =====================================================================
+# CODIFICA / DECODIFICA BINARIA
+# =====================================================================
+
+def encode_levels(levels):
+    parts = [_HEADER.pack(MAGIC, VERSION, len(levels))]
+    for tolerance, track in levels.levels:
+        blob = encode_track(track)
+        parts.append(_LEVEL.pack(tolerance, len(blob)))
+        parts.append(blob)
+    return b''.join(parts)
+
+
+def decode_levels(value):
+    value = bytes(value)
+    magic, version, count = _HEADER.unpack_from(value)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Formato livelli non supportato (versione {version}).")
+    offset = _HEADER.size
+    levels = []
+    for _ in range(count):
+        tolerance, length = _LEVEL.unpack_from(value, offset)
+        offset += _LEVEL.size
+        levels.append((float(tolerance), decode_track(value[offset:offset + length])))
+        offset += length
+    return TrackLevels(levels)
+
+
+class CompactTrackLevels(TypeDecorator):
+    """Colonna LargeBinary che accetta e restituisce oggetti TrackLevels."""
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return encode_levels(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return decode_levels(value)
+        except (ValueError, zlib.error, struct.error) as e:
+            print(f"⚠️ Livelli di dettaglio non decodificabili: {e}")
+            return None
@@ -0,0 +1,589 @@
+# app/spatial.py
+"""
+Indice spaziale in-process sulle geometrie dei percorsi.
+
+Ogni worker costruisce una sola volta (alla prima richiesta) uno STRtree di
+shapely con le geometrie di tutti i percorsi e lo tiene aggiornato tramite gli
+eventi SQLAlchemy su Route, così /api/map_data non deve più decodificare il
+JSON di ogni percorso ad ogni richiesta. Lo stesso indice risponde alle
+ricerche dei k percorsi più vicini a un punto (/api/routes/nearby).
+
+Accanto all'indice c'è una cache LRU limitata (RouteGeometryCache) delle
+geometrie preparate, delle Feature GeoJSON e dei geofence dei singoli
+percorsi, usata dalla validazione delle attività e dalle risposte della mappa.
+"""
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+from shapely import STRtree
+from shapely.geometry import LineString, Point, box
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import get_history
+
+from app import db
+from app.geo import EARTH_RADIUS_M
+from app.geofence import DEFAULT_BUFFER_METERS, DEFAULT_SECTIONS, LocalProjection, RouteGeofence
+from app.polyline import DEFAULT_PRECISION, clamp_precision, encode, encode_track
+from app.models import Route
+
+
+# =====================================================================
+# PARSING DELLE COORDINATE DEI PERCORSI
+# =====================================================================
+
+def parse_route_coordinates(raw_coordinates):
+    """
+    Restituisce la lista di coordinate [lon, lat(, alt)] di un percorso,
+    qualunque sia il formato salvato in Route.coordinates
+    (Feature GeoJSON, LineString GeoJSON o semplice array). None se non valido.
+    """
+    if not raw_coordinates:
+        return None
+    try:
+        loaded = json.loads(raw_coordinates) if isinstance(raw_coordinates, str) else raw_coordinates
+    except (json.JSONDecodeError, TypeError):
+        return None
+
+    if isinstance(loaded, dict) and loaded.get('type') == 'Feature':
+        loaded = loaded.get('geometry') or {}
+    if isinstance(loaded, dict) and loaded.get('type') in ('LineString', 'Point'):
+        loaded = loaded.get('coordinates')
+        # Un Point GeoJSON ha una sola coppia di coordinate
+        if loaded and not isinstance(loaded[0], (list, tuple)):
+            loaded = [loaded]
+
+    if isinstance(loaded, list) and loaded and all(isinstance(c, (list, tuple)) and len(c) >= 2 for c in loaded):
+        return loaded
+    return None
+
+
+def route_geojson_feature(raw_coordinates):
+    """
+    Normalizza Route.coordinates in una Feature GeoJSON per le risposte API.
+    Una Feature già salvata viene restituita così com'è (con le sue properties).
+    """
+    if not raw_coordinates:
+        return None
+    try:
+        loaded = json.loads(raw_coordinates)
+    except json.JSONDecodeError:
+        return None
+
+    if isinstance(loaded, dict) and 'geometry' in loaded:
+        return loaded
+    if isinstance(loaded, dict) and loaded.get('type') == 'LineString':
+        return {"type": "Feature", "geometry": loaded, "properties": {}}
+    if isinstance(loaded, list):
+        return {
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": loaded},
+            "properties": {}
+        }
+    return None
+
+
+def route_geometry(raw_coordinates):
+    """Costruisce la geometria shapely (LineString o Point) di un percorso."""
+    coords = parse_route_coordinates(raw_coordinates)
+    if not coords:
+        return None
+    try:
+        # Da array NumPy shapely crea la geometria senza convertire punto per punto
+        xy = np.array([c[:2] for c in coords], dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+    if len(xy) == 1:
+        return Point(xy[0])
+    return LineString(xy)
+
+
+# =====================================================================
+# INDICE SPAZIALE
+# =====================================================================
+
+class RouteSpatialIndex:
+    """
+    STRtree sulle geometrie dei percorsi, con aggiornamenti incrementali.
+
+    Lo STRtree di shapely è immutabile: le modifiche finiscono in un piccolo
+    buffer di geometrie "pending" (scansionate linearmente) e in un insieme di
+    id rimossi; quando il buffer supera REBUILD_THRESHOLD l'albero viene
+    ricostruito. L'indice viene comunque ricaricato dal DB dopo `max_age`
+    secondi, per recepire le modifiche fatte dagli altri worker.
+    """
+
+    REBUILD_THRESHOLD = 64
+    # Raggio iniziale (metri) della ricerca dei più vicini, moltiplicato per
+    # NEAREST_GROWTH finché non si trovano k percorsi entro il raggio
+    NEAREST_START_M = 2_000
+    NEAREST_GROWTH = 4
+    NEAREST_MEASURES = ('line', 'start')
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._geometries = {}       # route_id -> geometria shapely
+        self._activity_types = {}   # route_id -> activity_type, per filtrare le ricerche
+        self._tree = None
+        self._tree_ids = np.empty(0, dtype=np.int64)
+        self._tree_id_set = set()
+        self._pending = {}          # route_id -> geometria non ancora nell'albero
+        self._removed = set()       # id presenti nell'albero ma non più validi
+        self._built_at = None
+
+    @property
+    def is_built(self):
+        return self._built_at is not None
+
+    def is_stale(self):
+        return self._built_at is None or (time.monotonic() - self._built_at) > self.max_age
+
+    def __len__(self):
+        return len(self._geometries)
+
+    def build(self, rows):
+        """Ricostruisce l'indice da un iterabile di terne (route_id, coordinates, activity_type)."""
+        geometries = {}
+        activity_types = {}
+        for route_id, raw_coordinates, activity_type in rows:
+            geometry = route_geometry(raw_coordinates)
+            if geometry is not None:
+                geometries[route_id] = geometry
+                activity_types[route_id] = activity_type
+        with self._lock:
+            self._geometries = geometries
+            self._activity_types = activity_types
+            self._rebuild_tree()
+            self._built_at = time.monotonic()
+
+    def _rebuild_tree(self):
+        ids = list(self._geometries.keys())
+        self._tree_ids = np.array(ids, dtype=np.int64)
+        self._tree_id_set = set(ids)
+        self._tree = STRtree([self._geometries[i] for i in ids]) if ids else None
+        self._pending = {}
+        self._removed = set()
+
+    def upsert(self, route_id, raw_coordinates, activity_type=None):
+        """Inserisce o aggiorna la geometria di un percorso."""
+        self._store(route_id, route_geometry(raw_coordinates), activity_type)
+
+    def set_activity_type(self, route_id, activity_type):
+        with self._lock:
+            if route_id in self._geometries:
+                self._activity_types[route_id] = activity_type
+
+    def _store(self, route_id, geometry, activity_type=None):
+        with self._lock:
+            if route_id in self._tree_id_set:
+                self._removed.add(route_id)
+            self._pending.pop(route_id, None)
+            if geometry is None:
+                self._geometries.pop(route_id, None)
+                self._activity_types.pop(route_id, None)
+            else:
+                self._geometries[route_id] = geometry
+                self._activity_types[route_id] = activity_type
+                self._pending[route_id] = geometry
+            self._maybe_rebuild()
+
+    def remove(self, route_id):
+        """Toglie un percorso dall'indice."""
+        with self._lock:
+            self._geometries.pop(route_id, None)
+            self._activity_types.pop(route_id, None)
+            self._pending.pop(route_id, None)
+            if route_id in self._tree_id_set:
+                self._removed.add(route_id)
+            self._maybe_rebuild()
+
+    def _maybe_rebuild(self):
+        if len(self._pending) + len(self._removed) > self.REBUILD_THRESHOLD:
+            self._rebuild_tree()
+
+    def geometry(self, route_id):
+        return self._geometries.get(route_id)
+
+    def geometry_for(self, route):
+        """
+        Geometria di un oggetto Route già caricato. Se quella in memoria manca
+        o non corrisponde più al bounding box salvato sul DB (es. percorso
+        modificato da un altro worker) viene ricostruita e aggiornata.
+        """
+        geometry = self._geometries.get(route.id)
+        if geometry is not None and (route.min_lon is None or _same_bounds(geometry.bounds, route)):
+            return geometry
+        geometry = route_geometry(route.coordinates)
+        self._store(route.id, geometry, route.activity_type)
+        return geometry
+
+    def query_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Restituisce l'insieme degli id dei percorsi che intersecano il bbox."""
+        area = box(min_lon, min_lat, max_lon, max_lat)
+        with self._lock:
+            tree, tree_ids = self._tree, self._tree_ids
+            pending = list(self._pending.items())
+            removed = set(self._removed)
+
+        result = set()
+        if tree is not None:
+            hits = tree.query(area, predicate='intersects')
+            result.update(int(i) for i in tree_ids[hits] if int(i) not in removed)
+        for route_id, geometry in pending:
+            if geometry.intersects(area):
+                result.add(route_id)
+        return result
+
+    def nearest(self, lon, lat, k=10, activity_type=None, measure='line', max_distance_m=None):
+        """
+        I `k` percorsi più vicini al punto, come lista di coppie
+        (route_id, distanza in metri) ordinate per distanza. Con measure='line'
+        conta il punto più vicino della linea, con 'start' il punto di partenza.
+
+        Ricerca a raggio crescente: lo STRtree restituisce i candidati il cui
+        bounding box interseca il quadrato di lato 2·raggio, la distanza esatta
+        viene calcolata (in blocco) in una proiezione metrica centrata nel punto;
+        ci si ferma quando almeno k candidati cadono entro il raggio, perché
+        ogni percorso più vicino del raggio ha per forza il bbox nel quadrato.
+        """
+        if measure not in self.NEAREST_MEASURES:
+            raise ValueError(f"Misura non supportata: {measure} (usa 'line' o 'start').")
+        if k <= 0:
+            return []
+        projection = LocalProjection(lon, lat)
+        limit = max_distance_m if max_distance_m is not None else math.pi * EARTH_RADIUS_M
+        radius = min(self.NEAREST_START_M, limit)
+        distances = {}      # route_id -> distanza, calcolata una volta sola
+        while True:
+            delta_lat = math.degrees(radius / EARTH_RADIUS_M)
+            cos_lat = math.cos(math.radians(lat))
+            delta_lon = 180.0 if cos_lat < 1e-6 else min(delta_lat / cos_lat, 180.0)
+            candidate_ids = self.query_bbox(lon - delta_lon, lat - delta_lat, lon + delta_lon, lat + delta_lat)
+            new_ids = [
+                route_id for route_id in candidate_ids
+                if route_id not in distances
+                and (activity_type is None or self._activity_types.get(route_id) == activity_type)
+            ]
+            if new_ids:
+                distances.update(zip(new_ids, self._distances(projection, new_ids, measure)))
+
+            within = sorted((d, route_id) for route_id, d in distances.items() if d <= radius)
+            exhausted = radius >= limit or (delta_lat >= 90.0 and delta_lon >= 180.0)
+            if len(within) >= k or exhausted:
+                return [(route_id, d) for d, route_id in within[:k] if d <= limit]
+            radius = min(radius * self.NEAREST_GROWTH, limit)
+
+    def _distances(self, projection, route_ids, measure):
+        with self._lock:
+            geometries = np.array([self._geometries[i] for i in route_ids], dtype=object)
+        if measure == 'start':
+            # get_point restituisce None per i Point: il punto di partenza è il Point stesso
+            starts = shapely.get_point(geometries, 0)
+            geometries = np.where(shapely.is_missing(starts), geometries, starts)
+
+        def to_metres(coordinates):
+            return np.column_stack(projection.forward(coordinates[:, 0], coordinates[:, 1]))
+
+        projected = shapely.transform(geometries, to_metres)
+        return shapely.distance(projected, Point(0.0, 0.0)).tolist()
+
+
+def _same_bounds(bounds, route, tolerance=1e-9):
+    expected = (route.min_lon, route.min_lat, route.max_lon, route.max_lat)
+    return all(abs(a - b) <= tolerance for a, b in zip(bounds, expected))
+
+
+_route_index = RouteSpatialIndex()
+
+
+def get_route_index():
+    """
+    Restituisce l'indice dei percorsi del worker corrente, costruendolo
+    (o ricaricandolo se scaduto) alla prima richiesta.
+    Va chiamata dentro un application context.
+    """
+    if _route_index.is_stale():
+        rows = db.session.query(Route.id, Route.coordinates, Route.activity_type).all()
+        _route_index.build(rows)
+        print(f"🗺️  Indice spaziale percorsi costruito: {len(_route_index)} geometrie.")
+    return _route_index
+
+
+def routes_intersecting(routes, min_lon, min_lat, max_lon, max_lat):
+    """
+    Verifica esatta dell'intersezione col bbox per percorsi già prefiltrati
+    in SQL (Route.bbox_intersects), usando le geometrie tenute in memoria.
+    """
+    area = box(min_lon, min_lat, max_lon, max_lat)
+    result = []
+    for route in routes:
+        geometry = _route_index.geometry_for(route)
+        if geometry is not None and geometry.intersects(area):
+            result.append(route)
+    return result
+
+
+def route_ids_intersecting(route_bounds, min_lon, min_lat, max_lon, max_lat):
+    """
+    Sottoinsieme di `route_bounds` ({route_id: (min_lon, min_lat, max_lon, max_lat)})
+    che interseca il bbox: confronto tra bounding box, poi verifica esatta
+    sulle geometrie in memoria (senza geometria basta il bounding box).
+    """
+    area = box(min_lon, min_lat, max_lon, max_lat)
+    result = set()
+    for route_id, bounds in route_bounds.items():
+        if None in bounds or bounds[2] < min_lon or bounds[0] > max_lon or bounds[3] < min_lat or bounds[1] > max_lat:
+            continue
+        geometry = _route_index.geometry(route_id)
+        if geometry is None or geometry.intersects(area):
+            result.add(route_id)
+    return result
+
+
+# =====================================================================
+# CACHE LRU DELLE GEOMETRIE PER PERCORSO
+# =====================================================================
+
+def coordinates_hash(raw_coordinates):
+    """Impronta del contenuto di Route.coordinates (chiave della cache insieme all'id)."""
+    if raw_coordinates is None:
+        return None
+    if not isinstance(raw_coordinates, str):
+        raw_coordinates = json.dumps(raw_coordinates, sort_keys=True)
+    return hashlib.blake2b(raw_coordinates.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class _CachedRoute:
+    __slots__ = ('content_hash', 'coordinates', 'geometry', 'feature', 'geofences', 'polylines')
+
+    def __init__(self, content_hash, raw_coordinates):
+        self.content_hash = content_hash
+        self.coordinates = parse_route_coordinates(raw_coordinates)
+        self.geometry = route_geometry(raw_coordinates)
+        if self.geometry is not None:
+            shapely.prepare(self.geometry)
+        self.feature = route_geojson_feature(raw_coordinates) if isinstance(raw_coordinates, str) else None
+        self.geofences = {}     # (buffer_meters, sections) -> RouteGeofence
+        self.polylines = {}     # (precisione, tolleranza del livello o None) -> Encoded Polyline
+
+
+class RouteGeometryCache:
+    """
+    Cache LRU (al massimo `maxsize` percorsi) di ciò che si ricava da
+    Route.coordinates: coordinate, geometria shapely preparata, Feature GeoJSON,
+    Encoded Polyline e geofence. La chiave è (route_id, hash del contenuto): se un altro worker
+    modifica il percorso l'hash cambia e la voce viene ricostruita; nel worker
+    corrente la voce viene anche invalidata dagli eventi after_update/after_delete.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()   # route_id -> _CachedRoute
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry(self, route_id, raw_coordinates):
+        """Voce aggiornata del percorso; ritorna (voce, trovata_in_cache)."""
+        content_hash = coordinates_hash(raw_coordinates)
+        with self._lock:
+            entry = self._entries.get(route_id)
+            if entry is not None and entry.content_hash == content_hash:
+                self._entries.move_to_end(route_id)
+                return entry, True
+
+        entry = _CachedRoute(content_hash, raw_coordinates)
+        with self._lock:
+            self._entries[route_id] = entry
+            self._entries.move_to_end(route_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry, False
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def geometry(self, route):
+        """Geometria shapely preparata (LineString o Point) del percorso, None se non valida."""
+        entry, hit = self._entry(route.id, route.coordinates)
+        self._count(hit)
+        return entry.geometry
+
+    def coordinates(self, route):
+        """Lista di coordinate [lon, lat(, alt)] del percorso, None se non valida."""
+        entry, hit = self._entry(route.id, route.coordinates)
+        self._count(hit)
+        return entry.coordinates
+
+    def feature(self, route):
+        """Feature GeoJSON del percorso per le risposte API (da non modificare)."""
+        entry, hit = self._entry(route.id, route.coordinates)
+        self._count(hit)
+        return entry.feature
+
+    def polyline(self, route, precision=DEFAULT_PRECISION, tolerance=None):
+        """
+        Encoded Polyline del percorso; con `tolerance` (metri) usa il livello
+        semplificato corrispondente (serve Route.coordinates_lod caricato).
+        """
+        entry, hit = self._entry(route.id, route.coordinates)
+        precision = clamp_precision(precision)
+        level = route.coordinates_lod.level_for(tolerance) if tolerance is not None and route.coordinates_lod else None
+        key = (precision, level[0] if level else None)
+        polyline = entry.polylines.get(key)
+        if polyline is None:
+            hit = False
+            if level:
+                polyline = encode_track(level[1], precision)
+            else:
+                try:
+                    coordinates = np.asarray([c[:2] for c in entry.coordinates or []], dtype=np.float64)
+                    polyline = encode(coordinates[:, 0], coordinates[:, 1], precision) if len(coordinates) else ''
+                except (TypeError, ValueError):
+                    polyline = ''
+            entry.polylines[key] = polyline
+        self._count(hit)
+        return polyline
+
+    def geofence(self, route, buffer_meters=DEFAULT_BUFFER_METERS, sections=DEFAULT_SECTIONS):
+        """
+        Geofence (buffer metrico preparato) del percorso.
+        Solleva ValueError se il percorso non ha almeno due punti.
+        """
+        entry, hit = self._entry(route.id, route.coordinates)
+        key = (buffer_meters, sections)
+        geofence = entry.geofences.get(key)
+        if geofence is None:
+            hit = False
+            if not entry.coordinates or len(entry.coordinates) < 2:
+                self._count(hit)
+                raise ValueError("Il percorso deve avere almeno due punti.")
+            geofence = RouteGeofence.from_coordinates(entry.coordinates, buffer_meters=buffer_meters, sections=sections)
+            entry.geofences[key] = geofence
+        self._count(hit)
+        return geofence
+
+    def invalidate(self, route_id):
+        with self._lock:
+            if self._entries.pop(route_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+route_geometry_cache = RouteGeometryCache()
+
+
+# =====================================================================
+# SINCRONIZZAZIONE CON IL DATABASE
+# =====================================================================
+
+def route_bounds_changes(route, include_old=True):
+    """
+    Bounding box (min_lon, min_lat, max_lon, max_lat) toccati da una scrittura
+    sul percorso: quello attuale e, durante un flush di aggiornamento, quello
+    precedente. Usato per invalidare le cache per area dopo il commit.
+    """
+    names = ('min_lon', 'min_lat', 'max_lon', 'max_lat')
+    candidates = [tuple(getattr(route, name) for name in names)]
+    if include_old:
+        old_values = []
+        for name in names:
+            history = get_history(route, name)
+            old_values.append(history.deleted[0] if history.deleted else getattr(route, name))
+        candidates.append(tuple(old_values))
+    return {bounds for bounds in candidates if all(v is not None for v in bounds)}
+
+
+def _pending_index_changes(session):
+    # route_id -> ultima modifica da applicare all'indice dopo il commit
+    return session.info.setdefault('dirty_route_index', {})
+
+
+def _on_route_saved(mapper, connection, target):
+    session = object_session(target)
+    if session is None or not _route_index.is_built:
+        return
+    pending = _pending_index_changes(session)
+    if get_history(target, 'coordinates').has_changes() or target.id not in _route_index._geometries:
+        pending[target.id] = ('upsert', target.coordinates, target.activity_type)
+    elif get_history(target, 'activity_type').has_changes():
+        previous = pending.get(target.id)
+        if previous is not None and previous[0] == 'upsert':
+            pending[target.id] = ('upsert', previous[1], target.activity_type)
+        else:
+            pending[target.id] = ('activity_type', target.activity_type)
+
+
+def _on_route_deleted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None and _route_index.is_built:
+        _pending_index_changes(session)[target.id] = ('remove',)
+
+
+def _apply_index_changes_after_commit(session):
+    """L'indice del worker cambia solo per le scritture effettivamente confermate."""
+    pending = session.info.pop('dirty_route_index', None)
+    if not pending or not _route_index.is_built:
+        return
+    for route_id, change in pending.items():
+        if change[0] == 'upsert':
+            _route_index.upsert(route_id, change[1], change[2])
+        elif change[0] == 'activity_type':
+            _route_index.set_activity_type(route_id, change[1])
+        else:
+            _route_index.remove(route_id)
+
+
+def _discard_index_changes_after_rollback(session, previous_transaction):
+    session.info.pop('dirty_route_index', None)
+
+
+def _on_route_changed(mapper, connection, target):
+    if get_history(target, 'coordinates').has_changes():
+        route_geometry_cache.invalidate(target.id)
+
+
+def _on_route_removed(mapper, connection, target):
+    route_geometry_cache.invalidate(target.id)
+
+
+event.listen(Route, 'after_insert', _on_route_saved)
+event.listen(Route, 'after_update', _on_route_saved)
+event.listen(Route, 'after_delete', _on_route_deleted)
+event.listen(Route, 'after_update', _on_route_changed)
+event.listen(Route, 'after_delete', _on_route_removed)
+event.listen(Session, 'after_commit', _apply_index_changes_after_commit)
+event.listen(Session, 'after_soft_rollback', _discard_index_changes_after_rollback)
@@ -200,7 +200,7 @@ async function loadMapAndData(lat, lon, zoom = 13, city = null) {
     
     try {
         // Chiamata API filtrata per città
-        const apiUrl = `${mapDataApiUrl}?lat=${lat}&lon=${lon}&radius_km=50&activity_type=${activityType}&city=${encodeURIComponent(city || '')}`;
+        const apiUrl = `${mapDataApiUrl}?lat=${lat}&lon=${lon}&radius_km=50&zoom=${zoom}&activity_type=${activityType}&city=${encodeURIComponent(city || '')}`;
         const res = await fetch(apiUrl);
         const data = await res.json();
         loadedRoutes = data.routes || [];
@@ -0,0 +1,435 @@
+# app/tiles.py
+"""
+Tile vettoriali dei percorsi: /api/tiles/<z>/<x>/<y> (GeoJSON o MVT).
+
+Al posto di un'unica risposta /api/map_data per tutta la vista, la mappa
+chiede le tile XYZ (Web Mercator) che le servono: spostandosi scarica solo
+quelle nuove, e il browser/CDN le tiene in cache (ETag + Cache-Control).
+
+Per ogni tile:
+- i percorsi candidati vengono trovati con la range query indicizzata sul
+  bounding box salvato (Route.bbox_intersects);
+- la geometria parte dal livello semplificato adatto allo zoom
+  (Route.coordinates_lod, vedi app/simplify.py) o da Route.coordinates;
+- viene proiettata nelle coordinate della tile (EXTENT unità per lato),
+  ritagliata con un piccolo margine e semplificata a mezzo pixel.
+
+Le tile generate vengono salvate su disco (TILE_CACHE_DIR/z/x/y.formato) e
+condivise tra i worker; quando un percorso viene creato, modificato o
+eliminato, dopo il commit si cancellano solo le tile che toccano il suo
+bounding box (vecchio e nuovo), a tutti gli zoom.
+
+Il formato MVT (Mapbox Vector Tile 2.1) è scritto direttamente in protobuf
+qui sotto: bastano pochi tipi di messaggio e si evita una dipendenza in più.
+"""
+import hashlib
+import json
+import math
+import os
+import struct
+import tempfile
+import threading
+
+import numpy as np
+import shapely
+from flask import current_app, has_app_context
+from shapely.geometry import LineString
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session, undefer
+
+from app.models import Route
+from app.simplify import tolerance_for_zoom
+from app.spatial import route_bounds_changes, route_geometry_cache
+
+
+MAX_ZOOM = 20
+EXTENT = 4096               # unità per lato della tile (standard MVT)
+BUFFER = 64                 # margine oltre il bordo, evita giunzioni visibili tra tile
+SIMPLIFY_UNITS = 8          # mezzo pixel su una tile da 256 px
+LAYER_NAME = 'routes'
+
+FORMATS = {
+    'geojson': 'application/geo+json',
+    'mvt': 'application/vnd.mapbox-vector-tile',
+}
+FORMAT_ALIASES = {'json': 'geojson', 'pbf': 'mvt'}
+
+
+# =====================================================================
+# WEB MERCATOR
+# =====================================================================
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bounds(z, x, y):
+    """Bounding box (min_lon, min_lat, max_lon, max_lat) della tile."""
+    n = 2 ** z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+
+def tile_range(z, min_lon, min_lat, max_lon, max_lat):
+    """Intervalli (x_min, x_max, y_min, y_max) delle tile a zoom z che coprono il bbox."""
+    n = 2 ** z
+    x0, y0 = _mercator_units(np.array([min_lon, max_lon]), np.array([max_lat, min_lat]))
+    xs = np.clip(np.floor(x0 * n), 0, n - 1).astype(int)
+    ys = np.clip(np.floor(y0 * n), 0, n - 1).astype(int)
+    return int(xs[0]), int(xs[1]), int(ys[0]), int(ys[1])
+
+
+def _mercator_units(lon, lat):
+    """Gradi -> coordinate Web Mercator normalizzate in [0, 1] (y verso il basso)."""
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -85.0511287798, 85.0511287798)
+    x = (np.asarray(lon, dtype=np.float64) + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(np.radians(lat)) + 1.0 / np.cos(np.radians(lat))) / math.pi) / 2.0
+    return x, y
+
+
+def _to_tile(lon, lat, z, x, y):
+    mx, my = _mercator_units(lon, lat)
+    scale = (2 ** z) * EXTENT
+    return mx * scale - x * EXTENT, my * scale - y * EXTENT
+
+
+def _from_tile(px, py, z, x, y):
+    scale = (2 ** z) * EXTENT
+    mx = (np.asarray(px) + x * EXTENT) / scale
+    my = (np.asarray(py) + y * EXTENT) / scale
+    lon = mx * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * my))))
+    return lon, lat
+
+
+# =====================================================================
+# COSTRUZIONE DELLA TILE
+# =====================================================================
+
+def _route_lon_lat(route, tolerance):
+    track = route.coordinates_lod.for_tolerance(tolerance) if route.coordinates_lod is not None else None
+    if track is not None:
+        return track.lon, track.lat
+    coordinates = route_geometry_cache.coordinates(route)
+    if not coordinates:
+        return None
+    try:
+        array = np.asarray([c[:2] for c in coordinates], dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+    return array[:, 0], array[:, 1]
+
+
+def _tile_parts(route, z, x, y, tolerance):
+    """Parti della linea del percorso dentro la tile, in coordinate intere della tile."""
+    lon_lat = _route_lon_lat(route, tolerance)
+    if lon_lat is None or len(lon_lat[0]) < 2:
+        return []
+    px, py = _to_tile(lon_lat[0], lon_lat[1], z, x, y)
+    clipped = shapely.clip_by_rect(LineString(np.column_stack((px, py))),
+                                   -BUFFER, -BUFFER, EXTENT + BUFFER, EXTENT + BUFFER)
+    clipped = shapely.simplify(clipped, SIMPLIFY_UNITS, preserve_topology=False)
+
+    parts = []
+    for line in getattr(clipped, 'geoms', [clipped]):
+        if line.is_empty or line.geom_type != 'LineString':
+            continue
+        points = np.round(shapely.get_coordinates(line)).astype(np.int64)
+        # Punti consecutivi uguali dopo l'arrotondamento non servono
+        keep = np.ones(len(points), dtype=bool)
+        keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+        points = points[keep]
+        if len(points) >= 2:
+            parts.append(points)
+    return parts
+
+
+def _route_properties(route):
+    return {
+        'id': route.id,
+        'name': route.name,
+        'activity_type': route.activity_type,
+        'distance_km': route.distance_km,
+        'is_featured': bool(route.is_featured),
+    }
+
+
+def build_tile(z, x, y, tile_format):
+    """Genera la tile (bytes) con i percorsi che la attraversano."""
+    min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+    # Margine in gradi corrispondente al BUFFER in unità della tile
+    margin_lon = (max_lon - min_lon) * BUFFER / EXTENT
+    margin_lat = (max_lat - min_lat) * BUFFER / EXTENT
+    routes = Route.query.options(undefer(Route.coordinates_lod)).filter(
+        Route.bbox_intersects(min_lat - margin_lat, max_lat + margin_lat,
+                              min_lon - margin_lon, max_lon + margin_lon)
+    ).order_by(Route.id).all()
+
+    tolerance = tolerance_for_zoom(z, (min_lat + max_lat) / 2.0)
+    features = []
+    for route in routes:
+        parts = _tile_parts(route, z, x, y, tolerance)
+        if parts:
+            features.append((route, parts))
+
+    if tile_format == 'mvt':
+        return encode_mvt(features)
+    return _encode_geojson(features, z, x, y)
+
+
+def _encode_geojson(features, z, x, y):
+    # Precisione delle coordinate adeguata allo zoom (~1/16 di pixel)
+    digits = min(7, max(1, int(math.ceil(math.log10(2 ** z * EXTENT / 360.0)))))
+    collection = []
+    for route, parts in features:
+        lines = []
+        for points in parts:
+            lon, lat = _from_tile(points[:, 0], points[:, 1], z, x, y)
+            lines.append(np.column_stack((lon, lat)).round(digits).tolist())
+        geometry = ({"type": "LineString", "coordinates": lines[0]} if len(lines) == 1
+                    else {"type": "MultiLineString", "coordinates": lines})
+        collection.append({"type": "Feature", "id": route.id, "geometry": geometry,
+                           "properties": _route_properties(route)})
+    return json.dumps({"type": "FeatureCollection", "features": collection}, separators=(',', ':')).encode('utf-8')
+
+
+# =====================================================================
+# MAPBOX VECTOR TILE (protobuf)
+# =====================================================================
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+
+def _bytes_field(field, payload):
+    return _key(field, 2) + _varint(len(payload)) + payload
+
+
+def _varint_field(field, value):
+    return _key(field, 0) + _varint(value)
+
+
+def _packed(field, values):
+    return _bytes_field(field, b''.join(_varint(v) for v in values))
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _value_message(value):
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    if isinstance(value, int) and value >= 0:
+        return _varint_field(5, value)
+    if isinstance(value, int):
+        return _varint_field(6, _zigzag(value))
+    if isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    return _bytes_field(1, str(value).encode('utf-8'))
+
+
+def _line_geometry(parts):
+    """Comandi MVT: MoveTo(1) + LineTo(n-1) per ogni parte, con delta zigzag."""
+    commands = []
+    cursor_x = cursor_y = 0
+    for points in parts:
+        deltas = np.diff(points, axis=0, prepend=[[cursor_x, cursor_y]])
+        encoded = ((deltas << 1) ^ (deltas >> 63)).tolist()
+        commands.append((1 & 0x7) | (1 << 3))
+        commands.extend(encoded[0])
+        commands.append((2 & 0x7) | ((len(points) - 1) << 3))
+        for dx_dy in encoded[1:]:
+            commands.extend(dx_dy)
+        cursor_x, cursor_y = int(points[-1][0]), int(points[-1][1])
+    return commands
+
+
+def encode_mvt(features):
+    """Codifica [(route, parti), ...] in una tile MVT con il layer 'routes'."""
+    keys, key_index = [], {}
+    values, value_index = [], {}
+    feature_messages = []
+    for route, parts in features:
+        tags = []
+        for name, value in _route_properties(route).items():
+            if value is None:
+                continue
+            if name not in key_index:
+                key_index[name] = len(keys)
+                keys.append(name)
+            value_key = (type(value).__name__, value)
+            if value_key not in value_index:
+                value_index[value_key] = len(values)
+                values.append(value)
+            tags.extend((key_index[name], value_index[value_key]))
+        feature_messages.append(
+            _varint_field(1, route.id) + _packed(2, tags) + _varint_field(3, 2) + _packed(4, _line_geometry(parts))
+        )
+
+    layer = _varint_field(15, 2) + _bytes_field(1, LAYER_NAME.encode('utf-8'))
+    layer += b''.join(_bytes_field(2, message) for message in feature_messages)
+    layer += b''.join(_bytes_field(3, key.encode('utf-8')) for key in keys)
+    layer += b''.join(_bytes_field(4, _value_message(value)) for value in values)
+    layer += _varint_field(5, EXTENT)
+    return _bytes_field(3, layer)
+
+
+# =====================================================================
+# CACHE SU DISCO
+# =====================================================================
+
+class TileCache:
+    """
+    Tile salvate come file in TILE_CACHE_DIR/<z>/<x>/<y>.<formato>.
+    La scrittura è atomica (file temporaneo + rename), quindi più worker
+    possono leggere e scrivere la stessa cartella.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def base_dir():
+        return current_app.config.get('TILE_CACHE_DIR')
+
+    def _path(self, z, x, y, tile_format):
+        return os.path.join(self.base_dir(), str(z), str(x), f'{y}.{tile_format}')
+
+    def get(self, z, x, y, tile_format):
+        if not self.base_dir():
+            return None
+        try:
+            with open(self._path(z, x, y, tile_format), 'rb') as f:
+                body = f.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return body
+
+    def put(self, z, x, y, tile_format, body):
+        if not self.base_dir():
+            return
+        path = self._path(z, x, y, tile_format)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ Impossibile salvare la tile {z}/{x}/{y}: {e}")
+
+    def invalidate_bounds(self, min_lon, min_lat, max_lon, max_lat):
+        """
+        Cancella le tile (di ogni zoom e formato) che toccano il bbox.
+        Scorre solo le cartelle esistenti, non tutte le tile dell'area.
+        """
+        base_dir = self.base_dir()
+        if not base_dir or not os.path.isdir(base_dir):
+            return 0
+        removed = 0
+        for z in range(MAX_ZOOM + 1):
+            z_dir = os.path.join(base_dir, str(z))
+            if not os.path.isdir(z_dir):
+                continue
+            # Il margine delle tile vicine può contenere il percorso: si allarga di una tile
+            x_min, x_max, y_min, y_max = tile_range(z, min_lon, min_lat, max_lon, max_lat)
+            for x_entry in os.scandir(z_dir):
+                if not x_entry.name.isdigit() or not x_min - 1 <= int(x_entry.name) <= x_max + 1:
+                    continue
+                for y_entry in os.scandir(x_entry.path):
+                    y_name = y_entry.name.split('.', 1)[0]
+                    if y_name.isdigit() and y_min - 1 <= int(y_name) <= y_max + 1:
+                        try:
+                            os.remove(y_entry.path)
+                            removed += 1
+                        except OSError:
+                            pass
+        with self._lock:
+            self.invalidated += removed
+        return removed
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidated_tiles': self.invalidated,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+tile_cache = TileCache()
+
+
+def get_tile(z, x, y, tile_format):
+    """Restituisce (body, etag) della tile, dalla cache su disco o generandola."""
+    body = tile_cache.get(z, x, y, tile_format)
+    if body is None:
+        body = build_tile(z, x, y, tile_format)
+        tile_cache.put(z, x, y, tile_format, body)
+    return body, hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+# =====================================================================
+# INVALIDAZIONE DOPO LE SCRITTURE SUI PERCORSI
+# =====================================================================
+
+def _mark_dirty(target, include_old):
+    session = object_session(target)
+    if session is None:
+        return
+    session.info.setdefault('dirty_tile_bounds', set()).update(route_bounds_changes(target, include_old))
+
+
+def _on_route_inserted(mapper, connection, target):
+    _mark_dirty(target, include_old=False)
+
+
+def _on_route_updated(mapper, connection, target):
+    # Nome, tipo e attributi finiscono nelle properties: qualunque modifica invalida
+    _mark_dirty(target, include_old=True)
+
+
+def _on_route_deleted(mapper, connection, target):
+    _mark_dirty(target, include_old=False)
+
+
+def _invalidate_after_commit(session):
+    dirty = session.info.pop('dirty_tile_bounds', None)
+    if not dirty or not has_app_context():
+        return
+    removed = sum(tile_cache.invalidate_bounds(*bounds) for bounds in dirty)
+    if removed:
+        print(f"🧹 Tile invalidate dopo la modifica dei percorsi: {removed}.")
+
+
+def _discard_after_rollback(session, previous_transaction):
+    session.info.pop('dirty_tile_bounds', None)
+
+
+event.listen(Route, 'after_insert', _on_route_inserted)
+event.listen(Route, 'after_update', _on_route_updated)
+event.listen(Route, 'after_delete', _on_route_deleted)
+event.listen(Session, 'after_commit', _invalidate_after_commit)
+event.listen(Session, 'after_soft_rollback', _discard_after_rollback)
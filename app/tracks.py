@@ -0,0 +1,300 @@
+# app/tracks.py
+"""
+Formato binario compatto per Activity.gps_track.
+
+Le tracce venivano salvate come JSON verboso in diversi formati (Feature
+GeoJSON, lista di dizionari {latitude, longitude, timestamp, ...}, [[lon, lat]]).
+Ora sono salvate come array int32 codificati a delta e compressi con zlib:
+
+    header:  magic b'GTK' | versione (B) | flags (B) | numero punti (I) | tempo base epoch ms (q)
+    corpo (zlib): lat µgradi | lon µgradi | [offset tempo ms] | [quota dm]
+                  ogni canale è un array int32 little-endian codificato a delta
+
+La decodifica produce direttamente array NumPy (classe Track).
+"""
+import json
+import struct
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy.types import LargeBinary, TypeDecorator
+
+
+MAGIC = b'GTK'
+VERSION = 1
+FLAG_TIME = 0x01
+FLAG_ELEVATION = 0x02
+_HEADER = struct.Struct('<3sBBIq')
+
+COORD_SCALE = 1e6       # microgradi
+ELEVATION_SCALE = 10.0  # decimetri
+
+
+# =====================================================================
+# TIMESTAMP
+# =====================================================================
+
+def parse_timestamp(value):
+    """
+    Converte un timestamp (ISO 8601, anche con 'Z', datetime oppure epoch in
+    secondi/millisecondi) in un datetime UTC naive. None se assente.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, (int, float)):
+        seconds = value / 1000.0 if value > 1e11 else float(value)
+        return datetime.fromtimestamp(seconds, tz=timezone.utc).replace(tzinfo=None)
+    else:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def to_epoch_seconds(value):
+    """Epoch in secondi di un datetime (naive = UTC, aware convertito)."""
+    return _to_epoch_ms(parse_timestamp(value)) / 1000.0
+
+
+def _to_epoch_ms(value):
+    return int(round(value.replace(tzinfo=timezone.utc).timestamp() * 1000))
+
+
+def _from_epoch_ms(value):
+    return datetime.fromtimestamp(value / 1000.0, tz=timezone.utc).replace(tzinfo=None)
+
+
+# =====================================================================
+# TRACCIA DECODIFICATA
+# =====================================================================
+
+class Track:
+    """
+    Traccia GPS decodificata in array NumPy:
+    - lon, lat: gradi (float64)
+    - time: epoch in secondi (float64) oppure None se la traccia non ha tempi
+    - ele: quota in metri (float64) oppure None
+    """
+
+    __slots__ = ('lon', 'lat', 'time', 'ele')
+
+    def __init__(self, lon, lat, time=None, ele=None):
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.time = None if time is None else np.asarray(time, dtype=np.float64)
+        self.ele = None if ele is None else np.asarray(ele, dtype=np.float64)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0), np.empty(0))
+
+    def __len__(self):
+        return int(self.lat.size)
+
+    def __repr__(self):
+        return f'<Track {len(self)} punti>'
+
+    def __str__(self):
+        # Usato dai form di amministrazione: la traccia si modifica come JSON
+        return self.to_json()
+
+    @property
+    def has_time(self):
+        return self.time is not None
+
+    @property
+    def has_elevation(self):
+        return self.ele is not None
+
+    # --- COSTRUZIONE DAI FORMATI LEGACY ---
+
+    @classmethod
+    def from_json(cls, raw):
+        """Costruisce la traccia da una stringa JSON in uno qualsiasi dei formati storici."""
+        if raw is None or raw == '':
+            return cls.empty()
+        data = json.loads(raw) if isinstance(raw, (str, bytes)) else raw
+        return cls.from_points(data)
+
+    @classmethod
+    def from_points(cls, data):
+        """
+        Costruisce la traccia da:
+        - Feature o LineString GeoJSON
+        - lista di dizionari con latitude/longitude oppure lat/lon (o lat/lng),
+          con timestamp/time e altitude/ele opzionali
+        - lista di liste [lon, lat(, quota)]
+        """
+        if isinstance(data, dict) and data.get('type') == 'Feature':
+            data = data.get('geometry') or {}
+        if isinstance(data, dict) and data.get('type') == 'LineString':
+            data = data.get('coordinates') or []
+        if not isinstance(data, list) or not data:
+            return cls.empty()
+
+        if isinstance(data[0], (list, tuple)):
+            rows = [p for p in data if isinstance(p, (list, tuple)) and len(p) >= 2]
+            lon = [float(p[0]) for p in rows]
+            lat = [float(p[1]) for p in rows]
+            ele = None
+            if rows and all(len(p) >= 3 and p[2] is not None for p in rows):
+                ele = [float(p[2]) for p in rows]
+            return cls(lon, lat, ele=ele)
+
+        lon, lat, times, ele = [], [], [], []
+        for p in data:
+            if not isinstance(p, dict):
+                continue
+            p_lat = p.get('latitude', p.get('lat'))
+            p_lon = p.get('longitude', p.get('lon', p.get('lng')))
+            if p_lat is None or p_lon is None:
+                continue
+            lat.append(float(p_lat))
+            lon.append(float(p_lon))
+            try:
+                times.append(parse_timestamp(p.get('timestamp', p.get('time'))))
+            except (TypeError, ValueError, OverflowError, OSError):
+                times.append(None)
+            p_ele = p.get('altitude', p.get('ele'))
+            ele.append(None if p_ele is None else float(p_ele))
+
+        time_array = None
+        if times and all(t is not None for t in times):
+            time_array = [_to_epoch_ms(t) / 1000.0 for t in times]
+        ele_array = ele if ele and all(e is not None for e in ele) else None
+        return cls(lon, lat, time=time_array, ele=ele_array)
+
+    # --- ESPORTAZIONE ---
+
+    def coordinates(self):
+        """Lista [[lon, lat], ...] per GeoJSON."""
+        return np.column_stack((self.lon, self.lat)).tolist()
+
+    def to_geojson(self):
+        """Geometria LineString GeoJSON, o None se la traccia è vuota."""
+        if not len(self):
+            return None
+        return {"type": "LineString", "coordinates": self.coordinates()}
+
+    def to_points(self):
+        """Lista di dizionari nel formato usato dal tracciamento live."""
+        points = []
+        for i in range(len(self)):
+            point = {'latitude': float(self.lat[i]), 'longitude': float(self.lon[i])}
+            if self.time is not None:
+                point['timestamp'] = _from_epoch_ms(self.time[i] * 1000.0).isoformat() + 'Z'
+            if self.ele is not None:
+                point['altitude'] = float(self.ele[i])
+            points.append(point)
+        return points
+
+    def to_json(self):
+        if self.time is None and self.ele is None:
+            return json.dumps(self.coordinates())
+        return json.dumps(self.to_points())
+
+
+# =====================================================================
+# CODIFICA / DECODIFICA BINARIA
+# =====================================================================
+
+def _delta_encode(values):
+    values = np.asarray(values, dtype=np.int64)
+    deltas = np.diff(values, prepend=0)
+    if deltas.size and (deltas.max() > np.iinfo(np.int32).max or deltas.min() < np.iinfo(np.int32).min):
+        raise ValueError("Delta fuori dal range int32.")
+    return deltas.astype('<i4').tobytes()
+
+
+def _delta_decode(buffer, offset, count):
+    deltas = np.frombuffer(buffer, dtype='<i4', count=count, offset=offset)
+    return np.cumsum(deltas, dtype=np.int64), offset + count * 4
+
+
+def encode_track(track):
+    """Serializza una Track nel formato binario compatto."""
+    count = len(track)
+    flags = 0
+    base_time_ms = 0
+    channels = [
+        _delta_encode(np.round(track.lat * COORD_SCALE)),
+        _delta_encode(np.round(track.lon * COORD_SCALE)),
+    ]
+    if track.time is not None and count:
+        flags |= FLAG_TIME
+        time_ms = np.round(track.time * 1000.0).astype(np.int64)
+        base_time_ms = int(time_ms[0])
+        channels.append(_delta_encode(time_ms - base_time_ms))
+    if track.ele is not None and count:
+        flags |= FLAG_ELEVATION
+        channels.append(_delta_encode(np.round(track.ele * ELEVATION_SCALE)))
+
+    header = _HEADER.pack(MAGIC, VERSION, flags, count, base_time_ms)
+    return header + zlib.compress(b''.join(channels), 6)
+
+
+def is_encoded_track(value):
+    return isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:3]) == MAGIC
+
+
+def decode_track(value):
+    """Decodifica il formato binario in una Track (array NumPy)."""
+    value = bytes(value)
+    magic, version, flags, count, base_time_ms = _HEADER.unpack_from(value)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Formato traccia non supportato (versione {version}).")
+    body = zlib.decompress(value[_HEADER.size:])
+
+    offset = 0
+    lat, offset = _delta_decode(body, offset, count)
+    lon, offset = _delta_decode(body, offset, count)
+    time = ele = None
+    if flags & FLAG_TIME:
+        time_ms, offset = _delta_decode(body, offset, count)
+        time = (time_ms + base_time_ms) / 1000.0
+    if flags & FLAG_ELEVATION:
+        ele_dm, offset = _delta_decode(body, offset, count)
+        ele = ele_dm / ELEVATION_SCALE
+    return Track(lon / COORD_SCALE, lat / COORD_SCALE, time=time, ele=ele)
+
+
+def to_track(value):
+    """Normalizza qualsiasi rappresentazione di traccia (Track, binario, JSON, lista) in una Track."""
+    if value is None:
+        return Track.empty()
+    if isinstance(value, Track):
+        return value
+    if is_encoded_track(value):
+        return decode_track(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value).decode('utf-8')
+    return Track.from_json(value)
+
+
+class CompactTrack(TypeDecorator):
+    """
+    Colonna LargeBinary che accetta e restituisce oggetti Track.
+    In scrittura accetta anche i vecchi formati JSON (stringhe o liste),
+    che vengono convertiti automaticamente.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if is_encoded_track(value):
+            return bytes(value)
+        return encode_track(to_track(value))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return to_track(value)
+        except (ValueError, zlib.error, struct.error) as e:
+            print(f"⚠️ Traccia GPS non decodificabile: {e}")
+            return Track.empty()
@@ -0,0 +1,80 @@
+# benchmarks/bench_geo.py
+"""
+Benchmark delle statistiche delle tracce: ciclo Python punto per punto
+(vecchio calculate_activity_stats) contro il motore vettorizzato di app.geo.
+
+Uso:
+    python benchmarks/bench_geo.py [numero_punti] [ripetizioni]
+"""
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.geo import cumulative_distance, speed_series, track_stats  # noqa: E402
+from app.tracks import Track  # noqa: E402
+
+
+def legacy_distance_km(lats, lons):
+    total = 0.0
+    for i in range(1, len(lats)):
+        dlat = math.radians(lats[i] - lats[i - 1])
+        dlon = math.radians(lons[i] - lons[i - 1])
+        a = (math.sin(dlat / 2) ** 2 +
+             math.cos(math.radians(lats[i - 1])) * math.cos(math.radians(lats[i])) * math.sin(dlon / 2) ** 2)
+        total += 6371 * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return total
+
+
+def synthetic_track(n_points):
+    """Corsa simulata: un punto al secondo a ~3 m/s con rumore GPS, partenza da Milano."""
+    rng = np.random.default_rng(42)
+    heading = np.cumsum(rng.normal(0, 0.05, n_points))
+    step = 3.0 + rng.normal(0, 0.3, n_points)
+    lat = 45.4642 + np.cumsum(step * np.cos(heading)) / 111320.0
+    lon = 9.1900 + np.cumsum(step * np.sin(heading)) / (111320.0 * math.cos(math.radians(45.4642)))
+    times = 1_700_000_000 + np.arange(n_points, dtype=np.float64)
+    ele = 120 + np.cumsum(rng.normal(0, 0.2, n_points))
+    return Track(lon, lat, time=times, ele=ele)
+
+
+def timed(func, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    track = synthetic_track(n_points)
+    lats, lons = track.lat.tolist(), track.lon.tolist()
+
+    legacy_time, legacy_km = timed(lambda: legacy_distance_km(lats, lons), repeat)
+    stats_time, stats = timed(lambda: track_stats(track), repeat)
+    cumulative_time, _ = timed(lambda: cumulative_distance(track.lat, track.lon), repeat)
+    speed_time, _ = timed(lambda: speed_series(track.lat, track.lon, track.time), repeat)
+
+    print(f"Traccia sintetica: {n_points} punti, migliore di {repeat} ripetizioni")
+    print(f"  ciclo Python (solo distanza) : {legacy_time * 1000:8.2f} ms  "
+          f"({n_points / legacy_time / 1e6:6.2f} Mpunti/s)  {legacy_km:.3f} km")
+    print(f"  app.geo.track_stats (tutto)  : {stats_time * 1000:8.2f} ms  "
+          f"({n_points / stats_time / 1e6:6.2f} Mpunti/s)  {stats.distance_km:.3f} km")
+    print(f"  app.geo.cumulative_distance  : {cumulative_time * 1000:8.2f} ms")
+    print(f"  app.geo.speed_series         : {speed_time * 1000:8.2f} ms")
+    print(f"  speedup track_stats vs ciclo : {legacy_time / stats_time:6.1f}x")
+    print(f"  durata {stats.duration}s, in movimento {stats.moving_time}s, "
+          f"media {stats.avg_speed:.2f} km/h, max {stats.max_speed:.2f} km/h, "
+          f"passo {stats.avg_pace:.2f} min/km, D+ {stats.elevation_gain:.0f} m")
+
+
+if __name__ == '__main__':
+    main()
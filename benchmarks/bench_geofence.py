@@ -0,0 +1,71 @@
+# benchmarks/bench_geofence.py
+"""
+Benchmark della validazione geofencing di record_activity: vecchio ciclo
+`polygon.contains(Point(...))` con buffer in gradi contro app.geofence
+(proiezione metrica locale + contains_xy su geometria preparata).
+
+Uso:
+    python benchmarks/bench_geofence.py [numero_punti] [ripetizioni]
+"""
+import math
+import os
+import sys
+import time
+
+import numpy as np
+from shapely.geometry import LineString, Point
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.geofence import RouteGeofence  # noqa: E402
+
+
+def legacy_match(route_coords, lons, lats, buffer_meters=50):
+    polygon = LineString(route_coords).buffer(buffer_meters / (111.32 * 1000))
+    inside = sum(1 for lon, lat in zip(lons, lats) if polygon.contains(Point(lon, lat)))
+    return inside / len(lons)
+
+
+def synthetic_route_and_track(n_points):
+    """Percorso di ~20 km a 60° di latitudine e una traccia GPS rumorosa che lo segue."""
+    rng = np.random.default_rng(7)
+    lat0 = 60.0
+    t = np.linspace(0, 1, 400)
+    route_lon = 10.0 + 0.3 * t
+    route_lat = lat0 + 0.05 * np.sin(t * 6 * math.pi)
+    u = np.linspace(0, 1, n_points)
+    lon = np.interp(u, t, route_lon) + rng.normal(0, 8, n_points) / (111320 * math.cos(math.radians(lat0)))
+    lat = np.interp(u, t, route_lat) + rng.normal(0, 8, n_points) / 111320
+    return list(zip(route_lon.tolist(), route_lat.tolist())), lon, lat
+
+
+def timed(func, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    route_coords, lon, lat = synthetic_route_and_track(n_points)
+    lons, lats = lon.tolist(), lat.tolist()
+
+    legacy_time, legacy_pct = timed(lambda: legacy_match(route_coords, lons, lats), repeat)
+    build_time, geofence = timed(lambda: RouteGeofence.from_coordinates(route_coords), repeat)
+    validate_time, result = timed(lambda: geofence.validate(lon, lat), repeat)
+
+    print(f"Traccia sintetica: {n_points} punti a 60°N, migliore di {repeat} ripetizioni")
+    print(f"  ciclo contains(Point) in gradi : {legacy_time * 1000:8.2f} ms  match {legacy_pct:.1%}")
+    print(f"  costruzione geofence metrico   : {build_time * 1000:8.2f} ms")
+    print(f"  validazione vettorizzata       : {validate_time * 1000:8.2f} ms  match {result.match_percentage:.1%}, "
+          f"copertura {result.route_coverage:.1%}")
+    print(f"  speedup (costruzione inclusa)  : {legacy_time / (build_time + validate_time):6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# benchmarks/bench_gpx_stream.py
+"""
+Benchmark della lettura di un GPX grande: gpxpy.parse (albero completo in
+memoria) contro il lettore in streaming app.gpx_stream.
+
+Uso:
+    python benchmarks/bench_gpx_stream.py [numero_punti]
+"""
+import io
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.gpx_stream import read_track_file  # noqa: E402
+
+
+def synthetic_gpx(n_points):
+    """Export tipo orologio GPS: un punto al secondo con quota, tempo ed estensioni."""
+    start = datetime(2025, 1, 1, 6, 0, 0)
+    parts = ['<?xml version="1.0"?><gpx version="1.1" creator="bench" '
+             'xmlns="http://www.topografix.com/GPX/1/1"><trk><name>Bench</name><trkseg>']
+    for i in range(n_points):
+        parts.append(
+            f'<trkpt lat="{45.4 + i * 0.00003:.6f}" lon="{9.1 + i * 0.00002:.6f}">'
+            f'<ele>{100 + (i % 50)}</ele><time>{start + timedelta(seconds=i):%Y-%m-%dT%H:%M:%S}Z</time>'
+            f'<extensions><hr>140</hr></extensions></trkpt>'
+        )
+    parts.append('</trkseg></trk></gpx>')
+    return ''.join(parts).encode('utf-8')
+
+
+def measure(func):
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, peak, result
+
+
+def main():
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    data = synthetic_gpx(n_points)
+    print(f"GPX sintetico: {n_points} punti, {len(data) / 1e6:.1f} MB")
+
+    stream_time, stream_peak, parsed = measure(lambda: read_track_file(io.BytesIO(data)))
+    print(f"  app.gpx_stream : {stream_time:6.2f} s, picco memoria {stream_peak / 1e6:7.1f} MB, "
+          f"{parsed.distance_km:.2f} km, {parsed.duration} s")
+
+    try:
+        import gpxpy
+    except ImportError:
+        print("  gpxpy non installato: confronto saltato.")
+        return
+
+    def with_gpxpy():
+        gpx = gpxpy.parse(io.BytesIO(data))
+        return gpx.length_3d() or gpx.length_2d()
+
+    gpxpy_time, gpxpy_peak, length = measure(with_gpxpy)
+    print(f"  gpxpy          : {gpxpy_time:6.2f} s, picco memoria {gpxpy_peak / 1e6:7.1f} MB, "
+          f"{length / 1000:.2f} km")
+
+
+if __name__ == '__main__':
+    main()
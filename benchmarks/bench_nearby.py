@@ -0,0 +1,91 @@
+# benchmarks/bench_nearby.py
+"""
+Benchmark della ricerca dei k percorsi più vicini (RouteSpatialIndex.nearest)
+su percorsi sintetici sparsi in Italia, contro la scansione lineare che
+calcola la distanza da tutti i percorsi.
+
+Uso:
+    python benchmarks/bench_nearby.py [numero_percorsi] [k] [interrogazioni]
+"""
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import shapely
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.geofence import LocalProjection  # noqa: E402
+from app.spatial import RouteSpatialIndex  # noqa: E402
+
+
+def synthetic_rows(n_routes, n_points=50):
+    """Percorsi di ~5 km, metà attorno a tre città e metà sparsi su tutta l'Italia."""
+    rng = np.random.default_rng(3)
+    cities = np.array([[12.49, 41.89], [9.19, 45.46], [14.25, 40.85]])
+    starts = np.empty((n_routes, 2))
+    clustered = n_routes // 2
+    starts[:clustered] = cities[rng.integers(0, len(cities), clustered)] + rng.normal(0, 0.1, (clustered, 2))
+    starts[clustered:] = rng.uniform([7.0, 37.0], [18.0, 46.5], (n_routes - clustered, 2))
+    steps = rng.normal(0, 0.001, (n_routes, n_points, 2)).cumsum(axis=1)
+    types = ('Corsa', 'Bici', 'Camminata')
+    return [
+        (i + 1, json.dumps((starts[i] + steps[i]).round(6).tolist()), types[i % len(types)])
+        for i in range(n_routes)
+    ]
+
+
+def linear_scan(index, lon, lat, k):
+    ids = np.array(list(index._geometries.keys()))
+    projection = LocalProjection(lon, lat)
+    geometries = shapely.transform(
+        np.array([index._geometries[i] for i in ids], dtype=object),
+        lambda c: np.column_stack(projection.forward(c[:, 0], c[:, 1]))
+    )
+    distances = shapely.distance(geometries, shapely.Point(0.0, 0.0))
+    order = np.argsort(distances)[:k]
+    return [(int(ids[i]), float(distances[i])) for i in order]
+
+
+def main():
+    n_routes = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    n_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    rows = synthetic_rows(n_routes)
+
+    index = RouteSpatialIndex()
+    start = time.perf_counter()
+    index.build(rows)
+    build_time = time.perf_counter() - start
+
+    rng = np.random.default_rng(8)
+    queries = rng.uniform([7.0, 37.0], [18.0, 46.5], (n_queries, 2))
+    queries[: n_queries // 2] = [12.49, 41.89] + rng.normal(0, 0.05, (n_queries // 2, 2))
+
+    timings = {'line': [], 'start': [], 'filtered': []}
+    for lon, lat in queries:
+        for label, kwargs in (('line', {}), ('start', {'measure': 'start'}), ('filtered', {'activity_type': 'Bici'})):
+            t0 = time.perf_counter()
+            index.nearest(lon, lat, k=k, **kwargs)
+            timings[label].append(time.perf_counter() - t0)
+
+    lon, lat = queries[-1]
+    expected = linear_scan(index, lon, lat, k)
+    t0 = time.perf_counter()
+    linear_scan(index, lon, lat, k)
+    scan_time = time.perf_counter() - t0
+    found = index.nearest(lon, lat, k=k)
+    assert [i for i, _ in found] == [i for i, _ in expected]
+
+    print(f"{n_routes} percorsi, k={k}, {n_queries} interrogazioni (metà in centro a Roma)")
+    print(f"  costruzione indice   : {build_time * 1000:9.1f} ms")
+    for label, values in timings.items():
+        values = np.array(values) * 1000
+        print(f"  nearest ({label:8s}) : mediana {np.median(values):7.2f} ms  p95 {np.percentile(values, 95):7.2f} ms")
+    print(f"  scansione lineare    : {scan_time * 1000:9.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
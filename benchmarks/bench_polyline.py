@@ -0,0 +1,101 @@
+# benchmarks/bench_polyline.py
+"""
+Benchmark del formato di trasporto delle geometrie di /api/map_data:
+Feature GeoJSON (default) contro Encoded Polyline (format=polyline).
+Confronta byte della risposta e tempo di serializzazione, e l'encoder
+vettorizzato di app.polyline contro un encoder Python puntuale.
+
+Uso:
+    python benchmarks/bench_polyline.py [numero_percorsi] [punti_per_percorso] [ripetizioni]
+"""
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.polyline import decode, encode  # noqa: E402
+
+
+def python_encode(coordinates, precision=5):
+    """Encoder di riferimento punto per punto (come le librerie pure Python)."""
+    factor = 10 ** precision
+    output = []
+    previous_lat = previous_lon = 0
+    for lon, lat in coordinates:
+        lat_i, lon_i = int(round(lat * factor)), int(round(lon * factor))
+        for value in (lat_i - previous_lat, lon_i - previous_lon):
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                output.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            output.append(chr(value + 63))
+        previous_lat, previous_lon = lat_i, lon_i
+    return ''.join(output)
+
+
+def synthetic_routes(n_routes, n_points):
+    rng = np.random.default_rng(5)
+    routes = []
+    for i in range(n_routes):
+        t = np.linspace(0, 1, n_points)
+        lon = 12.4 + rng.uniform(-0.2, 0.2) + 0.05 * t + 0.005 * np.sin(t * 12 * math.pi)
+        lat = 41.9 + rng.uniform(-0.2, 0.2) + 0.03 * np.sin(t * 4 * math.pi)
+        routes.append((lon.round(6), lat.round(6)))
+    return routes
+
+
+def timed(func, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    n_routes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    n_points = int(sys.argv[2]) if len(sys.argv) > 2 else 2_000
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    routes = synthetic_routes(n_routes, n_points)
+    coordinate_lists = [np.column_stack((lon, lat)).tolist() for lon, lat in routes]
+
+    def geojson_payload():
+        return json.dumps({'routes': [
+            {'id': i, 'coordinates': {"type": "Feature", "properties": {},
+                                      "geometry": {"type": "LineString", "coordinates": coordinates}}}
+            for i, coordinates in enumerate(coordinate_lists)
+        ]})
+
+    def polyline_payload():
+        return json.dumps({'routes': [
+            {'id': i, 'polyline': encode(lon, lat, 5), 'polyline_precision': 5}
+            for i, (lon, lat) in enumerate(routes)
+        ]})
+
+    geojson_time, geojson_body = timed(geojson_payload, repeat)
+    polyline_time, polyline_body = timed(polyline_payload, repeat)
+    numpy_time, _ = timed(lambda: [encode(lon, lat, 5) for lon, lat in routes], repeat)
+    python_time, python_polylines = timed(lambda: [python_encode(c, 5) for c in coordinate_lists], repeat)
+
+    assert python_polylines[0] == encode(*routes[0], 5)
+    assert np.allclose(decode(python_polylines[0]), coordinate_lists[0], atol=1e-5)
+
+    print(f"{n_routes} percorsi da {n_points} punti, migliore di {repeat} ripetizioni")
+    print(f"  GeoJSON  : {len(geojson_body) / 1024:9.1f} KB  serializzazione {geojson_time * 1000:8.2f} ms")
+    print(f"  polyline : {len(polyline_body) / 1024:9.1f} KB  serializzazione {polyline_time * 1000:8.2f} ms "
+          f"(encoding incluso)")
+    print(f"  riduzione: {len(geojson_body) / len(polyline_body):6.1f}x byte, "
+          f"{geojson_time / polyline_time:6.1f}x tempo")
+    print(f"  encoder NumPy {numpy_time * 1000:8.2f} ms  contro Python puntuale {python_time * 1000:8.2f} ms "
+          f"({python_time / numpy_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
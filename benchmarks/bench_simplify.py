@@ -0,0 +1,65 @@
+# benchmarks/bench_simplify.py
+"""
+Benchmark dei livelli di dettaglio (app.simplify): tempo di calcolo alla
+scrittura e dimensione del GeoJSON restituito per zoom rispetto alla traccia
+completa.
+
+Uso:
+    python benchmarks/bench_simplify.py [numero_punti] [ripetizioni]
+"""
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.simplify import build_levels, tolerance_for_zoom  # noqa: E402
+from app.tracks import Track  # noqa: E402
+
+
+def synthetic_track(n_points):
+    """Traccia GPS di ~25 km a 45° di latitudine, un punto al secondo con rumore di 3 m."""
+    rng = np.random.default_rng(11)
+    lat0 = 45.0
+    t = np.linspace(0, 1, n_points)
+    lon = 9.0 + 0.25 * t + 0.01 * np.sin(t * 40 * math.pi)
+    lat = lat0 + 0.04 * np.sin(t * 6 * math.pi)
+    lon += rng.normal(0, 3, n_points) / (111320 * math.cos(math.radians(lat0)))
+    lat += rng.normal(0, 3, n_points) / 111320
+    return Track(lon, lat)
+
+
+def geojson_size(track):
+    return len(json.dumps({"type": "LineString", "coordinates": track.coordinates()}))
+
+
+def main():
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    track = synthetic_track(n_points)
+
+    best = float('inf')
+    levels = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        levels = build_levels(track)
+        best = min(best, time.perf_counter() - start)
+
+    full_size = geojson_size(track)
+    print(f"Traccia sintetica: {n_points} punti a 45°N, migliore di {repeat} ripetizioni")
+    print(f"  calcolo livelli (scrittura)    : {best * 1000:8.2f} ms")
+    print(f"  completa                       : {n_points:6d} punti {full_size / 1024:9.1f} KB")
+    for zoom in (10, 12, 14, 16):
+        tolerance = tolerance_for_zoom(zoom, 45.0)
+        level = levels.for_tolerance(tolerance) or track
+        size = geojson_size(level)
+        print(f"  zoom {zoom:2d} (tolleranza {tolerance:6.1f} m): {len(level):6d} punti {size / 1024:9.1f} KB "
+              f"({full_size / size:6.1f}x più piccolo)")
+
+
+if __name__ == '__main__':
+    main()
@@ -125,5 +125,12 @@ def update_route_fields(route_id, json_fields):
     else:
         click.echo("ℹ️  Nessun campo aggiornato.")
 
+@app.cli.command("reconcile-counters")
+def reconcile_counters():
+    """Ricalcola in blocco i contatori di like e commenti di post e attività."""
+    from app.main.services import reconcile_engagement_counters
+    updated_posts, updated_activities = reconcile_engagement_counters()
+    click.echo(f"✅ Contatori riallineati: {updated_posts} post e {updated_activities} attività corretti.")
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -1,18 +1,20 @@
 # worker.py (ora nella radice del progetto)
 import os
-import time
-from app import create_app, scheduler # <--- Questa dovrebbe funzionare se 'app' è una cartella Python Module
-from app.models import close_expired_challenges 
-
-print("Worker: Avvio del servizio worker...")
+import sys
 
 # Aggiungiamo esplicitamente la directory corrente al PYTHONPATH
 # per assicurarci che 'app' sia trovato, dato che il worker si avvia con 'python worker.py'
-import sys
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
+from app import create_app, scheduler  # noqa: E402
+from app.jobs import run_worker, cleanup_finished_jobs  # noqa: E402
+from app.main.gamification import close_expired_challenges  # noqa: E402
+from app.main.suggestions import REFRESH_INTERVAL_HOURS, enqueue_suggestions_refresh  # noqa: E402
+from app.main.services import reconcile_unread_notifications  # noqa: E402
 
-app = create_app() # Crea l'app per inizializzare lo scheduler
+print("Worker: Avvio del servizio worker...")
+
+app = create_app()  # Crea l'app per inizializzare lo scheduler e registrare gli handler dei job
 
 # Esegui la logica di chiusura all'avvio del worker
 with app.app_context():
@@ -21,7 +23,31 @@ with app.app_context():
         close_expired_challenges()
     except Exception as e:
         print(f"Worker: Errore durante close_expired_challenges all'avvio: {e}")
+    # Suggerimenti "chi seguire" ricalcolati all'avvio e poi periodicamente
+    enqueue_suggestions_refresh()
+
+
+@scheduler.scheduled_job('interval', hours=24)
+def scheduled_cleanup_jobs():
+    with app.app_context():
+        removed = cleanup_finished_jobs()
+        if removed:
+            print(f"Worker: eliminati {removed} job conclusi.")
+
+
+@scheduler.scheduled_job('interval', hours=24)
+def scheduled_reconcile_unread_notifications():
+    with app.app_context():
+        fixed = reconcile_unread_notifications()
+        if fixed:
+            print(f"Worker: riallineati i contatori di notifiche non lette di {fixed} utenti.")
+
+
+@scheduler.scheduled_job('interval', hours=REFRESH_INTERVAL_HOURS)
+def scheduled_refresh_suggestions():
+    with app.app_context():
+        enqueue_suggestions_refresh()
+
 
-print("Worker: Scheduler in background attivo. Il worker rimarrà attivo.")
-while True:
-    time.sleep(3600) # Mantieni il processo attivo
\ No newline at end of file
+print("Worker: Scheduler in background attivo, avvio consumo della coda job.")
+run_worker(app)  # Blocca finché il processo è attivo